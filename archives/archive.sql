@@ -1,10 +0,0 @@
-.mode csv
-.headers on
-.output dataset.csv
-select * from dataset;
-.output value.csv
-select * from value;
-.output indicator.csv
-select * from indicator;
-.output all.sql
-.dump
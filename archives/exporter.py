@@ -0,0 +1,518 @@
+"""
+Exports the CHD database for download, in place of piping archive.sql into the sqlite3 shell.
+
+Each table is read once, in chunks, and every chunk is fanned out to all the outputs at the same time: the CSV files
+of the dataset, indicator and value tables, a full SQL dump (all.sql), and optionally columnar copies of the tables
+(Parquet and/or Feather, when pyarrow is installed). The CSV files and the database are then zipped, compressing the
+members in parallel. The result has the same layout as before:
+
+    http/all.sql
+    http/v1.1/DATESTAMP
+    http/v1.1/{dataset,indicator,value}.csv
+    http/v1.1/csv.zip
+    http/v1.1/sql.zip
+
+plus the changes to the value table since the previously published value.csv, so downstream loads don't have to
+reload the whole table (see write_value_delta):
+
+    http/v1.1/value.{added,changed,removed}.csv
+    http/v1.1/delta.json
+
+Run from the home directory as
+    python exporter.py --db ~/ocha.db --output-dir ~/http
+"""
+
+import argparse
+import csv
+import datetime
+import json
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import zipfile
+import zlib
+from multiprocessing.pool import ThreadPool
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+VERSION = 'v1.1'
+CSV_TABLES = ['dataset', 'indicator', 'value']
+# columns left out of the CSV files, which keep the scraperwiki layout (num_value is the typed copy of value)
+CSV_EXCLUDED_COLUMNS = {'value': ['num_value']}
+COLUMNAR_FORMATS = ['parquet', 'feather']
+CHUNK_ROWS = 10000
+COPY_CHUNK_SIZE = 1024 * 1024
+DEFAULT_COMPRESSION_THREADS = 4
+
+DELTA_TABLE = 'value'
+DELTA_KEY_COLUMNS = ['dsID', 'region', 'indID', 'period']
+DELTA_FILENAMES = {change: '{}.{}.csv'.format(DELTA_TABLE, change) for change in ['added', 'changed', 'removed']}
+DELTA_MANIFEST_FILENAME = 'delta.json'
+DELTA_FORMAT = 1
+
+
+# characters the sqlite3 shell leaves unquoted in csv mode: printable ASCII other than space, quotes and comma
+_CSV_SAFE_TEXT = re.compile(u'^[\x21\x23-\x26\x28-\x2b\x2d-\x7e]+$')
+_PLAIN_IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def _quote_identifier(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def _dump_identifier(name):
+    """
+    Table name as the sqlite3 shell writes it in a dump, only quoted when needed
+    """
+    return name if _PLAIN_IDENTIFIER.match(name) else _quote_identifier(name)
+
+
+def _format_real(value):
+    """
+    Floats as SQLite renders them as text ("%!.15g"), e.g. 3.0, 0.3 and 1.0e+20
+    """
+    text = '%.15g' % value
+    if text.lstrip('-').isdigit():
+        return text + '.0'
+    if 'e' in text and '.' not in text:
+        mantissa, exponent = text.split('e')
+        return '{}.0e{}'.format(mantissa, exponent)
+    return text
+
+
+def _csv_field(value):
+    """
+    A value as the sqlite3 shell writes it in csv mode: null as nothing, and text quoted when empty or when it
+    holds anything other than printable ASCII without spaces, quotes or commas
+    """
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        return _format_real(value)
+    if isinstance(value, (int, long)):
+        return str(value)
+    if _CSV_SAFE_TEXT.match(value):
+        return value.encode('utf-8')
+    return '"{}"'.format(value.replace('"', '""').encode('utf-8'))
+
+
+def _csv_text(value):
+    """
+    A value as it reads back from a CSV file written by _csv_field (null reads back as empty text)
+    """
+    if value is None:
+        return u''
+    if isinstance(value, float):
+        return unicode(_format_real(value))
+    if isinstance(value, (int, long)):
+        return unicode(value)
+    return value
+
+
+class CsvSink(object):
+    """
+    Writes a table as CSV, byte for byte as the sqlite3 shell did in csv mode with headers
+    """
+    def __init__(self, filename, column_names, excluded_columns=()):
+        self.file = open(filename, 'wb')
+        self.positions = [position for position, name in enumerate(column_names) if name not in excluded_columns]
+        self._write_row(column_names)
+
+    def _write_row(self, row):
+        self.file.write(','.join(_csv_field(row[position]) for position in self.positions) + '\r\n')
+
+    def write(self, rows):
+        for row in rows:
+            self._write_row(row)
+
+    def close(self):
+        self.file.close()
+
+
+class ColumnarSink(object):
+    """
+    Writes a table as Parquet or Feather (Arrow IPC), one row group or record batch per chunk
+    """
+    ARROW_TYPES_BY_AFFINITY = [('INT', 'int64'), ('BOOL', 'int64'), ('REAL', 'float64'), ('FLOA', 'float64'),
+                               ('DOUB', 'float64')]
+
+    def __init__(self, filename, column_names, declared_types, columnar_format):
+        self.schema = pyarrow.schema([pyarrow.field(name, self._arrow_type(declared_type))
+                                      for name, declared_type in zip(column_names, declared_types)])
+        if columnar_format == 'parquet':
+            self.writer = pyarrow.parquet.ParquetWriter(filename, self.schema)
+        else:
+            self.sink = pyarrow.OSFile(filename, 'wb')
+            self.writer = pyarrow.RecordBatchFileWriter(self.sink, self.schema)
+        self.columnar_format = columnar_format
+
+    @classmethod
+    def _arrow_type(cls, declared_type):
+        for affinity, arrow_type in cls.ARROW_TYPES_BY_AFFINITY:
+            if affinity in (declared_type or '').upper():
+                return getattr(pyarrow, arrow_type)()
+        return pyarrow.string()
+
+    def write(self, rows):
+        if not rows:
+            return
+        columns = zip(*rows)
+        batch = pyarrow.RecordBatch.from_arrays(
+            [pyarrow.array(list(column), type=field.type) for column, field in zip(columns, self.schema)],
+            [field.name for field in self.schema])
+        if self.columnar_format == 'parquet':
+            self.writer.write_table(pyarrow.Table.from_batches([batch]))
+        else:
+            self.writer.write_batch(batch)
+
+    def close(self):
+        self.writer.close()
+        if self.columnar_format != 'parquet':
+            self.sink.close()
+
+
+class SqlDumpSink(object):
+    """
+    Writes a full SQL dump of the database, like the sqlite3 shell's .dump
+    """
+    def __init__(self, filename):
+        self.file = open(filename, 'w')
+        self.file.write('PRAGMA foreign_keys=OFF;\nBEGIN TRANSACTION;\n')
+
+    def start_table(self, create_statement):
+        self.file.write('{};\n'.format(create_statement.encode('utf-8')))
+
+    def write_inserts(self, table_name, quoted_rows):
+        """
+        quoted_rows are the comma separated values of each row, already quoted as SQL literals
+        """
+        prefix = 'INSERT INTO {} VALUES('.format(_dump_identifier(table_name))
+        self.file.writelines('{}{});\n'.format(prefix, quoted_row.encode('utf-8')) for quoted_row in quoted_rows)
+
+    def finish(self, other_statements):
+        for statement in other_statements:
+            self.file.write('{};\n'.format(statement.encode('utf-8')))
+        self.file.write('COMMIT;\n')
+        self.file.close()
+
+
+def export_tables(db, staging_dir, dump_filename, columnar_formats=(), chunk_rows=CHUNK_ROWS):
+    """
+    Read every table once, writing the dump and, for the CSV_TABLES, the CSV (and columnar) files as it goes.
+    Returns the filenames written to staging_dir.
+    """
+    tables = db.execute("select name, sql from sqlite_master where type = 'table' and name not like 'sqlite_%'"
+                        " order by rowid").fetchall()
+    dump = SqlDumpSink(dump_filename)
+    written = []
+
+    for table_name, create_statement in tables:
+        dump.start_table(create_statement)
+
+        table_info = db.execute("pragma table_info({})".format(_quote_identifier(table_name))).fetchall()
+        column_names = [column[1] for column in table_info]
+        declared_types = [column[2] for column in table_info]
+
+        sinks = []
+        if table_name in CSV_TABLES:
+            filename = os.path.join(staging_dir, '{}.csv'.format(table_name))
+            sinks.append(CsvSink(filename, column_names, CSV_EXCLUDED_COLUMNS.get(table_name, ())))
+            written.append(filename)
+            for columnar_format in columnar_formats:
+                filename = os.path.join(staging_dir, '{}.{}'.format(table_name, columnar_format))
+                sinks.append(ColumnarSink(filename, column_names, declared_types, columnar_format))
+                written.append(filename)
+
+        # the raw values for the CSV and columnar files, and the values quoted by SQLite itself for the dump
+        quoted_columns = " || ',' || ".join('quote({})'.format(_quote_identifier(name)) for name in column_names)
+        cursor = db.execute("select {}, {} from {}".format(
+            ', '.join(_quote_identifier(name) for name in column_names), quoted_columns,
+            _quote_identifier(table_name)))
+        while True:
+            chunk = cursor.fetchmany(chunk_rows)
+            if not chunk:
+                break
+            rows = [row[:-1] for row in chunk]
+            for sink in sinks:
+                sink.write(rows)
+            dump.write_inserts(table_name, [row[-1] for row in chunk])
+
+        for sink in sinks:
+            sink.close()
+
+    dump.finish([statement for (statement,) in db.execute(
+        "select sql from sqlite_master where type in ('index', 'trigger', 'view') and sql is not null order by rowid")])
+    return written
+
+
+def _read_published_csv(filename):
+    """
+    The rows of a CSV file written by CsvSink, as lists of unicode, header included
+    """
+    with open(filename, 'rb') as f:
+        for row in csv.reader(f):
+            yield [field.decode('utf-8') for field in row]
+
+
+def _published_rows_in_key_order(filename, key_positions):
+    """
+    The rows of a published CSV file in key order, without the header. Files exported from a WITHOUT ROWID table are
+    in key order already and are streamed, others (e.g. from before the value table was WITHOUT ROWID) are sorted.
+    """
+    def key(row):
+        return [row[position] for position in key_positions]
+
+    def rows():
+        published_rows = _read_published_csv(filename)
+        next(published_rows)
+        return published_rows
+
+    previous_key = None
+    for row in rows():
+        if previous_key is not None and key(row) < previous_key:
+            return iter(sorted(rows(), key=key))
+        previous_key = key(row)
+    return rows()
+
+
+def write_value_delta(db, previous_csv_filename, staging_dir, base_datestamp=None, datestamp=None,
+                      chunk_rows=CHUNK_ROWS):
+    """
+    Compare the value table with the value.csv published before (if any), writing the rows added, changed and
+    removed since then and a manifest describing them to staging_dir. Returns the filenames written.
+
+    Both sides are read in (dsID, region, indID, period) order and merged, so neither is held in memory. Added and
+    changed rows are written in full, as in value.csv; removed rows only have the key columns. Rows are compared as
+    they read back from value.csv. Without a previous value.csv, or if its columns differ, every row is added and the
+    manifest has no base, meaning the full table has to be loaded.
+    """
+    table_info = db.execute("pragma table_info({})".format(_quote_identifier(DELTA_TABLE))).fetchall()
+    column_names = [column[1] for column in table_info]
+    excluded_columns = CSV_EXCLUDED_COLUMNS.get(DELTA_TABLE, ())
+    csv_positions = [position for position, name in enumerate(column_names) if name not in excluded_columns]
+    csv_column_names = [column_names[position] for position in csv_positions]
+    key_positions = [csv_column_names.index(name) for name in DELTA_KEY_COLUMNS]
+
+    previous_rows = iter([])
+    if previous_csv_filename is not None and os.path.exists(previous_csv_filename):
+        if next(_read_published_csv(previous_csv_filename), None) == csv_column_names:
+            previous_rows = _published_rows_in_key_order(previous_csv_filename, key_positions)
+        else:
+            base_datestamp = None
+    else:
+        base_datestamp = None
+
+    def current_rows():
+        cursor = db.execute("select {} from {} order by {}".format(
+            ', '.join(_quote_identifier(name) for name in column_names), _quote_identifier(DELTA_TABLE),
+            ', '.join(_quote_identifier(name) for name in DELTA_KEY_COLUMNS)))
+        while True:
+            chunk = cursor.fetchmany(chunk_rows)
+            if not chunk:
+                return
+            for row in chunk:
+                yield [_csv_text(row[position]) for position in csv_positions], row
+
+    filenames = dict((change, os.path.join(staging_dir, filename)) for change, filename in DELTA_FILENAMES.items())
+    sinks = {
+        'added': CsvSink(filenames['added'], column_names, excluded_columns),
+        'changed': CsvSink(filenames['changed'], column_names, excluded_columns),
+        'removed': CsvSink(filenames['removed'], DELTA_KEY_COLUMNS),
+    }
+    counts = dict((change, 0) for change in sinks)
+    row_count = 0
+
+    def key(row):
+        return [row[position] for position in key_positions]
+
+    # sorted merge of the previous rows with the current ones
+    new_rows = current_rows()
+    old = next(previous_rows, None)
+    new = next(new_rows, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and key(old) < key(new[0])):
+            sinks['removed'].write([key(old)])
+            counts['removed'] += 1
+            old = next(previous_rows, None)
+            continue
+        row_count += 1
+        if old is None or key(new[0]) < key(old):
+            sinks['added'].write([new[1]])
+            counts['added'] += 1
+        else:
+            if old != new[0]:
+                sinks['changed'].write([new[1]])
+                counts['changed'] += 1
+            old = next(previous_rows, None)
+        new = next(new_rows, None)
+
+    for sink in sinks.values():
+        sink.close()
+
+    manifest_filename = os.path.join(staging_dir, DELTA_MANIFEST_FILENAME)
+    with open(manifest_filename, 'w') as f:
+        json.dump({
+            'format': DELTA_FORMAT,
+            'table': DELTA_TABLE,
+            'key': DELTA_KEY_COLUMNS,
+            'base': base_datestamp,
+            'datestamp': datestamp or datetime.date.today().isoformat(),
+            'rows': row_count,
+            'counts': counts,
+            'files': DELTA_FILENAMES,
+        }, f, indent=2, sort_keys=True)
+    return sorted(filenames.values()) + [manifest_filename]
+
+
+def _compress_member(job):
+    """
+    Raw deflate the given file into a temporary file next to it, returning what's needed to add it to a zip file.
+    zlib releases the GIL while compressing, so several members can be compressed at once on threads.
+    """
+    path, member_name = job
+    compressed_path = path + '.deflate'
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    crc = 0
+    size = 0
+    with open(path, 'rb') as source, open(compressed_path, 'wb') as target:
+        while True:
+            data = source.read(COPY_CHUNK_SIZE)
+            if not data:
+                break
+            crc = zlib.crc32(data, crc)
+            size += len(data)
+            target.write(compressor.compress(data))
+        target.write(compressor.flush())
+    return member_name, path, compressed_path, crc & 0xffffffff, size
+
+
+def _add_compressed_member(zip_file, member_name, source_path, compressed_path, crc, size):
+    """
+    Add an already deflated member to a zip file open for writing, copying the compressed data in chunks.
+    zipfile has no public way to add compressed data, so this relies on the internals of Python 2.7's ZipFile: the
+    member is written to fp and recorded in filelist and NameToInfo, and _didModify makes close() write the central
+    directory, at the position of fp. write_zip_files checks the zip files written this way can be read back.
+    """
+    zip_info = zipfile.ZipInfo(member_name, datetime.datetime.fromtimestamp(os.path.getmtime(source_path))
+                               .timetuple()[:6])
+    zip_info.compress_type = zipfile.ZIP_DEFLATED
+    zip_info.external_attr = 0o644 << 16
+    zip_info.CRC = crc
+    zip_info.file_size = size
+    zip_info.compress_size = os.path.getsize(compressed_path)
+    zip_info.header_offset = zip_file.fp.tell()
+
+    zip_file.fp.write(zip_info.FileHeader())
+    with open(compressed_path, 'rb') as compressed:
+        shutil.copyfileobj(compressed, zip_file.fp, COPY_CHUNK_SIZE)
+    os.remove(compressed_path)
+
+    zip_file.filelist.append(zip_info)
+    zip_file.NameToInfo[member_name] = zip_info
+    zip_file._didModify = True
+
+
+def write_zip_files(members_by_zip_filename, threads=DEFAULT_COMPRESSION_THREADS):
+    """
+    Write zip files given as {zip filename: [(file path, member name)]}, compressing all members in parallel.
+    Raises zipfile.BadZipfile if a zip file written doesn't read back as written.
+    """
+    jobs = [(zip_filename, member) for zip_filename, members in sorted(members_by_zip_filename.items())
+            for member in members]
+    pool = ThreadPool(max(1, min(threads, len(jobs))))
+    try:
+        compressed_members = pool.map(_compress_member, [member for _, member in jobs])
+    finally:
+        pool.close()
+        pool.join()
+
+    for zip_filename in sorted(members_by_zip_filename):
+        with zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            for (job_zip_filename, _), compressed_member in zip(jobs, compressed_members):
+                if job_zip_filename == zip_filename:
+                    _add_compressed_member(zip_file, *compressed_member)
+        # read every member back, checking its CRC, in case the zipfile internals relied on have changed
+        with zipfile.ZipFile(zip_filename) as zip_file:
+            bad_member = zip_file.testzip()
+        if bad_member is not None:
+            raise zipfile.BadZipfile('{} has a bad member: {}'.format(zip_filename, bad_member))
+
+
+def export_database(db_filename, output_dir, version=VERSION, columnar_formats=(), threads=DEFAULT_COMPRESSION_THREADS,
+                    chunk_rows=CHUNK_ROWS, delta=True):
+    """
+    Export the database into output_dir, see the module docstring for the layout.
+    The new files are prepared in a staging directory and only then moved into the version directory.
+    With delta, the changes to the value table since the previous export are written too, see write_value_delta;
+    without, those of an earlier export are removed.
+    """
+    if columnar_formats and pyarrow is None:
+        print "pyarrow is not installed, skipping", ', '.join(columnar_formats)
+        columnar_formats = ()
+
+    version_dir = os.path.join(output_dir, version)
+    if not os.path.isdir(version_dir):
+        os.makedirs(version_dir)
+    staging_dir = tempfile.mkdtemp(prefix='.export-', dir=output_dir)
+    datestamp = datetime.date.today().isoformat()
+
+    try:
+        db = sqlite3.connect(db_filename)
+        try:
+            db.execute("pragma wal_checkpoint(TRUNCATE)")  # so the database file alone holds all the data
+            written = export_tables(db, staging_dir, os.path.join(output_dir, 'all.sql'), columnar_formats,
+                                    chunk_rows)
+            if delta:
+                # the previous export is still in place in version_dir at this point
+                base_datestamp = None
+                datestamp_filename = os.path.join(version_dir, 'DATESTAMP')
+                if os.path.exists(datestamp_filename):
+                    with open(datestamp_filename) as f:
+                        base_datestamp = f.read().strip()
+                write_value_delta(db, os.path.join(version_dir, '{}.csv'.format(DELTA_TABLE)), staging_dir,
+                                  base_datestamp, datestamp, chunk_rows)
+        finally:
+            db.close()
+
+        csv_members = [(path, os.path.basename(path)) for path in written if path.endswith('.csv')]
+        write_zip_files({
+            os.path.join(staging_dir, 'csv.zip'): csv_members,
+            os.path.join(staging_dir, 'sql.zip'): [(db_filename, os.path.basename(db_filename))],
+        }, threads)
+
+        with open(os.path.join(staging_dir, 'DATESTAMP'), 'w') as f:
+            f.write(datestamp + '\n')
+
+        if not delta:
+            # the changes published with the previous export don't lead up to this one
+            for name in list(DELTA_FILENAMES.values()) + [DELTA_MANIFEST_FILENAME]:
+                if os.path.exists(os.path.join(version_dir, name)):
+                    os.remove(os.path.join(version_dir, name))
+
+        for name in os.listdir(staging_dir):
+            os.rename(os.path.join(staging_dir, name), os.path.join(version_dir, name))
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export the CHD database as CSV, SQL and zip files for download')
+    parser.add_argument('--db', default=os.path.expanduser('~/ocha.db'))
+    parser.add_argument('--output-dir', default=os.path.expanduser('~/http'))
+    parser.add_argument('--version', default=VERSION, help='subdirectory the files are published in')
+    parser.add_argument('--columnar', nargs='*', choices=COLUMNAR_FORMATS, default=[],
+                        help='also write the tables in these columnar formats (needs pyarrow)')
+    parser.add_argument('--threads', type=int, default=DEFAULT_COMPRESSION_THREADS,
+                        help='zip members compressed in parallel')
+    parser.add_argument('--no-delta', dest='delta', action='store_false',
+                        help="don't write the changes to the value table since the previous export")
+    args = parser.parse_args()
+
+    export_database(args.db, args.output_dir, args.version, args.columnar, args.threads, delta=args.delta)
+    print "all ok"
@@ -0,0 +1,246 @@
+"""
+Drill-down from appeals to their projects, clusters and contributions, through a local SQLite store.
+
+The FTS API only returns these one appeal at a time, so looking at sectors or clusters across appeals means thousands
+of calls and concatenating the dataframes they return. Instead, DrilldownStore.load_appeals fetches them for a set of
+appeals in concurrent batches (see fts_queries.fetch_many) and loads them into normalized tables:
+
+    appeal        id                          appeals loaded, and when
+    project       id, appeal_id, code         indexed by appeal and by project code
+    cluster       appeal_id, name             cluster names vary from appeal to appeal, so they are per appeal
+    contribution  id, appeal_id, project_code indexed by appeal, project code and donor
+
+Questions across appeals are then indexed queries joining those tables, e.g. get_funding_by_sector joins the
+contributions to their projects by project code. Appeals already in the store are not fetched again unless asked to.
+
+    store = DrilldownStore('drilldown.db')
+    store.load_appeals(fts_queries.fetch_appeals_json_for_year_as_dataframe(2015).index)
+    store.get_funding_by_sector()
+"""
+
+import argparse
+import sqlite3
+import time
+
+import pandas as pd
+
+import fts_queries
+import instrumentation
+
+DEFAULT_BATCH_SIZE = 20  # appeals fetched concurrently and written in one transaction
+LOCK_TIMEOUT = 60
+
+# columns kept of each entity, as named by FTS, with their SQLite types
+PROJECT_COLUMNS = [
+    ('code', 'text'), ('title', 'text'), ('cluster', 'text'), ('sector', 'text'), ('organisation', 'text'),
+    ('organisation_abbreviation', 'text'), ('country', 'text'), ('priority', 'text'), ('gendermarker', 'text'),
+    ('original_requirements', 'real'), ('current_requirements', 'real'), ('end_date', 'text'),
+    ('last_updated_datetime', 'text'),
+]
+CLUSTER_COLUMNS = [
+    ('original_requirement', 'real'), ('current_requirement', 'real'), ('funding', 'real'), ('pledges', 'real'),
+]
+CONTRIBUTION_COLUMNS = [
+    ('emergency_id', 'integer'), ('project_code', 'text'), ('donor', 'text'), ('recipient', 'text'),
+    ('status', 'text'), ('is_allocation', 'integer'), ('amount', 'real'), ('year', 'integer'),
+    ('decision_date', 'text'),
+]
+
+SCHEMA = [
+    "create table if not exists appeal (id integer primary key, loaded_at real not null)",
+    "create table if not exists project (id integer primary key, appeal_id integer not null, {})".format(
+        ', '.join('{} {}'.format(name, sql_type) for name, sql_type in PROJECT_COLUMNS)),
+    "create index if not exists project_by_appeal on project (appeal_id)",
+    "create index if not exists project_by_code on project (code)",
+    "create table if not exists cluster (appeal_id integer not null, name text not null, {},"
+    " primary key (appeal_id, name)) without rowid".format(
+        ', '.join('{} {}'.format(name, sql_type) for name, sql_type in CLUSTER_COLUMNS)),
+    "create table if not exists contribution (id integer primary key, appeal_id integer not null, {})".format(
+        ', '.join('{} {}'.format(name, sql_type) for name, sql_type in CONTRIBUTION_COLUMNS)),
+    "create index if not exists contribution_by_appeal on contribution (appeal_id)",
+    "create index if not exists contribution_by_project on contribution (project_code)",
+    "create index if not exists contribution_by_donor on contribution (donor)",
+]
+
+
+def _sql_value(value):
+    """
+    A dataframe value as SQLite can store it: missing values as null, dates as ISO strings, numpy scalars as Python
+    """
+    if value is None:
+        return None
+    if isinstance(value, pd.Timestamp):
+        return None if pd.isnull(value) else value.isoformat()
+    if pd.isnull(value):
+        return None
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
+
+
+def _rows(dataframe, column_names):
+    """
+    Rows of the key (the index) and the given columns of a fetched dataframe, null for the columns it doesn't have
+    """
+    if dataframe.empty:
+        return []
+    columns = [dataframe.index] + [dataframe[name] if name in dataframe.columns else [None] * len(dataframe)
+                                   for name in column_names]
+    return [tuple(_sql_value(value) for value in row) for row in zip(*columns)]
+
+
+def _placeholders(count):
+    return ', '.join('?' * count)
+
+
+class DrilldownStore(object):
+    """
+    Projects, clusters and contributions of appeals, in a local SQLite file
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        db = self._connect()
+        try:
+            with db:
+                for statement in SCHEMA:
+                    db.execute(statement)
+        finally:
+            db.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.filename, timeout=LOCK_TIMEOUT)
+
+    def query(self, sql, parameters=()):
+        """
+        Run a query against the store, returning a dataframe
+        """
+        db = self._connect()
+        try:
+            return pd.read_sql_query(sql, db, params=parameters)
+        finally:
+            db.close()
+
+    def get_loaded_appeals(self):
+        db = self._connect()
+        try:
+            return set(appeal_id for (appeal_id,) in db.execute("select id from appeal"))
+        finally:
+            db.close()
+
+    def load_appeals(self, appeal_ids, batch_size=DEFAULT_BATCH_SIZE, reload=False, max_workers=None):
+        """
+        Fetch the projects, clusters and contributions of the given appeals into the store, batch_size appeals at a
+        time: the calls of a batch run concurrently, and its rows are written in one transaction, replacing any rows
+        the appeals had. Appeals already in the store are skipped, unless reload. Returns the number of appeals
+        fetched.
+        """
+        appeal_ids = [int(appeal_id) for appeal_id in appeal_ids]
+        if not reload:
+            loaded_appeals = self.get_loaded_appeals()
+            appeal_ids = [appeal_id for appeal_id in appeal_ids if appeal_id not in loaded_appeals]
+
+        for start in range(0, len(appeal_ids), batch_size):
+            batch = appeal_ids[start:start + batch_size]
+            with instrumentation.stage('fetch_appeal_drilldown'):
+                calls = []
+                for appeal_id in batch:
+                    calls += [
+                        (fts_queries.fetch_projects_json_for_appeal_as_dataframe, appeal_id,
+                         [name for name, _ in PROJECT_COLUMNS]),
+                        (fts_queries.fetch_clusters_json_for_appeal_as_dataframe, appeal_id,
+                         [name for name, _ in CLUSTER_COLUMNS]),
+                        (fts_queries.fetch_contributions_json_for_appeal_as_dataframe, appeal_id,
+                         [name for name, _ in CONTRIBUTION_COLUMNS]),
+                    ]
+                dataframes = fts_queries.fetch_many(calls, max_workers)
+            with instrumentation.stage('write_appeal_drilldown'):
+                self._write_batch(batch, [dataframes[position:position + 3]
+                                          for position in range(0, len(dataframes), 3)])
+        return len(appeal_ids)
+
+    def _write_batch(self, appeal_ids, dataframes_by_appeal):
+        project_names = [name for name, _ in PROJECT_COLUMNS]
+        cluster_names = [name for name, _ in CLUSTER_COLUMNS]
+        contribution_names = [name for name, _ in CONTRIBUTION_COLUMNS]
+        db = self._connect()
+        try:
+            with db:
+                for table_name in ['project', 'cluster', 'contribution']:
+                    db.executemany("delete from {} where appeal_id = ?".format(table_name),
+                                   [(appeal_id,) for appeal_id in appeal_ids])
+                for appeal_id, (projects, clusters, contributions) in zip(appeal_ids, dataframes_by_appeal):
+                    db.executemany("insert or replace into project (id, appeal_id, {}) values (?, ?, {})".format(
+                        ', '.join(project_names), _placeholders(len(project_names))),
+                        [(row[0], appeal_id) + row[1:] for row in _rows(projects, project_names)])
+                    db.executemany("insert or replace into cluster (appeal_id, name, {}) values (?, ?, {})".format(
+                        ', '.join(cluster_names), _placeholders(len(cluster_names))),
+                        [(appeal_id,) + row for row in _rows(clusters, cluster_names)])
+                    db.executemany(
+                        "insert or replace into contribution (id, appeal_id, {}) values (?, ?, {})".format(
+                            ', '.join(contribution_names), _placeholders(len(contribution_names))),
+                        [(row[0], appeal_id) + row[1:] for row in _rows(contributions, contribution_names)])
+                db.executemany("insert or replace into appeal (id, loaded_at) values (?, ?)",
+                               [(appeal_id, time.time()) for appeal_id in appeal_ids])
+        finally:
+            db.close()
+
+    def _appeal_filter(self, table_name, appeal_ids):
+        """
+        A where clause and its parameters restricting table_name to the given appeals (None meaning all)
+        """
+        if appeal_ids is None:
+            return '', ()
+        appeal_ids = tuple(int(appeal_id) for appeal_id in appeal_ids)
+        return ' where {}.appeal_id in ({})'.format(table_name, _placeholders(len(appeal_ids))), appeal_ids
+
+    def get_projects(self, appeal_ids=None):
+        where, parameters = self._appeal_filter('project', appeal_ids)
+        return self.query("select * from project{} order by appeal_id, id".format(where), parameters).set_index('id')
+
+    def get_clusters(self, appeal_ids=None):
+        where, parameters = self._appeal_filter('cluster', appeal_ids)
+        return self.query("select * from cluster{} order by appeal_id, name".format(where), parameters)
+
+    def get_contributions(self, appeal_ids=None):
+        where, parameters = self._appeal_filter('contribution', appeal_ids)
+        return self.query("select * from contribution{} order by appeal_id, id".format(where),
+                          parameters).set_index('id')
+
+    def get_contributions_for_project(self, project_code):
+        return self.query("select * from contribution where project_code = ? order by id",
+                          (project_code,)).set_index('id')
+
+    def get_funding_by_sector(self, appeal_ids=None, include_pledges=False):
+        """
+        Dataframe of the contributions to the projects of the appeals, summed by appeal and project sector
+        """
+        where, parameters = self._appeal_filter('contribution', appeal_ids)
+        if not include_pledges:
+            where += (' and' if where else ' where') + " contribution.status != 'Pledge'"
+        return self.query(
+            "select contribution.appeal_id, project.sector, sum(contribution.amount) as funding"
+            " from contribution join project"
+            " on project.code = contribution.project_code and project.appeal_id = contribution.appeal_id"
+            "{} group by contribution.appeal_id, project.sector order by contribution.appeal_id, project.sector"
+            .format(where), parameters)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load the projects, clusters and contributions of appeals into a '
+                                                 'local SQLite store for drill-down queries')
+    parser.add_argument('--db', default='fts_drilldown.db')
+    parser.add_argument('--year', type=int, action='append', default=[], help='load the appeals of this year')
+    parser.add_argument('--country', action='append', default=[], help='load the appeals of this country')
+    parser.add_argument('--appeal', type=int, action='append', default=[], help='load this appeal')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--reload', action='store_true', help='fetch appeals already in the store again')
+    args = parser.parse_args()
+
+    appeal_ids = list(args.appeal)
+    for year in args.year:
+        appeal_ids += list(fts_queries.fetch_appeals_json_for_year_as_dataframe(year, ['year']).index)
+    for country in args.country:
+        appeal_ids += list(fts_queries.fetch_appeals_json_for_country_as_dataframe(country, ['year']).index)
+
+    fetched = DrilldownStore(args.db).load_appeals(sorted(set(appeal_ids)), args.batch_size, args.reload)
+    print "Fetched", fetched, "of", len(set(appeal_ids)), "appeals"
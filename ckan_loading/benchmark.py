@@ -0,0 +1,246 @@
+"""
+Benchmark suite for the indicator pipeline.
+
+For each requested size a synthetic FTS dataset is generated (see fts_synthetic) and served locally by fts_replay, and
+the stages of generate_chd_indicators are timed against it: each populate function over all regions, building the
+values dataframe, the CSV and SQL writers and the archive step. Results are appended to a JSON lines file along with
+the git revision, and each run is compared with the previous result for the same size, so regressions show up as soon
+as the pipeline changes.
+
+    python benchmark.py --sizes small medium --results ~/fts_benchmarks.jsonl
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import fts_queries
+import fts_replay
+import fts_synthetic
+import generate_chd_indicators as indicators
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'archives'))
+import exporter
+
+SIZES = {
+    'small': fts_synthetic.SyntheticParameters(countries=10, years=3, appeals_per_country=4,
+                                               contributions_per_emergency=10, organizations=200),
+    'medium': fts_synthetic.SyntheticParameters(countries=50, years=8, appeals_per_country=10,
+                                                contributions_per_emergency=25, organizations=2000),
+    'large': fts_synthetic.SyntheticParameters(countries=200, years=15, appeals_per_country=20,
+                                               contributions_per_emergency=50, organizations=10000),
+}
+SIZE_ORDER = ['small', 'medium', 'large']
+
+DEFAULT_RESULTS_FILENAME = 'benchmark_results.jsonl'
+# a timing counts as a regression when it is this much slower than the previous result (and not just noise)
+REGRESSION_THRESHOLD = 0.2
+MINIMUM_REGRESSION_SECONDS = 0.05
+
+
+class Timer(object):
+    """
+    Collects named timings
+    """
+    def __init__(self):
+        self.seconds_by_name = {}
+
+    def time(self, name, function, *args):
+        started = time.time()
+        result = function(*args)
+        self.seconds_by_name[name] = time.time() - started
+        return result
+
+
+def _reset_pipeline():
+    """
+    Drop everything the pipeline keeps between calls, so each measurement starts from scratch
+    """
+    indicators.reset_reference_caches()
+    indicators.VALUES.clear()
+    fts_queries.clear_memo()
+
+
+def _populate_for_all(function, regions, *args):
+    for region in regions:
+        function(region, *args)
+
+
+def _prepare_shared_data(regions):
+    """
+    The per-run work of populate_data_for_regions that all regions share
+    """
+    organizations = indicators.load_reference_data()
+    indicators.POOLED_FUND_CONTRIBUTIONS.load_countries(regions)
+    return organizations
+
+
+def run_archive_step(output_dir):
+    """
+    The archive step of main.sh, exporting the database the pipeline just wrote
+    """
+    exporter.export_database(os.path.join(output_dir, indicators.SQL_FILENAME), output_dir)
+
+
+def benchmark_pipeline(output_dir):
+    """
+    Time the pipeline stages once against whatever fts_queries.FTS_BASE_URL points at, returns the timings
+    """
+    _reset_pipeline()
+    timer = Timer()
+
+    regions = list(timer.time('fetch_countries', fts_queries.fetch_countries_json_as_dataframe,
+                              indicators.COUNTRY_COLUMNS).iso_code_A)
+    organizations = timer.time('prepare_shared_data', _prepare_shared_data, regions)
+
+    timer.time('populate_appeals_level_data', _populate_for_all, indicators.populate_appeals_level_data, regions)
+    timer.time('populate_organization_level_data', _populate_for_all, indicators.populate_organization_level_data,
+               regions, organizations)
+    timer.time('populate_pooled_fund_data', _populate_for_all, indicators.populate_pooled_fund_data, regions)
+
+    timer.time('get_values_as_dataframe', indicators.get_values_as_dataframe)
+    timer.time('write_values_as_scraperwiki_style_csv', indicators.write_values_as_scraperwiki_style_csv, output_dir)
+    timer.time('write_values_as_scraperwiki_style_sql', indicators.write_values_as_scraperwiki_style_sql, output_dir)
+    timer.time('archive', run_archive_step, output_dir)
+
+    timings = timer.seconds_by_name
+    timings['total'] = sum(timings.values())
+    return timings, len(indicators.VALUES)
+
+
+def benchmark_size(size, parameters, work_dir, repeat=1, latency=0.):
+    """
+    Generate a synthetic dataset of the given size, serve it and time the pipeline against it.
+    With repeat > 1, the best time of each stage is kept.
+    """
+    archive_path = os.path.join(work_dir, 'synthetic_{}.zip'.format(size))
+    started = time.time()
+    response_count = fts_synthetic.write_synthetic_archive(archive_path, parameters)
+    generate_seconds = time.time() - started
+
+    server = fts_replay.start_replay_server(archive_path, latency=latency)
+    original_base_url = fts_queries.FTS_BASE_URL
+    fts_queries.FTS_BASE_URL = server.base_url
+    try:
+        best_timings = None
+        for _ in range(repeat):
+            output_dir = tempfile.mkdtemp(dir=work_dir)
+            timings, value_count = benchmark_pipeline(output_dir)
+            shutil.rmtree(output_dir, ignore_errors=True)
+            if best_timings is None:
+                best_timings = timings
+            else:
+                best_timings = dict((name, min(seconds, best_timings[name])) for name, seconds in timings.items())
+    finally:
+        fts_queries.FTS_BASE_URL = original_base_url
+        server.shutdown()
+        server.server_close()
+
+    return {
+        'timestamp': datetime.datetime.now().isoformat(),
+        'revision': _git_revision(),
+        'python': platform.python_version(),
+        'size': size,
+        'parameters': parameters.as_dict(),
+        'latency': latency,
+        'repeat': repeat,
+        'responses': response_count,
+        'values': value_count,
+        'generate_seconds': generate_seconds,
+        'timings': best_timings,
+    }
+
+
+def _git_revision():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=devnull,
+                                           cwd=os.path.dirname(os.path.realpath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_results(filename):
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def append_result(filename, result):
+    with open(filename, 'a') as f:
+        f.write(json.dumps(result, sort_keys=True) + '\n')
+
+
+def find_previous_result(results, result):
+    """
+    The most recent earlier result measured under the same conditions, or None
+    """
+    for previous in reversed(results):
+        if previous['size'] == result['size'] and previous['parameters'] == result['parameters'] and\
+                previous['latency'] == result['latency']:
+            return previous
+    return None
+
+
+def find_regressions(previous, result, threshold=REGRESSION_THRESHOLD):
+    """
+    Returns (stage, previous seconds, seconds) for each stage that got slower by more than the threshold
+    """
+    regressions = []
+    for name, seconds in sorted(result['timings'].items()):
+        previous_seconds = previous['timings'].get(name)
+        if previous_seconds is None:
+            continue
+        if seconds > previous_seconds * (1 + threshold) and seconds - previous_seconds > MINIMUM_REGRESSION_SECONDS:
+            regressions.append((name, previous_seconds, seconds))
+    return regressions
+
+
+def print_result(result, previous):
+    print "{} ({} responses, {} values, revision {}):".format(
+        result['size'], result['responses'], result['values'], result['revision'])
+    for name, seconds in sorted(result['timings'].items(), key=lambda item: item[1], reverse=True):
+        line = "  {:<40} {:>9.3f}s".format(name, seconds)
+        if previous is not None and previous['timings'].get(name):
+            line += "  ({:+.0%} vs {})".format(seconds / previous['timings'][name] - 1, previous['revision'])
+        print line
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the indicator pipeline on synthetic FTS data')
+    parser.add_argument('--sizes', nargs='+', choices=SIZE_ORDER, default=['small', 'medium'])
+    parser.add_argument('--repeat', type=int, default=1, help='run each size this many times, keeping the best')
+    parser.add_argument('--latency', type=float, default=0., help='seconds of latency added to each response')
+    parser.add_argument('--results', default=DEFAULT_RESULTS_FILENAME, help='JSON lines file results are added to')
+    parser.add_argument('--fail-on-regression', action='store_true',
+                        help='exit with an error if any stage is more than {:.0%} slower than the previous result'
+                        .format(REGRESSION_THRESHOLD))
+    args = parser.parse_args()
+
+    previous_results = load_results(args.results)
+    benchmark_work_dir = tempfile.mkdtemp(prefix='fts_benchmark_')
+    regressed = False
+    try:
+        for benchmark_size_name in args.sizes:
+            size_result = benchmark_size(benchmark_size_name, SIZES[benchmark_size_name], benchmark_work_dir,
+                                         args.repeat, args.latency)
+            previous_result = find_previous_result(previous_results, size_result)
+            append_result(args.results, size_result)
+            print_result(size_result, previous_result)
+
+            if previous_result is not None:
+                for stage_name, previous_seconds, stage_seconds in find_regressions(previous_result, size_result):
+                    regressed = True
+                    print "REGRESSION in {}: {:.3f}s -> {:.3f}s".format(stage_name, previous_seconds, stage_seconds)
+    finally:
+        shutil.rmtree(benchmark_work_dir, ignore_errors=True)
+
+    sys.exit(1 if regressed and args.fail_on_regression else 0)
@@ -0,0 +1,102 @@
+"""
+Per-region checkpoints, so that a failed run can be resumed rather than restarted.
+
+As each region finishes, its indicator rows are stored in a small SQLite file along with the region's status. A
+region that fails (after the per-request retries, see fts_http.call_with_retries) is marked as failed and the run
+carries on with the other regions. A later run with --resume skips the regions already done, re-running only the
+failed and pending ones, and takes the rows of the others from the checkpoint.
+
+A connection is opened for each operation, so one checkpoint file can be shared by forked worker processes.
+"""
+
+import sqlite3
+import time
+
+DONE = 'done'
+FAILED = 'failed'
+LOCK_TIMEOUT = 60  # seconds to wait for other processes writing to the same checkpoint
+
+
+class CheckpointStore(object):
+    """
+    Region statuses and rows of the current run
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        db = self._connect()
+        try:
+            with db:
+                db.execute("create table if not exists region_status ("
+                           " region text primary key, status text not null, error text, updated_at real not null)")
+                db.execute("create table if not exists region_value ("
+                           " region text not null, position integer not null, indicator text not null,"
+                           " year integer not null, value real, primary key (region, position))")
+        finally:
+            db.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.filename, timeout=LOCK_TIMEOUT)
+
+    def _query(self, sql, parameters=()):
+        db = self._connect()
+        try:
+            return db.execute(sql, parameters).fetchall()
+        finally:
+            db.close()
+
+    def reset(self):
+        """
+        Forget everything, for a fresh run
+        """
+        db = self._connect()
+        try:
+            with db:
+                db.execute("delete from region_status")
+                db.execute("delete from region_value")
+        finally:
+            db.close()
+
+    def get_done_regions(self):
+        return set(region for (region,) in self._query("select region from region_status where status = ?", (DONE,)))
+
+    def get_failed_regions(self):
+        """
+        Returns a dict of region -> error for the regions that failed
+        """
+        return dict(self._query("select region, error from region_status where status = ?", (FAILED,)))
+
+    def save_region(self, region, rows):
+        """
+        Store the (indicator, year, value) rows of a finished region and mark it as done
+        """
+        db = self._connect()
+        try:
+            with db:
+                db.execute("delete from region_value where region = ?", (region,))
+                db.executemany("insert into region_value (region, position, indicator, year, value)"
+                               " values (?, ?, ?, ?, ?)",
+                               [(region, position, indicator, year, value)
+                                for position, (indicator, year, value) in enumerate(rows)])
+                db.execute("insert or replace into region_status (region, status, error, updated_at)"
+                           " values (?, ?, null, ?)", (region, DONE, time.time()))
+        finally:
+            db.close()
+
+    def mark_failed(self, region, error):
+        db = self._connect()
+        try:
+            with db:
+                db.execute("delete from region_value where region = ?", (region,))
+                db.execute("insert or replace into region_status (region, status, error, updated_at)"
+                           " values (?, ?, ?, ?)", (region, FAILED, error, time.time()))
+        finally:
+            db.close()
+
+    def load_rows(self, region):
+        """
+        The (indicator, year, value) rows stored for the region, in the order they were produced
+        """
+        # SQLite stores NaN as null
+        return [(indicator, year, float('nan') if value is None else value) for indicator, year, value
+                in self._query("select indicator, year, value from region_value where region = ? order by position",
+                               (region,))]
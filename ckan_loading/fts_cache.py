@@ -0,0 +1,256 @@
+"""
+Persistent on-disk cache of raw FTS API responses.
+
+Responses are stored zlib-compressed, one file per URL, with a small SQLite index alongside them holding the
+validators (ETag / Last-Modified) and timestamps. Each URL gets a time-to-live based on its endpoint; once it has
+expired the cached copy is revalidated with a conditional request, so an unchanged endpoint costs a 304 rather than a
+full download. Data for years long closed is treated as never expiring. The cache is kept under a size budget by
+evicting the least recently used responses.
+"""
+
+import hashlib
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+
+import fts_http
+import instrumentation
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+# first matching pattern (searched in the URL) wins
+DEFAULT_TTL_RULES = [
+    (r'/(Organization|Country|Sector)\.json', 7 * DAY),  # reference lists, these rarely change
+    (r'\.json', 6 * HOUR),
+]
+NEVER_EXPIRES = None
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+# years older than this many years before the current one are considered closed, so their data never expires
+HISTORICAL_YEAR_LAG = 2
+
+_YEAR_PATTERN = re.compile(r'(?:/year/|[?&]Year=)(\d{4})', re.IGNORECASE)
+
+CHUNK_SIZE = 64 * 1024
+LOCK_TIMEOUT = 60  # seconds to wait for other processes writing to the same index
+
+
+class _CompressedFileReader(object):
+    """
+    File-like access to the decompressed contents of a cached response, read incrementally from disk
+    """
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.decompressor = zlib.decompressobj()
+        self.pending = ''
+
+    def read(self, size=None):
+        if size is None:
+            data = self.pending + self.decompressor.decompress(self.file.read()) + self.decompressor.flush()
+            self.pending = ''
+            return data
+
+        while len(self.pending) < size:
+            compressed = self.file.read(CHUNK_SIZE)
+            if not compressed:
+                self.pending += self.decompressor.flush()
+                break
+            self.pending += self.decompressor.decompress(compressed)
+
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+class ResponseCache(object):
+    """
+    Caches response bodies by URL in the given directory
+    """
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES, ttl_rules=None, historical_year_lag=HISTORICAL_YEAR_LAG):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl_rules = [(re.compile(pattern), ttl) for pattern, ttl in (ttl_rules or DEFAULT_TTL_RULES)]
+        self.historical_year_lag = historical_year_lag
+        self._connect()
+        self.index.execute(
+            "create table if not exists response ("
+            " url text primary key, etag text, last_modified text,"
+            " fetched_at real not null, last_used real not null, size integer not null)")
+        self.index.commit()
+
+    def _connect(self):
+        self.lock = threading.Lock()
+        self.index = sqlite3.connect(os.path.join(self.directory, 'index.db'), timeout=LOCK_TIMEOUT,
+                                     check_same_thread=False)
+
+    def reset_after_fork(self):
+        """
+        Call in a freshly forked worker process, a SQLite connection must not be carried across a fork
+        """
+        self._connect()
+
+    def ttl_for_url(self, url):
+        """
+        Seconds a response for this url stays fresh, or NEVER_EXPIRES
+        """
+        match = _YEAR_PATTERN.search(url)
+        if match and self.historical_year_lag is not None:
+            if int(match.group(1)) < time.localtime().tm_year - self.historical_year_lag:
+                return NEVER_EXPIRES
+
+        for pattern, ttl in self.ttl_rules:
+            if pattern.search(url):
+                return ttl
+        return 0
+
+    def _path_for_url(self, url):
+        return os.path.join(self.directory, hashlib.sha1(url).hexdigest() + '.z')
+
+    def _lookup(self, url):
+        with self.lock:
+            return self.index.execute(
+                "select etag, last_modified, fetched_at from response where url = ?", (url,)).fetchone()
+
+    def _open_body(self, url):
+        return _CompressedFileReader(self._path_for_url(url))
+
+    def _touch(self, url, refreshed):
+        now = time.time()
+        with self.lock:
+            if refreshed:
+                self.index.execute("update response set fetched_at = ?, last_used = ? where url = ?", (now, now, url))
+            else:
+                self.index.execute("update response set last_used = ? where url = ?", (now, url))
+            self.index.commit()
+
+    def _store(self, url, response):
+        """
+        Compress the body of the given fts_http.StreamingResponse to disk as it is read
+        """
+        path = self._path_for_url(url)
+        # unique across the threads and processes sharing the cache
+        fd, temporary_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=self.directory)
+        try:
+            compressor = zlib.compressobj()
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = response.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(compressor.compress(chunk))
+                f.write(compressor.flush())
+            compressed_size = os.path.getsize(temporary_path)
+            os.rename(temporary_path, path)  # atomic, so readers never see a partial file
+        except:
+            os.remove(temporary_path)
+            raise
+
+        now = time.time()
+        with self.lock:
+            self.index.execute(
+                "insert or replace into response (url, etag, last_modified, fetched_at, last_used, size)"
+                " values (?, ?, ?, ?, ?, ?)",
+                (url, response.headers.get('etag'), response.headers.get('last-modified'), now, now, compressed_size))
+            self.index.commit()
+        self._evict(keep_url=url)
+
+    def _evict(self, keep_url=None):
+        """
+        Drop least recently used responses (other than keep_url) until the cache fits its size budget
+        """
+        with self.lock:
+            total_size = self.index.execute("select coalesce(sum(size), 0) from response").fetchone()[0]
+            if total_size <= self.max_bytes:
+                return
+
+            evicted_urls = []
+            for url, size in self.index.execute("select url, size from response order by last_used"):
+                if total_size <= self.max_bytes:
+                    break
+                if url == keep_url:
+                    continue
+                evicted_urls.append(url)
+                total_size -= size
+
+            for url in evicted_urls:
+                self.index.execute("delete from response where url = ?", (url,))
+                try:
+                    os.remove(self._path_for_url(url))
+                except OSError:
+                    pass  # already gone
+            self.index.commit()
+
+    def open(self, url):
+        """
+        Returns a file-like object to read the body for the given url from, from the cache if fresh,
+        otherwise after downloading it from FTS into the cache. Call close() on it when done.
+        """
+        entry = self._lookup(url)
+        if entry is not None:
+            etag, last_modified, fetched_at = entry
+            ttl = self.ttl_for_url(url)
+            if ttl is NEVER_EXPIRES or time.time() - fetched_at < ttl:
+                try:
+                    body = self._open_body(url)
+                    self._touch(url, refreshed=False)
+                    instrumentation.note_cache_status('hit')
+                    return body
+                except IOError:
+                    entry = None  # file went missing, fall through to a full fetch
+
+        headers = {}
+        if entry is not None:
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        response = fts_http.open_stream(url, headers)
+        try:
+            if response.status == 304:
+                response.read()
+                try:
+                    body = self._open_body(url)
+                    self._touch(url, refreshed=True)
+                    instrumentation.note_cache_status('revalidated')
+                    return body
+                except IOError:
+                    response.close()
+                    response = fts_http.open_stream(url)
+
+            self._store(url, response)
+            instrumentation.note_cache_status('miss')
+        finally:
+            response.close()
+
+        return self._open_body(url)
+
+    def fetch(self, url):
+        """
+        Returns the whole body for the given url, see open
+        """
+        body = self.open(url)
+        try:
+            return body.read()
+        finally:
+            body.close()
+
+    def clear(self):
+        with self.lock:
+            for (url,) in self.index.execute("select url from response").fetchall():
+                try:
+                    os.remove(self._path_for_url(url))
+                except OSError:
+                    pass
+            self.index.execute("delete from response")
+            self.index.commit()
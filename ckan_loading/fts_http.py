@@ -0,0 +1,306 @@
+"""
+Low level HTTP access for the FTS API.
+
+Keeps a pool of keep-alive connections per host so that the thousands of small requests made during a full run don't
+each pay for a new TCP connection, and provides a bounded worker pool so that several requests can be in flight at
+once. A simple per-host rate limit keeps us polite towards the FTS servers, and transient failures (dropped
+connections, timeouts, 5xx answers) are retried with exponential backoff and jitter, see call_with_retries.
+"""
+
+import httplib
+import random
+import sys
+import threading
+import time
+import urlparse
+from Queue import Queue
+
+import instrumentation
+
+DEFAULT_MAX_WORKERS = 8  # upper bound on concurrent requests
+DEFAULT_REQUESTS_PER_SECOND = 10.  # per host, None or 0 disables the limit
+CONNECTION_TIMEOUT = 60  # seconds
+DEFAULT_MAX_RETRIES = 4  # per request, on top of the first attempt
+BACKOFF_BASE_SECONDS = 1.  # the n-th retry waits a random time of up to BACKOFF_BASE_SECONDS * 2 ** n
+BACKOFF_MAX_SECONDS = 60.
+TRANSIENT_STATUSES = (429, 500, 502, 503, 504)
+# what a failed request raises: socket errors, timeouts and HTTPError are IOErrors, incomplete reads and bad status
+# lines are HTTPExceptions
+REQUEST_ERRORS = (httplib.HTTPException, IOError)
+
+
+class HTTPError(IOError):
+    """
+    Raised when FTS answers with an unexpected HTTP status
+    """
+    def __init__(self, url, status, reason):
+        IOError.__init__(self, '{} {} for {}'.format(status, reason, url))
+        self.url = url
+        self.status = status
+
+    @property
+    def transient(self):
+        return self.status in TRANSIENT_STATUSES
+
+
+class Response(object):
+    """
+    A simple "struct" for a fully read HTTP response.
+    """
+    def __init__(self, url, status, headers, body):
+        self.url = url
+        self.status = status
+        self.headers = headers  # dict with lower case header names
+        self.body = body
+
+
+class RateLimiter(object):
+    """
+    Spaces out requests to each host so that no more than requests_per_second are started
+    """
+    def __init__(self, requests_per_second):
+        self.min_interval = 1. / requests_per_second if requests_per_second else 0.
+        self.next_slot_by_host = {}
+        self.lock = threading.Lock()
+
+    def wait(self, host):
+        if not self.min_interval:
+            return
+
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot_by_host.get(host, now))
+            self.next_slot_by_host[host] = slot + self.min_interval
+
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class ConnectionPool(object):
+    """
+    Holds idle keep-alive connections, keyed by (scheme, host)
+    """
+    def __init__(self):
+        self.idle_connections = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, scheme, host):
+        with self.lock:
+            connections = self.idle_connections.get((scheme, host))
+            if connections:
+                return connections.pop()
+
+        connection_class = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        return connection_class(host, timeout=CONNECTION_TIMEOUT)
+
+    def release(self, scheme, host, connection):
+        with self.lock:
+            self.idle_connections.setdefault((scheme, host), []).append(connection)
+
+    def close_all(self):
+        with self.lock:
+            for connections in self.idle_connections.values():
+                for connection in connections:
+                    connection.close()
+            self.idle_connections = {}
+
+
+_POOL = ConnectionPool()
+_REQUESTS_PER_SECOND = DEFAULT_REQUESTS_PER_SECOND
+_RATE_LIMITER = RateLimiter(_REQUESTS_PER_SECOND)
+_MAX_WORKERS = DEFAULT_MAX_WORKERS
+_MAX_RETRIES = DEFAULT_MAX_RETRIES
+
+
+def configure(max_workers=None, requests_per_second=None, max_retries=None):
+    """
+    Change the concurrency cap, the per-host rate limit (use 0 to disable rate limiting)
+    and/or the number of retries of transient failures
+    """
+    global _MAX_WORKERS, _REQUESTS_PER_SECOND, _RATE_LIMITER, _MAX_RETRIES
+    if max_workers is not None:
+        _MAX_WORKERS = max(1, int(max_workers))
+    if max_retries is not None:
+        _MAX_RETRIES = max(0, int(max_retries))
+    if requests_per_second is not None:
+        _REQUESTS_PER_SECOND = requests_per_second
+        _RATE_LIMITER = RateLimiter(requests_per_second)
+
+
+def reset_after_fork(process_count=1):
+    """
+    Call in a freshly forked worker process: connections inherited from the parent must not be shared, and
+    the per-host rate limit is split between the given number of processes so that together they stay within it
+    """
+    global _POOL, _RATE_LIMITER
+    _POOL = ConnectionPool()  # the parent keeps using its own connections, so leave them open
+    _RATE_LIMITER = RateLimiter(_REQUESTS_PER_SECOND / float(process_count) if _REQUESTS_PER_SECOND else 0)
+
+
+class StreamingResponse(object):
+    """
+    A response whose body is read incrementally. Call close() when done: the connection goes back to the pool
+    if the body was read completely, otherwise it is closed.
+    """
+    def __init__(self, url, scheme, host, connection, http_response):
+        self.url = url
+        self.scheme = scheme
+        self.host = host
+        self.connection = connection
+        self.http_response = http_response
+        self.status = http_response.status
+        self.reason = http_response.reason
+        self.headers = dict((name.lower(), value) for name, value in http_response.getheaders())
+
+    def read(self, size=None):
+        if self.connection is None:
+            return ''
+        try:
+            return self.http_response.read() if size is None else self.http_response.read(size)
+        except Exception:
+            self.connection.close()
+            self.connection = None
+            raise
+
+    def close(self):
+        if self.connection is None:
+            return
+        if self.http_response.isclosed() and not self.http_response.will_close:
+            _POOL.release(self.scheme, self.host, self.connection)
+        else:
+            self.connection.close()
+        self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _open_once(url, scheme, host, path, headers):
+    connection = _POOL.acquire(scheme, host)
+    try:
+        connection.request('GET', path, headers=headers)
+        http_response = connection.getresponse()
+    except Exception:
+        connection.close()
+        raise
+    return StreamingResponse(url, scheme, host, connection, http_response)
+
+
+def open_stream(url, headers=None):
+    """
+    GET the given url over a pooled connection, returning a StreamingResponse to read the body from.
+    Any status other than 200 (or 304, which only happens for conditional requests) raises HTTPError.
+    """
+    parts = urlparse.urlsplit(url)
+    path = parts.path + ('?' + parts.query if parts.query else '')
+    request_headers = {'Connection': 'keep-alive'}
+    request_headers.update(headers or {})
+
+    _RATE_LIMITER.wait(parts.netloc)
+
+    try:
+        response = _open_once(url, parts.scheme, parts.netloc, path, request_headers)
+    except (httplib.HTTPException, IOError):
+        # an idle keep-alive connection may have been dropped by the server, try once more on a fresh one
+        instrumentation.note_retry()
+        response = _open_once(url, parts.scheme, parts.netloc, path, request_headers)
+
+    if response.status not in (200, 304):
+        response.close()
+        raise HTTPError(url, response.status, response.reason)
+
+    return response
+
+
+def is_transient(error):
+    """
+    Whether a request that failed with the given error is worth retrying
+    """
+    if isinstance(error, HTTPError):
+        return error.transient
+    return isinstance(error, REQUEST_ERRORS)
+
+
+def backoff_delay(attempt):
+    """
+    Seconds to wait before the given retry (counting from 0): exponential backoff with "full jitter", so that
+    concurrent requests failing together don't all come back at the same moment
+    """
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+def call_with_retries(function, *args):
+    """
+    Calls function(*args), retrying it after a backoff delay if it fails with a transient error
+    (up to the configured number of retries, after which the last error is raised)
+    """
+    attempt = 0
+    while True:
+        try:
+            return function(*args)
+        except Exception as e:
+            if attempt >= _MAX_RETRIES or not is_transient(e):
+                raise
+            delay = backoff_delay(attempt)
+            print "Retrying in {:.1f}s after {!r}".format(delay, e)
+            instrumentation.note_retry()
+            time.sleep(delay)
+            attempt += 1
+
+
+def fetch(url, headers=None):
+    """
+    Like open_stream, but reads the whole body, returning a Response
+    """
+    with open_stream(url, headers) as response:
+        body = response.read()
+    return Response(url, response.status, response.headers, body)
+
+
+def run_in_parallel(tasks, max_workers=None):
+    """
+    Runs each task (a zero argument callable) on a bounded pool of worker threads.
+    Results are returned in the same order as the tasks. If any task raises, the first exception
+    (in task order) is re-raised once all tasks have finished.
+    """
+    tasks = list(tasks)
+    worker_count = min(max_workers or _MAX_WORKERS, len(tasks))
+    if worker_count <= 1:
+        return [task() for task in tasks]
+
+    results = [None] * len(tasks)
+    errors = [None] * len(tasks)
+    queue = Queue()
+    for position, task in enumerate(tasks):
+        queue.put((position, task))
+
+    def work():
+        while True:
+            position, task = queue.get()
+            if task is None:
+                return
+            try:
+                results[position] = task()
+            except Exception:
+                # with the traceback, so the error is re-raised as it happened in the worker
+                errors[position] = sys.exc_info()
+
+    for _ in range(worker_count):
+        queue.put((None, None))  # one stop marker per worker, queued after all the real work
+
+    workers = [threading.Thread(target=work) for _ in range(worker_count)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    for error in errors:
+        if error is not None:
+            exc_type, exc_value, exc_tb = error
+            raise exc_type, exc_value, exc_tb
+
+    return results
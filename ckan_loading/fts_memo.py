@@ -0,0 +1,168 @@
+"""
+Run-scoped memoization of decoded FTS responses, so the same URL is fetched and decoded only once in a run.
+
+Several stages ask for the same data, e.g. the appeals of a country are used both for the appeal level and the
+organization level indicators. The first caller fetches the response while any concurrent callers for the same URL
+wait for it (single flight), and later callers get the memoized dataframe. A request for some of the columns of a URL
+is answered from a memoized dataframe holding all of them. Every caller gets its own copy, so callers are free to
+change the dataframe they get.
+
+Memory is bounded: the least recently used dataframes are dropped once the total goes over a budget.
+The memo holds record arrays (see fts_records) just the same, as another kind of entry for the URL, so dataframes and
+records share the budget. Entries are indexed by kind and URL, so finding one only looks at those of its URL.
+
+Response listeners (see fts_queries.add_response_listener) need to see every raw response, so while there are any,
+responses are fetched again rather than taken from the memo, though what's fetched is still memoized for later.
+"""
+
+import collections
+import threading
+
+DEFAULT_MAX_BYTES = 128 * 1024 * 1024
+
+
+class _Flight(object):
+    """
+    A fetch in progress, that other callers for the same URL can wait for
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.dataframe = None
+        self.error = None
+
+
+def _dataframe_bytes(dataframe):
+    if not hasattr(dataframe, 'memory_usage'):
+        return int(dataframe.nbytes)  # record arrays
+    return int(dataframe.memory_usage(index=True).sum())
+
+
+def _select(dataframe, columns):
+    """
+    The given columns of the dataframe, leaving out those it doesn't have (e.g. when the response was empty)
+    """
+    if columns is None:
+        return dataframe
+    return dataframe[[column for column in columns if column in dataframe.columns]]
+
+
+def _covers(memo_columns, columns):
+    """
+    Whether a dataframe fetched with memo_columns has all the given columns (None meaning all columns)
+    """
+    return memo_columns is None or (columns is not None and set(columns) <= set(memo_columns))
+
+
+class RequestMemo(object):
+    """
+    Decoded responses by kind, URL and requested columns, with single flight fetching
+    """
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.reset_after_fork()
+        self.clear()
+
+    def reset_after_fork(self):
+        """
+        Call in a freshly forked worker process: the lock may have been held by a thread of the parent, and the
+        parent's fetches in flight will never finish here
+        """
+        self._lock = threading.Lock()
+        self._flights = {}  # (kind, url) -> {columns: flight}
+
+    def clear(self):
+        with self._lock:
+            # (kind, url, columns) -> dataframe, least recently used first
+            self._dataframes = collections.OrderedDict()
+            self._columns_by_url = {}  # (kind, url) -> set of the columns memoized
+            self._bytes = 0
+
+    def _find(self, kind, url, columns):
+        for memo_columns in self._columns_by_url.get((kind, url), ()):
+            if _covers(memo_columns, columns):
+                key = (kind, url, memo_columns)
+                dataframe = self._dataframes.pop(key)
+                self._dataframes[key] = dataframe
+                return _select(dataframe, columns)
+        return None
+
+    def _remove(self, key):
+        self._bytes -= _dataframe_bytes(self._dataframes.pop(key))
+        kind, url, columns = key
+        memo_columns = self._columns_by_url[kind, url]
+        memo_columns.discard(columns)
+        if not memo_columns:
+            del self._columns_by_url[kind, url]
+
+    def _add(self, key, dataframe):
+        if key in self._dataframes:
+            self._remove(key)
+        size = _dataframe_bytes(dataframe)
+        if size > self.max_bytes:
+            return
+        kind, url, columns = key
+        self._dataframes[key] = dataframe
+        self._columns_by_url.setdefault((kind, url), set()).add(columns)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            self._remove(next(iter(self._dataframes)))
+
+    def _find_flight(self, kind, url, columns):
+        for flight_columns, flight in self._flights.get((kind, url), {}).items():
+            if _covers(flight_columns, columns):
+                return flight
+        return None
+
+    def fetch(self, fetch_function, url, columns=None, reuse=True, kind=None):
+        """
+        fetch_function(url, columns) memoized, returning a copy of the dataframe.
+        With reuse False the response is always fetched, and the memo updated with it.
+        Entries of different kinds (e.g. a dataframe and the records of the same URL) are kept apart.
+        """
+        columns_key = None if columns is None else tuple(columns)
+        key = (kind, url, columns_key)
+        with self._lock:
+            flight = None
+            if reuse:
+                dataframe = self._find(kind, url, columns)
+                if dataframe is not None:
+                    self.hits += 1
+                    return dataframe.copy()
+                flight = self._find_flight(kind, url, columns)
+
+            if flight is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+                own_flight = _Flight()
+                # when several callers don't reuse the memo, only the first is waited for by others
+                url_flights = self._flights.setdefault((kind, url), {})
+                registered = columns_key not in url_flights
+                if registered:
+                    url_flights[columns_key] = own_flight
+
+        if flight is not None:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return _select(flight.dataframe, columns).copy()
+
+        try:
+            own_flight.dataframe = fetch_function(url, columns)
+        except Exception as e:
+            own_flight.error = e
+            raise
+        else:
+            with self._lock:
+                self._add(key, own_flight.dataframe)
+        finally:
+            if registered:
+                with self._lock:
+                    url_flights = self._flights[kind, url]
+                    del url_flights[columns_key]
+                    if not url_flights:
+                        del self._flights[kind, url]
+            own_flight.done.set()
+        return own_flight.dataframe.copy()
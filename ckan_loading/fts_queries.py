@@ -1,33 +1,209 @@
 """
 Provides queries against the FTS API, fetching JSON and translating it into pandas dataframes.
-It unfortunately doesn't show the structure of the returned data explicitly, that's all handled by pandas.
+The column types of each kind of data returned are declared in fts_schemas, the rest is handled by pandas.
 At some point we may want to create dedicated classes for each type of data returned by the API, to do validation etc,
 but then we'll also need to implement join logic between these classes.
 
+Most of the functions below accept an optional list of columns: if given, the response is decoded incrementally and
+only those columns (plus the index) are kept, which keeps memory bounded for large responses.
+
+Within a run each response is only fetched and decoded once, see fts_memo and clear_memo.
+
+The *_as_records functions skip the dataframe altogether: they decode a response straight into compact records (see
+fts_records), for callers that combine many small responses and only need a dataframe once they are all stacked.
+
 For more information on the FTS API see http://fts.unocha.org/api/Files/APIUserdocumentation.htm
 """
 
+import json
+from StringIO import StringIO
+
 import pandas as pd
 
+import fts_cache
+import fts_http
+import fts_memo
+import fts_records
+import fts_replay
+import fts_schemas
+import fts_stream
+import instrumentation
+
 FTS_BASE_URL = 'http://fts.unocha.org/api/v1/'
 JSON_SUFFIX = '.json'
 
+# optional on-disk response cache, see enable_cache
+_RESPONSE_CACHE = None
+# optional fixture archive recorder, see start_recording
+_RECORDER = None
+# callables notified of every raw response, see add_response_listener
+_RESPONSE_LISTENERS = []
+# decoded responses of this run, as dataframes and as records
+_MEMO = fts_memo.RequestMemo()
+
+
+def enable_cache(directory, max_bytes=fts_cache.DEFAULT_MAX_BYTES):
+    """
+    Keep raw responses in an on-disk cache in the given directory, so repeated runs only download what changed.
+    See fts_cache for the expiry and revalidation policy.
+    """
+    global _RESPONSE_CACHE
+    _RESPONSE_CACHE = fts_cache.ResponseCache(directory, max_bytes)
+
+
+def reset_after_fork(process_count=1):
+    """
+    Call in a freshly forked worker process, before fetching anything, see fts_http.reset_after_fork.
+    Recording is not supported in worker processes, the archive belongs to the parent.
+    """
+    fts_http.reset_after_fork(process_count)
+    _MEMO.reset_after_fork()
+    if _RESPONSE_CACHE is not None:
+        _RESPONSE_CACHE.reset_after_fork()
+
+
+def clear_memo():
+    """
+    Forget the responses fetched so far, so they are fetched again (e.g. at the start of another run in the same
+    process)
+    """
+    _MEMO.clear()
+
 
 # leading underscores indicate internal functions
 
 
-def _fetch_json_as_dataframe(url):
+def add_response_listener(listener):
+    """
+    Call listener(url, body) with the raw body of every response fetched from now on
+    (listeners may be called concurrently from several threads, see fetch_many)
+    """
+    _RESPONSE_LISTENERS.append(listener)
+
+
+def remove_response_listener(listener):
+    _RESPONSE_LISTENERS.remove(listener)
+
+
+def start_recording(archive_path):
+    """
+    Capture every response fetched from now on into a fixture archive, which fts_replay can serve later
+    """
+    global _RECORDER
+    _RECORDER = fts_replay.Recorder(archive_path, FTS_BASE_URL)
+    add_response_listener(_RECORDER.record)
+
+
+def stop_recording():
+    global _RECORDER
+    if _RECORDER is not None:
+        remove_response_listener(_RECORDER.record)
+        _RECORDER.close()
+        _RECORDER = None
+
+
+def _fetch_body(url):
+    """
+    Fetch the raw response for the given URL, via the response cache if one is enabled
+    """
+    if _RESPONSE_CACHE is not None:
+        body = _RESPONSE_CACHE.fetch(url)
+    else:
+        body = fts_http.fetch(url).body
+
+    for listener in _RESPONSE_LISTENERS:
+        listener(url, body)
+
+    return body
+
+
+def _open_body(url):
+    """
+    Open the raw response for the given URL as a file-like object, to be read incrementally.
+    Listeners need the whole body, so with listeners registered this falls back to _fetch_body.
+    """
+    if _RESPONSE_LISTENERS:
+        return StringIO(_fetch_body(url))
+    if _RESPONSE_CACHE is not None:
+        return _RESPONSE_CACHE.open(url)
+    return fts_http.open_stream(url)
+
+
+def _fetch_json_as_dataframe(url, columns=None):
+    """
+    Fetch the given JSON URL over a pooled connection and let pandas try to build a dataframe from the contents.
+    If columns are given, the response is decoded incrementally and only those columns are kept,
+    see fts_stream (this only works for responses that are JSON arrays of objects).
+    Responses are memoized for the rest of the run, and the caller gets its own copy, see fts_memo.
+    """
+    return _MEMO.fetch(_fetch_json_as_dataframe_from_fts, url, columns, reuse=not _RESPONSE_LISTENERS)
+
+
+def _fetch_json_as_dataframe_from_fts(url, columns):
     """
-    pandas will fetch the given JSON URL and try to build a dataframe from the contents
+    Transient failures are retried with backoff, see fts_http.call_with_retries.
+    Every call is timed and measured, see instrumentation.
     """
-    return pd.read_json(url)
+    with instrumentation.request(url) as request:
+        dataframe = fts_http.call_with_retries(_fetch_json_as_dataframe_once, url, columns, request)
+        request.rows = len(dataframe)
+        return dataframe
+
+
+def _fetch_json_as_dataframe_once(url, columns, request):
+    request.bytes = 0  # only count the last attempt
+    if columns is None:
+        body = _fetch_body(url)
+        request.bytes = len(body)
+        return pd.read_json(body)
+
+    body = _open_body(url)
+    try:
+        return fts_stream.read_dataframe(instrumentation.CountingReader(body, request), columns)
+    finally:
+        body.close()
+
+
+def _fetch_json_as_records(url, record_type, path=None):
+    """
+    Fetch the given JSON URL and decode it straight into a structured array of record_type, see fts_records.
+    The response is a JSON array, or with a path a JSON object holding the array under that name.
+    Like _fetch_json_as_dataframe, responses are memoized for the rest of the run, apart from the dataframes.
+    """
+    return _MEMO.fetch(lambda url, _: _fetch_json_as_records_from_fts(url, record_type, path), url,
+                       reuse=not _RESPONSE_LISTENERS, kind=record_type.name)
+
+
+def _fetch_json_as_records_from_fts(url, record_type, path):
+    with instrumentation.request(url) as request:
+        records = fts_http.call_with_retries(_fetch_json_as_records_once, url, record_type, path, request)
+        request.rows = len(records)
+        return records
 
 
-def _fetch_json_as_dataframe_with_id(url):
+def _fetch_json_as_records_once(url, record_type, path, request):
+    request.bytes = 0  # only count the last attempt
+    if path is not None:
+        body = _fetch_body(url)
+        request.bytes = len(body)
+        decoded = json.loads(body)
+        elements = (decoded.get(path) or []) if isinstance(decoded, dict) else []
+        return record_type.from_elements(elements)
+
+    body = _open_body(url)
+    try:
+        return record_type.from_elements(fts_stream.iter_json_array(instrumentation.CountingReader(body, request)))
+    finally:
+        body.close()
+
+
+def _fetch_json_as_dataframe_with_id(url, columns=None):
     """
     Fetch a JSON url as a dataframe, using the "id" field as the "index" ("key") of the dataframe
     """
-    dataframe = _fetch_json_as_dataframe(url)
+    if columns is not None and 'id' not in columns:
+        columns = ['id'] + list(columns)
+    dataframe = _fetch_json_as_dataframe(url, columns)
     if 'id' in dataframe.columns:
         return dataframe.set_index('id')
     else:
@@ -41,22 +217,34 @@ def _build_json_url(middle_part):
     return FTS_BASE_URL + middle_part + JSON_SUFFIX
 
 
-def _convert_date_columns_from_string_to_timestamp(dataframe, column_names):
-    for column_name in column_names:
-        dataframe[column_name] = dataframe[column_name].apply(pd.datetools.parse)
+def fetch_many(calls, max_workers=None):
+    """
+    Runs several of the fetch_* functions below concurrently, returning their results in the same order.
+    Each call is a tuple of a function followed by its arguments, e.g.
+        fetch_many([(fetch_appeals_json_for_country_as_dataframe, 'KEN'),
+                    (fetch_funding_json_for_appeal_as_dataframe, 984, 'Recipient', 'organisation')])
+    The number of requests in flight is capped by max_workers (see fts_http.configure for the default),
+    and requests to FTS are rate limited per host.
+    """
+    tasks = [_bind_call(call[0], call[1:]) for call in calls]
+    return fts_http.run_in_parallel(tasks, max_workers)
+
 
+def _bind_call(function, args):
+    return lambda: function(*args)
 
-def fetch_sectors_json_as_dataframe():
+
+def fetch_sectors_json_as_dataframe(columns=None):
     """
     Returns the canonical "Sectors" available in FTS data
     Columns:
     id - sector id within FTS
     name - sector name within FTS
     """
-    return _fetch_json_as_dataframe_with_id(_build_json_url('Sector'))
+    return fts_schemas.SECTOR.apply(_fetch_json_as_dataframe_with_id(_build_json_url('Sector'), columns))
 
 
-def fetch_countries_json_as_dataframe():
+def fetch_countries_json_as_dataframe(columns=None):
     """
     Returns the countries known to FTS
     Columns:
@@ -65,10 +253,10 @@ def fetch_countries_json_as_dataframe():
     iso_code_N - numeric ISO code for each country (e.g. 32 for Argentina)
     name - FTS name for each country
     """
-    return _fetch_json_as_dataframe_with_id(_build_json_url('Country'))
+    return fts_schemas.COUNTRY.apply(_fetch_json_as_dataframe_with_id(_build_json_url('Country'), columns))
 
 
-def fetch_organizations_json_as_dataframe():
+def fetch_organizations_json_as_dataframe(columns=None):
     """
     Returns organizations known to FTS
     Columns:
@@ -77,10 +265,10 @@ def fetch_organizations_json_as_dataframe():
     name - name of the organization
     type - type of organization, e.g. 'NGOs', 'UN Agencies', etc
     """
-    return _fetch_json_as_dataframe_with_id(_build_json_url('Organization'))
+    return fts_schemas.ORGANIZATION.apply(_fetch_json_as_dataframe_with_id(_build_json_url('Organization'), columns))
 
 
-def fetch_emergencies_json_for_country_as_dataframe(country):
+def fetch_emergencies_json_for_country_as_dataframe(country, columns=None):
     """
     Returns all known FTS Emergencies for the given country.
     Accepts both names ("Slovakia") and ISO country codes ("SVK").
@@ -94,28 +282,27 @@ def fetch_emergencies_json_for_country_as_dataframe(country):
     type - the type of emergency, e.g. 'Natural Disaster'
     year - the year of the emergency, e.g. 2012
     """
-    return _fetch_json_as_dataframe_with_id(_build_json_url('Emergency/country/' + country))
+    return fts_schemas.EMERGENCY.apply(
+        _fetch_json_as_dataframe_with_id(_build_json_url('Emergency/country/' + country), columns))
 
 
-def fetch_emergencies_json_for_year_as_dataframe(year):
+def fetch_emergencies_json_for_year_as_dataframe(year, columns=None):
     """
     Similar to fetch_emergencies_json_for_country_as_dataframe,
     except it finds all FTS emergencies for a given year (e.g. 2012).
     """
-    return _fetch_json_as_dataframe_with_id(_build_json_url('Emergency/year/' + str(year)))
+    return fts_schemas.EMERGENCY.apply(
+        _fetch_json_as_dataframe_with_id(_build_json_url('Emergency/year/' + str(year)), columns))
 
 
-def _fetch_appeals_json_as_dataframe_given_url(url):
+def _fetch_appeals_json_as_dataframe_given_url(url, columns=None):
     """
     Fetches appeals JSON and converts columns to better datatypes
     """
-    dataframe = _fetch_json_as_dataframe_with_id(url)
-    if not dataframe.empty:
-        _convert_date_columns_from_string_to_timestamp(dataframe, ['start_date', 'end_date', 'launch_date'])
-    return dataframe
+    return fts_schemas.APPEAL.apply(_fetch_json_as_dataframe_with_id(url, columns))
 
 
-def fetch_appeals_json_for_country_as_dataframe(country):
+def fetch_appeals_json_for_country_as_dataframe(country, columns=None):
     """
     Returns all known FTS Appeals for the given country.
     Accepts both names ("Slovakia") and ISO country codes ("SVK").
@@ -135,18 +322,18 @@ def fetch_appeals_json_for_country_as_dataframe(country):
     end_date - ? the end of the appeal period?
     launch_date - the date the appeal was launched
     """
-    return _fetch_appeals_json_as_dataframe_given_url(_build_json_url('Appeal/country/' + country))
+    return _fetch_appeals_json_as_dataframe_given_url(_build_json_url('Appeal/country/' + country), columns)
 
 
-def fetch_appeals_json_for_year_as_dataframe(year):
+def fetch_appeals_json_for_year_as_dataframe(year, columns=None):
     """
     Similar to fetch_appeals_json_for_country_as_dataframe,
     except it finds all FTS appeals for a given year (e.g. 2012).
     """
-    return _fetch_appeals_json_as_dataframe_given_url(_build_json_url('Appeal/year/' + str(year)))
+    return _fetch_appeals_json_as_dataframe_given_url(_build_json_url('Appeal/year/' + str(year)), columns)
 
 
-def fetch_projects_json_for_appeal_as_dataframe(appeal_id):
+def fetch_projects_json_for_appeal_as_dataframe(appeal_id, columns=None):
     """
     Returns all known projects for a given appeal.
     Index:
@@ -169,13 +356,11 @@ def fetch_projects_json_for_appeal_as_dataframe(appeal_id):
     end_date - ? not sure what this really means
     last_updated_datetime - ? not sure what this really means
     """
-    dataframe = _fetch_json_as_dataframe_with_id(_build_json_url('Project/appeal/' + str(appeal_id)))
-    if not dataframe.empty:  # guard against empty result
-        _convert_date_columns_from_string_to_timestamp(dataframe, ['end_date', 'last_updated_datetime'])
-    return dataframe
+    dataframe = _fetch_json_as_dataframe_with_id(_build_json_url('Project/appeal/' + str(appeal_id)), columns)
+    return fts_schemas.PROJECT.apply(dataframe)
 
 
-def fetch_clusters_json_for_appeal_as_dataframe(appeal_id):
+def fetch_clusters_json_for_appeal_as_dataframe(appeal_id, columns=None):
     """
     Return funding data by "cluster" for a given appeal.
     Index:
@@ -187,25 +372,24 @@ def fetch_clusters_json_for_appeal_as_dataframe(appeal_id):
     funding - funding (USD) received
     pledges - USD amount pledged (not yet committed/received)
     """
-    dataframe = _fetch_json_as_dataframe(_build_json_url('Cluster/appeal/' + str(appeal_id)))
+    if columns is not None and 'name' not in columns:
+        columns = ['name'] + list(columns)
+    dataframe = _fetch_json_as_dataframe(_build_json_url('Cluster/appeal/' + str(appeal_id)), columns)
 
     if not dataframe.empty:  # guard against empty result
         dataframe = dataframe.set_index('name')
 
-    return dataframe
+    return fts_schemas.CLUSTER.apply(dataframe)
 
 
-def _fetch_contributions_json_as_dataframe_given_url(url):
+def _fetch_contributions_json_as_dataframe_given_url(url, columns=None):
     """
     Fetches contributions JSON and converts columns to better datatypes
     """
-    dataframe = _fetch_json_as_dataframe_with_id(url)
-    if not dataframe.empty:  # guard against empty result
-        _convert_date_columns_from_string_to_timestamp(dataframe, ['decision_date'])
-    return dataframe
+    return fts_schemas.CONTRIBUTION.apply(_fetch_json_as_dataframe_with_id(url, columns))
 
 
-def fetch_contributions_json_for_appeal_as_dataframe(appeal_id):
+def fetch_contributions_json_for_appeal_as_dataframe(appeal_id, columns=None):
     """
     Returns all known funding contributions towards an appeal.
     Index:
@@ -225,16 +409,25 @@ def fetch_contributions_json_for_appeal_as_dataframe(appeal_id):
     year - the year of the contribution
     decision_date - not sure what this is
     """
-    return _fetch_contributions_json_as_dataframe_given_url(_build_json_url('Contribution/appeal/' + str(appeal_id)))
+    return _fetch_contributions_json_as_dataframe_given_url(
+        _build_json_url('Contribution/appeal/' + str(appeal_id)), columns)
 
 
-def fetch_contributions_json_for_emergency_as_dataframe(emergency_id):
+def fetch_contributions_json_for_emergency_as_dataframe(emergency_id, columns=None):
     """
     Similar to fetch_contributions_json_for_appeal_as_dataframe,
     except it finds all contributions for a given emergency id.
     """
     return _fetch_contributions_json_as_dataframe_given_url(
-        _build_json_url('Contribution/emergency/' + str(emergency_id)))
+        _build_json_url('Contribution/emergency/' + str(emergency_id)), columns)
+
+
+def fetch_contributions_json_for_emergency_as_records(emergency_id):
+    """
+    Similar to fetch_contributions_json_for_emergency_as_dataframe, but returns fts_records.CONTRIBUTION records
+    """
+    return _fetch_json_as_records(_build_json_url('Contribution/emergency/' + str(emergency_id)),
+                                  fts_records.CONTRIBUTION)
 
 
 def _fetch_grouping_type_json_as_dataframe(middle_part, query, grouping, alias):
@@ -264,19 +457,12 @@ def _fetch_grouping_type_json_as_dataframe(middle_part, query, grouping, alias):
     Columns:
     There will be only one column, named by the "middle_part" parameter (e.g. "funding").
     """
-    url = _build_json_url(middle_part) + '?' + query
+    records = _fetch_grouping_type_json_as_records(middle_part, query, grouping)
 
-    if grouping:
-        url += '&GroupBy=' + grouping
+    if not len(records):
+        return pd.DataFrame()
 
-    # NOTE no id present in this data
-    raw_dataframe = _fetch_json_as_dataframe(url)
-
-    # oddly the JSON of interest is nested inside the "grouping" element
-    processed_frame = pd.DataFrame.from_records(raw_dataframe.grouping.values)
-
-    if processed_frame.empty:
-        return processed_frame
+    processed_frame = pd.DataFrame({'type': records['type'], 'amount': records['amount']}, columns=['type', 'amount'])
 
     if alias:
         processed_frame = processed_frame.rename(columns={'type': alias, 'amount': middle_part})
@@ -285,6 +471,20 @@ def _fetch_grouping_type_json_as_dataframe(middle_part, query, grouping, alias):
     return processed_frame
 
 
+def _fetch_grouping_type_json_as_records(middle_part, query, grouping):
+    """
+    The entries of a "grouping type" API query as fts_records.GROUPING records (type, amount),
+    see _fetch_grouping_type_json_as_dataframe
+    """
+    url = _build_json_url(middle_part) + '?' + query
+
+    if grouping:
+        url += '&GroupBy=' + grouping
+
+    # NOTE no id present in this data, and oddly the JSON of interest is nested inside the "grouping" element
+    return _fetch_json_as_records(url, fts_records.GROUPING, 'grouping')
+
+
 def fetch_funding_json_for_appeal_as_dataframe(appeal_id, grouping, alias):
     """
     Fetches committed or contributed funds (including carry over from previous years) for an appeal.
@@ -293,6 +493,14 @@ def fetch_funding_json_for_appeal_as_dataframe(appeal_id, grouping, alias):
     return _fetch_grouping_type_json_as_dataframe("funding", 'Appeal=' + str(appeal_id), grouping, alias)
 
 
+def fetch_funding_json_for_appeal_as_records(appeal_id, grouping):
+    """
+    Similar to fetch_funding_json_for_appeal_as_dataframe, but returns fts_records.GROUPING records, with the
+    grouping data (e.g. the recipient organization) as type and the funding as amount
+    """
+    return _fetch_grouping_type_json_as_records("funding", 'Appeal=' + str(appeal_id), grouping)
+
+
 def fetch_funding_json_for_emergency_as_dataframe(emergency_id, grouping, alias):
     """
     Fetches committed or contributed funds (including carry over from previous years) for an emergency.
@@ -0,0 +1,67 @@
+"""
+Compact records of FTS responses, as an alternative to building a dataframe for each response.
+
+Most responses the pipeline fetches are tiny (a country's appeals, the funding of one appeal by recipient), and for
+those building a dataframe - and later concatenating the frames of many responses - costs far more than the data
+itself. A RecordType decodes the JSON elements of a response straight into a numpy structured array, one compact row
+per element holding only the fields of the type, and stack() concatenates the arrays of many responses in one go, so
+a dataframe is only built once, from the stacked columns, where the records are aggregated.
+
+Strings are kept as Python objects, so they are never truncated. Missing fields are None for strings, NaN for floats
+and 0 for integers.
+"""
+
+import numpy as np
+
+_MISSING_BY_KIND = {'O': None, 'f': np.nan, 'i': 0}
+
+
+class RecordType(object):
+    """
+    The fields kept of one FTS entity, with their dtypes
+    """
+    def __init__(self, name, fields):
+        self.name = name
+        self.dtype = np.dtype(fields)
+        self.defaults = [(field_name, _MISSING_BY_KIND[self.dtype[field_name].kind])
+                         for field_name in self.dtype.names]
+
+    def from_elements(self, elements):
+        """
+        Structured array of the given decoded JSON objects
+        """
+        return np.array([tuple(default if element.get(field_name) is None else element[field_name]
+                               for field_name, default in self.defaults)
+                         for element in elements], dtype=self.dtype)
+
+    def empty(self):
+        return np.zeros(0, dtype=self.dtype)
+
+
+def stack(arrays, record_type):
+    """
+    Concatenate the record arrays of several responses into one
+    """
+    arrays = [array for array in arrays if len(array)]
+    if not arrays:
+        return record_type.empty()
+    return np.concatenate(arrays)
+
+
+def repeat_for_each(values, arrays):
+    """
+    One value for each of the record arrays, repeated for each of its records, in line with stack(arrays),
+    e.g. to add the year of each appeal to the stacked funding of several appeals
+    """
+    values = np.asarray(list(values))
+    if values.dtype.kind in 'SU':
+        values = values.astype(object)  # like the string fields of the records
+    return np.repeat(values, [len(array) for array in arrays])
+
+
+CONTRIBUTION = RecordType('Contribution', [('id', np.int64), ('appeal_id', np.int64), ('emergency_id', np.int64),
+                                           ('donor', object), ('recipient', object), ('status', object),
+                                           ('year', np.int64), ('amount', np.float64)])
+
+# the entries of the "grouping" funding and pledges queries, see fts_queries._fetch_grouping_type_json_as_records
+GROUPING = RecordType('Grouping', [('type', object), ('amount', np.float64)])
@@ -0,0 +1,163 @@
+"""
+Record/replay support for the FTS API, so the indicator pipeline can be run offline, profiled and regression tested.
+
+In record mode every response fetched through fts_queries is captured into a fixture archive (a zip file holding
+one member per response plus an index). In replay mode the archive is served by a local HTTP stand-in implementing
+the same /api/v1/... routes as FTS, with optional injected latency and bandwidth limits so that changes to
+concurrency and caching can be measured under realistic network conditions.
+
+To serve an archive on its own:
+    python fts_replay.py archive.zip --port 8000 --latency 0.2 --bandwidth 200000
+and point FTS_BASE_URL at http://127.0.0.1:8000/api/v1/
+"""
+
+import argparse
+import BaseHTTPServer
+import json
+import SocketServer
+import threading
+import time
+import urllib
+import urlparse
+import zipfile
+
+API_PATH = '/api/v1/'
+INDEX_MEMBER = 'index.json'
+BANDWIDTH_CHUNK_SIZE = 16 * 1024
+
+
+def archive_key(url, base_url):
+    """
+    The key a response is archived under: the URL relative to the API base, with query parameters in a canonical
+    order, e.g. 'funding.json?Appeal=984&GroupBy=Recipient'
+    """
+    relative_url = url[len(base_url):] if url.startswith(base_url) else url
+    path, _, query = relative_url.partition('?')
+    if not query:
+        return path
+    return path + '?' + urllib.urlencode(sorted(urlparse.parse_qsl(query, keep_blank_values=True)))
+
+
+class Recorder(object):
+    """
+    Captures responses into a fixture archive, call close() to write the index
+    """
+    def __init__(self, archive_path, base_url):
+        self.archive = zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED)
+        self.base_url = base_url
+        self.member_by_key = {}
+        self.lock = threading.Lock()
+
+    def record(self, url, body):
+        key = archive_key(url, self.base_url)
+        with self.lock:
+            if key in self.member_by_key:
+                return
+            member = 'responses/{}.json'.format(len(self.member_by_key))
+            self.archive.writestr(member, body)
+            self.member_by_key[key] = member
+
+    def close(self):
+        with self.lock:
+            self.archive.writestr(INDEX_MEMBER, json.dumps(self.member_by_key, indent=1, sort_keys=True))
+            self.archive.close()
+
+
+class ReplayArchive(object):
+    """
+    Read access to a fixture archive written by Recorder
+    """
+    def __init__(self, archive_path):
+        self.archive = zipfile.ZipFile(archive_path, 'r')
+        self.member_by_key = json.loads(self.archive.read(INDEX_MEMBER))
+        self.lock = threading.Lock()  # ZipFile reads are not thread safe
+
+    def __contains__(self, key):
+        return key in self.member_by_key
+
+    def get(self, key):
+        """
+        Returns the recorded body for the given key, or None if it was never recorded
+        """
+        member = self.member_by_key.get(key)
+        if member is None:
+            return None
+        with self.lock:
+            return self.archive.read(member)
+
+
+class _ReplayRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # allows keep-alive, as with the real FTS servers
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+
+        body = None
+        if self.path.startswith(API_PATH):
+            body = server.archive.get(archive_key(self.path[len(API_PATH):], ''))
+
+        if body is None:
+            self.send_error(404, 'Not recorded')
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if not server.bandwidth:
+            self.wfile.write(body)
+            return
+
+        for start in range(0, len(body), BANDWIDTH_CHUNK_SIZE):
+            chunk = body[start:start + BANDWIDTH_CHUNK_SIZE]
+            self.wfile.write(chunk)
+            time.sleep(float(len(chunk)) / server.bandwidth)
+
+    def log_message(self, format, *args):
+        pass  # a full run makes thousands of requests, don't flood the console
+
+
+class ReplayServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Serves a fixture archive over HTTP on the same routes as the FTS API.
+    latency is in seconds per request, bandwidth in bytes per second per response (None for unlimited).
+    """
+    daemon_threads = True
+
+    def __init__(self, archive, port=0, latency=0., bandwidth=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), _ReplayRequestHandler)
+        self.archive = archive
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:{}{}'.format(self.server_address[1], API_PATH)
+
+
+def start_replay_server(archive_path, port=0, latency=0., bandwidth=None):
+    """
+    Starts a stand-in server for the given archive on a background thread, returns the server
+    (use server.base_url as FTS_BASE_URL, and server.shutdown() when done)
+    """
+    server = ReplayServer(ReplayArchive(archive_path), port, latency, bandwidth)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve a recorded FTS fixture archive')
+    parser.add_argument('archive', help='archive written in record mode')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0., help='seconds added to each response')
+    parser.add_argument('--bandwidth', type=int, help='bytes per second for each response')
+    args = parser.parse_args()
+
+    replay_server = ReplayServer(ReplayArchive(args.archive), args.port, args.latency, args.bandwidth)
+    print "Serving", args.archive, "at", replay_server.base_url
+    replay_server.serve_forever()
@@ -0,0 +1,117 @@
+"""
+Declarative schemas for the entities returned by the FTS API.
+
+Each schema says which columns hold dates (and in which format FTS writes them), which hold a small set of repeated
+strings (stored as pandas categoricals), and which hold integers that fit a smaller dtype. Applying a schema to a
+freshly fetched dataframe parses the dates in a vectorized way, parsing each distinct string only once across the
+whole run, and shrinks the frame's memory footprint.
+"""
+
+import numpy as np
+import pandas as pd
+
+DATE_FORMAT = '%Y-%m-%d'
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# parsed dates by their string form, shared by all schemas; cleared when it grows too big
+_PARSED_DATE_CACHE = {}
+MAX_CACHED_DATES = 100000
+
+_INTEGER_DTYPES = [np.int8, np.int16, np.int32]
+
+
+def parse_dates(values, date_format):
+    """
+    Parse a series of date strings, trying the given format first and falling back to guessing the format.
+    Each distinct string is only parsed once.
+    """
+    unique_values = pd.unique(values)
+    unparsed_values = [value for value in unique_values if value not in _PARSED_DATE_CACHE]
+
+    if unparsed_values:
+        try:
+            parsed = pd.to_datetime(unparsed_values, format=date_format)
+        except (ValueError, TypeError):
+            # not all in the expected format, parse one by one as pd.datetools.parse would
+            parsed = [pd.to_datetime(value) for value in unparsed_values]
+
+        if len(_PARSED_DATE_CACHE) + len(unparsed_values) > MAX_CACHED_DATES:
+            _PARSED_DATE_CACHE.clear()
+        _PARSED_DATE_CACHE.update(zip(unparsed_values, parsed))
+
+    parsed_by_value = pd.Series([_PARSED_DATE_CACHE[value] for value in unique_values], index=unique_values)
+    return values.map(parsed_by_value)
+
+
+def downcast_integers(values):
+    """
+    Store an integer series in the smallest integer dtype that holds all its values
+    """
+    if values.dtype.kind != 'i' or values.empty:
+        return values
+
+    minimum, maximum = values.min(), values.max()
+    for dtype in _INTEGER_DTYPES:
+        if np.iinfo(dtype).min <= minimum and maximum <= np.iinfo(dtype).max:
+            return values.astype(dtype)
+    return values
+
+
+class Schema(object):
+    """
+    Column types for one FTS entity.
+    date_columns maps column names to their date format.
+    """
+    def __init__(self, name, date_columns=None, categorical_columns=(), integer_columns=()):
+        self.name = name
+        self.date_columns = date_columns or {}
+        self.categorical_columns = categorical_columns
+        self.integer_columns = integer_columns
+
+    def apply(self, dataframe):
+        """
+        Convert the columns of the given dataframe in place. Columns that are not present are skipped,
+        e.g. when only some columns were requested.
+        """
+        if dataframe.empty:
+            return dataframe
+
+        for column_name, date_format in self.date_columns.items():
+            if column_name in dataframe.columns:
+                dataframe[column_name] = parse_dates(dataframe[column_name], date_format)
+
+        for column_name in self.categorical_columns:
+            if column_name in dataframe.columns:
+                dataframe[column_name] = dataframe[column_name].astype('category')
+
+        for column_name in self.integer_columns:
+            if column_name in dataframe.columns:
+                dataframe[column_name] = downcast_integers(dataframe[column_name])
+
+        return dataframe
+
+
+COUNTRY = Schema('Country', integer_columns=['iso_code_N'])
+
+ORGANIZATION = Schema('Organization', categorical_columns=['type'])
+
+SECTOR = Schema('Sector')
+
+EMERGENCY = Schema('Emergency', categorical_columns=['country', 'type'], integer_columns=['year'])
+
+APPEAL = Schema('Appeal',
+                date_columns={'start_date': DATE_FORMAT, 'end_date': DATE_FORMAT, 'launch_date': DATE_FORMAT},
+                categorical_columns=['country', 'type'],
+                integer_columns=['emergency_id', 'year'])
+
+PROJECT = Schema('Project',
+                 date_columns={'end_date': DATE_FORMAT, 'last_updated_datetime': DATETIME_FORMAT},
+                 categorical_columns=['priority', 'appeal_title', 'cluster', 'sector', 'country', 'gendermarker'],
+                 integer_columns=['appeal_id'])
+
+CLUSTER = Schema('Cluster')
+
+CONTRIBUTION = Schema('Contribution',
+                      date_columns={'decision_date': DATE_FORMAT},
+                      categorical_columns=['appeal_title', 'emergency_title', 'donor', 'recipient', 'status'],
+                      integer_columns=['appeal_id', 'emergency_id', 'year', 'is_allocation'])
@@ -0,0 +1,82 @@
+"""
+Streaming decoding of the JSON arrays returned by the FTS API.
+
+pd.read_json needs the whole response in memory and then builds a dataframe with every field, including long texts
+(project objectives, appeal and emergency titles) that the indicators never look at. Here the response is decoded
+incrementally, one array element at a time, and only the requested columns are kept, so peak memory depends on the
+columns kept rather than on the size of the response.
+"""
+
+import codecs
+import json
+
+import pandas as pd
+
+CHUNK_SIZE = 64 * 1024
+_WHITESPACE = u' \t\n\r'
+
+
+def _skip_whitespace(buffer, position):
+    while position < len(buffer) and buffer[position] in _WHITESPACE:
+        position += 1
+    return position
+
+
+def iter_json_array(stream, chunk_size=CHUNK_SIZE):
+    """
+    Yields the elements of the JSON array read from the given file-like object, decoding it chunk by chunk
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = u''
+    position = 0
+    started = False
+    eof = False
+
+    while True:
+        position = _skip_whitespace(buffer, position)
+
+        if position < len(buffer):
+            if not started:
+                if buffer[position] != u'[':
+                    raise ValueError('Expected a JSON array, found {!r}'.format(buffer[position:position + 20]))
+                started = True
+                position += 1
+                continue
+
+            if buffer[position] == u']':
+                return
+            if buffer[position] == u',':
+                position += 1
+                continue
+
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                element, end = None, None  # element not complete yet, read more
+
+            # a number or literal at the very end of the buffer may have been cut short, make sure it's complete
+            if end is not None and (end < len(buffer) or eof or isinstance(element, (dict, list))):
+                yield element
+                position = end
+                continue
+
+        if eof:
+            raise ValueError('Unexpected end of JSON array')
+
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        buffer = buffer[position:] + text_decoder.decode(chunk, final=eof)
+        position = 0
+
+
+def read_dataframe(stream, columns):
+    """
+    Builds a dataframe with the given columns from a JSON array of objects,
+    without ever holding the other fields of more than one object in memory
+    """
+    values_by_column = dict((column, []) for column in columns)
+    for record in iter_json_array(stream):
+        for column in columns:
+            values_by_column[column].append(record.get(column))
+    return pd.DataFrame(values_by_column, columns=columns)
@@ -0,0 +1,241 @@
+"""
+Generates synthetic FTS-shaped data, as a fixture archive that fts_replay can serve in place of FTS.
+
+The archive holds every response the indicator pipeline asks for: the Country and Organization lists, appeals by
+country and by year, emergencies by country, contributions by emergency, and the funding groupings (by recipient for
+each appeal, by donor and by country for each year). The volume of data is controlled by a handful of parameters, so
+the pipeline can be measured at sizes well beyond what FTS itself holds today (see benchmark.py).
+
+To write an archive:
+    python fts_synthetic.py synthetic.zip --countries 50 --years 10 --appeals-per-country 20
+"""
+
+import argparse
+import datetime
+import json
+import random
+
+import fts_replay
+
+POOLED_FUND_DONORS = ["Central Emergency Response Fund", "Emergency Response Fund (OCHA)", "Common Humanitarian Fund"]
+ORGANIZATION_TYPES = ['NGOs', 'Private Orgs. & Foundations', 'UN Agencies', 'Governments', 'Red Cross / Red Crescent']
+APPEAL_TYPES = ['CAP', 'CAP', 'FLASH', 'OTHER']
+EMERGENCY_TYPES = ['Natural Disaster', 'Complex Emergency', 'Epidemic']
+CONTRIBUTION_STATUSES = ['Paid contribution', 'Paid contribution', 'Commitment', 'Pledge']
+
+# share of contributions made by one of the pooled funds
+POOLED_FUND_SHARE = 0.2
+# share of funding recipients that are not in the Organization list
+UNKNOWN_RECIPIENT_SHARE = 0.05
+
+
+class SyntheticParameters(object):
+    """
+    Size of a synthetic dataset.
+    Data is generated for the last `years` years up to last_year, but the year based endpoints are generated for
+    every year from first_year to last_year, as the pipeline asks for all of them.
+    """
+    def __init__(self, countries=20, years=5, appeals_per_country=10, contributions_per_emergency=20,
+                 organizations=500, first_year=1999, last_year=None, seed=0):
+        self.countries = countries
+        self.years = years
+        self.appeals_per_country = appeals_per_country
+        self.contributions_per_emergency = contributions_per_emergency
+        self.organizations = organizations
+        self.first_year = first_year
+        self.last_year = last_year or datetime.date.today().year + 1
+        self.seed = seed
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+def _country_code(number):
+    """
+    Three letter code for the given country number, 'AAA', 'AAB', ...
+    """
+    letters = []
+    for _ in range(3):
+        number, remainder = divmod(number, 26)
+        letters.append(chr(ord('A') + remainder))
+    return ''.join(reversed(letters))
+
+
+def _amount(rng, scale):
+    return float(int(rng.lognormvariate(0, 1.5) * scale))
+
+
+def _date(year, rng):
+    return datetime.date(year, rng.randint(1, 12), rng.randint(1, 28)).strftime('%Y-%m-%d')
+
+
+class SyntheticFTS(object):
+    """
+    A synthetic FTS dataset, generated deterministically from the parameters
+    """
+    def __init__(self, parameters):
+        self.parameters = parameters
+        rng = random.Random(parameters.seed)
+        data_years = range(max(parameters.first_year, parameters.last_year - parameters.years + 1),
+                           parameters.last_year + 1)
+
+        self.countries = [{'id': number + 1, 'iso_code_A': _country_code(number), 'iso_code_N': number + 1,
+                           'name': 'Country {}'.format(_country_code(number))}
+                          for number in range(parameters.countries)]
+
+        self.organizations = [{'id': number + 1, 'abbreviation': 'ORG{}'.format(number + 1),
+                               'name': 'Organization {}'.format(number + 1), 'type': rng.choice(ORGANIZATION_TYPES)}
+                              for number in range(parameters.organizations)]
+        self.organizations += [{'id': parameters.organizations + number + 1, 'abbreviation': '',
+                                'name': donor, 'type': 'UN Agencies'}
+                               for number, donor in enumerate(POOLED_FUND_DONORS)]
+        organization_names = [organization['name'] for organization in self.organizations]
+
+        self.appeals = []
+        self.emergencies = []
+        self.contributions = []
+        for country in self.countries:
+            for _ in range(parameters.appeals_per_country):
+                year = rng.choice(data_years)
+                emergency = {'id': len(self.emergencies) + 1, 'country': country['name'], 'funding': 0.,
+                             'glideid': '', 'pledges': 0., 'title': 'Emergency {}'.format(len(self.emergencies) + 1),
+                             'type': rng.choice(EMERGENCY_TYPES), 'year': year}
+                self.emergencies.append(emergency)
+
+                original_requirements = _amount(rng, 1e7)
+                appeal = {'id': len(self.appeals) + 1, 'emergency_id': emergency['id'], 'country': country['name'],
+                          'original_requirements': original_requirements,
+                          'current_requirements': float(int(original_requirements * rng.uniform(0.8, 1.5))),
+                          'funding': 0., 'pledges': 0., 'title': 'Appeal {}'.format(len(self.appeals) + 1),
+                          'type': rng.choice(APPEAL_TYPES), 'year': year,
+                          'start_date': '{}-01-01'.format(year), 'end_date': '{}-12-31'.format(year),
+                          'launch_date': _date(year, rng)}
+                self.appeals.append(appeal)
+
+                for _ in range(parameters.contributions_per_emergency):
+                    if rng.random() < POOLED_FUND_SHARE:
+                        donor = rng.choice(POOLED_FUND_DONORS)
+                    else:
+                        donor = rng.choice(organization_names)
+                    if rng.random() < UNKNOWN_RECIPIENT_SHARE:
+                        recipient = 'Unlisted recipient {}'.format(rng.randint(1, 100))
+                    else:
+                        recipient = rng.choice(organization_names)
+                    status = rng.choice(CONTRIBUTION_STATUSES)
+                    contribution_year = min(year + rng.choice([0, 0, 0, 1]), parameters.last_year)
+                    contribution = {'id': len(self.contributions) + 1, 'amount': _amount(rng, 1e5),
+                                    'appeal_id': appeal['id'], 'appeal_title': appeal['title'],
+                                    'emergency_id': emergency['id'], 'emergency_title': emergency['title'],
+                                    'donor': donor, 'recipient': recipient, 'project_code': '',
+                                    'status': status, 'is_allocation': int(donor in POOLED_FUND_DONORS),
+                                    'year': contribution_year, 'decision_date': _date(contribution_year, rng)}
+                    self.contributions.append(contribution)
+
+                    if status == 'Pledge':
+                        appeal['pledges'] += contribution['amount']
+                        emergency['pledges'] += contribution['amount']
+                    else:
+                        appeal['funding'] += contribution['amount']
+                        emergency['funding'] += contribution['amount']
+
+    def _recipient_country(self, contribution):
+        return self.appeals[contribution['appeal_id'] - 1]['country']
+
+    def responses(self):
+        """
+        Yields (archive key, JSON body) for every response
+        """
+        parameters = self.parameters
+        all_years = range(parameters.first_year, parameters.last_year + 1)
+
+        yield 'Country.json', self.countries
+        yield 'Organization.json', self.organizations
+
+        appeals_by_country = _group_by(self.appeals, 'country')
+        emergencies_by_country = _group_by(self.emergencies, 'country')
+        for country in self.countries:
+            yield 'Appeal/country/{}.json'.format(country['iso_code_A']), appeals_by_country.get(country['name'], [])
+            yield ('Emergency/country/{}.json'.format(country['iso_code_A']),
+                   emergencies_by_country.get(country['name'], []))
+
+        appeals_by_year = _group_by(self.appeals, 'year')
+        for year in all_years:
+            yield 'Appeal/year/{}.json'.format(year), appeals_by_year.get(year, [])
+
+        contributions_by_emergency = _group_by(self.contributions, 'emergency_id')
+        for emergency in self.emergencies:
+            yield ('Contribution/emergency/{}.json'.format(emergency['id']),
+                   contributions_by_emergency.get(emergency['id'], []))
+
+        # pledges are not funding
+        funded_contributions = [contribution for contribution in self.contributions
+                                if contribution['status'] != 'Pledge']
+
+        funded_contributions_by_appeal = _group_by(funded_contributions, 'appeal_id')
+        for appeal in self.appeals:
+            yield (fts_replay.archive_key('funding.json?Appeal={}&GroupBy=Recipient'.format(appeal['id']), ''),
+                   _grouping(funded_contributions_by_appeal.get(appeal['id'], []), 'recipient'))
+
+        funded_contributions_by_year = _group_by(funded_contributions, 'year')
+        for year in all_years:
+            contributions = funded_contributions_by_year.get(year, [])
+            # FTS always lists the pooled funds
+            yield (fts_replay.archive_key('funding.json?Year={}&GroupBy=donor'.format(year), ''),
+                   _grouping(contributions, 'donor', POOLED_FUND_DONORS))
+            yield (fts_replay.archive_key('funding.json?Year={}&GroupBy=country'.format(year), ''),
+                   _grouping(contributions, self._recipient_country))
+
+    def write_archive(self, archive_path):
+        """
+        Write all responses to a fixture archive that fts_replay can serve
+        """
+        recorder = fts_replay.Recorder(archive_path, '')
+        try:
+            count = 0
+            for key, data in self.responses():
+                recorder.record(key, json.dumps(data))
+                count += 1
+        finally:
+            recorder.close()
+        return count
+
+
+def _group_by(records, field):
+    records_by_value = {}
+    for record in records:
+        records_by_value.setdefault(record[field], []).append(record)
+    return records_by_value
+
+
+def _grouping(contributions, key, always_listed=()):
+    """
+    A funding grouping response: contribution amounts summed by the given field (or function of a contribution)
+    """
+    amount_by_name = dict((name, 0.) for name in always_listed)
+    for contribution in contributions:
+        name = contribution[key] if isinstance(key, str) else key(contribution)
+        amount_by_name[name] = amount_by_name.get(name, 0.) + contribution['amount']
+    return {'grouping': [{'type': name, 'amount': amount} for name, amount in sorted(amount_by_name.items())]}
+
+
+def write_synthetic_archive(archive_path, parameters):
+    """
+    Generate a synthetic dataset with the given SyntheticParameters into a fixture archive, returns the response count
+    """
+    return SyntheticFTS(parameters).write_archive(archive_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write a synthetic FTS fixture archive')
+    parser.add_argument('archive', help='zip file to write')
+    parser.add_argument('--countries', type=int, default=20)
+    parser.add_argument('--years', type=int, default=5, help='number of (most recent) years with data')
+    parser.add_argument('--appeals-per-country', type=int, default=10)
+    parser.add_argument('--contributions-per-emergency', type=int, default=20)
+    parser.add_argument('--organizations', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    synthetic_parameters = SyntheticParameters(args.countries, args.years, args.appeals_per_country,
+                                               args.contributions_per_emergency, args.organizations, seed=args.seed)
+    print "Wrote", write_synthetic_archive(args.archive, synthetic_parameters), "responses to", args.archive
@@ -2,12 +2,33 @@
 Builds CHD indicators from FTS queries
 """
 
+import argparse
+import checkpoint
+import fts_http
 import fts_queries
+import fts_records
+import fts_replay
+import incremental
+import indicator_buffer
+import instrumentation
+import itertools
+import job_queue
+import multiprocessing
+import name_index
 import os
+import reference_snapshot
+import shutil
+import sys
+import tempfile
+import time
+import value_sinks
 import datetime
 import sqlite3
 import pandas as pd
-import pandas.io.sql as sql
+
+# the database schema and bulk writer live with the rest of the database code in ../metadata
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'metadata'))
+import orm
 
 
 # note relying on strings is fragile - could break if things get renamed in FTS
@@ -16,6 +37,7 @@ DONOR_ERF = "Emergency Response Fund (OCHA)"
 DONOR_CERF = "Central Emergency Response Fund"
 DONOR_CHF = "Common Humanitarian Fund"
 POOLED_FUNDS = [DONOR_CERF, DONOR_ERF, DONOR_CHF]
+POOLED_FUND_NAMES = name_index.NameIndex(POOLED_FUNDS)
 
 YEAR_START = 1999  # first year that FTS has data
 YEAR_END = datetime.date.today().year + 1  # next year data can start to show up near current year-end
@@ -27,6 +49,13 @@ class PooledFundCacheByYear(object):
     """
     def __init__(self):
         self.year_cache = {}
+        self.snapshot = None  # see use_snapshot
+
+    def use_snapshot(self, snapshot):
+        """
+        Take the years missing from the cache from the given reference_snapshot.ReferenceSnapshot rather than FTS
+        """
+        self.snapshot = snapshot
 
     # Note this doesn't match FTS reports exactly for all values
     # Sean Foo explains that contributions can have a year that differs from the fund-year
@@ -34,6 +63,10 @@ class PooledFundCacheByYear(object):
     # unfortunately the "fund-year" version is not readily available from the API
     def get_pooled_global_allocation_for_year(self, year):
         if year not in self.year_cache:
+            if self.snapshot is not None and self.snapshot.has_year(year):
+                self.year_cache[year] = self.snapshot.get_pooled_fund_amounts(year)
+                return self.year_cache[year]
+
             global_funding_by_donor =\
                 fts_queries.fetch_funding_json_for_year_as_dataframe(year, 'donor', 'organization')
 
@@ -50,25 +83,57 @@ class CountryFundingCacheByYear(object):
     """
     def __init__(self):
         self.year_cache = {}
-
-        self.country_iso_code_to_name = {}
-        countries = fts_queries.fetch_countries_json_as_dataframe()
-        for country_id, row in countries.iterrows():
-            self.country_iso_code_to_name[row['iso_code_A']] = row['name']
-
-    def get_total_country_funding_for_year(self, country_code, year):
+        self.country_iso_code_to_name = None  # loaded on first use, so FTS_BASE_URL can be changed before then
+        self.snapshot = None  # see use_snapshot
+
+    def use_snapshot(self, snapshot):
+        """
+        Take the countries and the years missing from the cache from the given reference_snapshot.ReferenceSnapshot
+        rather than FTS
+        """
+        self.snapshot = snapshot
+
+    def _get_country_iso_code_to_name(self):
+        if self.country_iso_code_to_name is None and self.snapshot is not None:
+            self.country_iso_code_to_name = self.snapshot.get_country_names_by_code()
+        if self.country_iso_code_to_name is None:
+            country_iso_code_to_name = {}
+            countries = fts_queries.fetch_countries_json_as_dataframe(COUNTRY_COLUMNS)
+            for country_id, row in countries.iterrows():
+                country_iso_code_to_name[row['iso_code_A']] = row['name']
+            self.country_iso_code_to_name = country_iso_code_to_name
+
+        return self.country_iso_code_to_name
+
+    def get_country_name(self, country_code):
+        return self._get_country_iso_code_to_name()[country_code]
+
+    def fetch_funding_for_year(self, year):
         if year not in self.year_cache:
+            if self.snapshot is not None and self.snapshot.has_year(year):
+                self.year_cache[year] = self.snapshot.get_funding_by_country(year)
+                return self.year_cache[year]
+
             funding_by_country =\
                 fts_queries.fetch_funding_json_for_year_as_dataframe(year, 'country', 'country')
 
             self.year_cache[year] = funding_by_country
 
+        return self.year_cache[year]
+
+    def get_country_codes_by_name(self):
+        return dict((name, code) for code, name in self._get_country_iso_code_to_name().items())
+
+    def get_country_names_by_code(self):
+        return dict(self._get_country_iso_code_to_name())
+
+    def get_total_country_funding_for_year(self, country_code, year):
         # possibly no funding at all in that year
-        funding_series = self.year_cache[year]
+        funding_series = self.fetch_funding_for_year(year)
         if funding_series.empty:
             return 0
 
-        country_name = self.country_iso_code_to_name[country_code]
+        country_name = self.get_country_name(country_code)
 
         if country_name in funding_series.funding:
             return funding_series.funding.loc[country_name]
@@ -76,8 +141,100 @@ class CountryFundingCacheByYear(object):
             return 0
 
 
-POOLED_FUND_CACHE = PooledFundCacheByYear()
-COUNTRY_FUNDING_CACHE = CountryFundingCacheByYear()
+class PooledFundContributionIndex(object):
+    """
+    Run-wide index of pooled fund contributions, keyed by emergency id.
+    The contributions of each emergency are fetched only once, even when the emergency spans several countries,
+    and only the non-pledge pooled fund (CERF/ERF/CHF) records are kept (see fts_records).
+    The records of each country's emergencies are then stacked and rolled up by donor and year.
+    """
+    def __init__(self):
+        self.contributions_by_emergency = {}
+        self.amount_by_donor_year_by_country = {}
+
+    def load_emergencies(self, emergency_ids):
+        """
+        Fetch the contributions of any of the given emergencies not seen yet, in one concurrent batch
+        """
+        missing_ids = sorted(set(emergency_ids) - set(self.contributions_by_emergency))
+
+        all_contributions = fts_queries.fetch_many(
+            [(fts_queries.fetch_contributions_json_for_emergency_as_records, emergency_id)
+             for emergency_id in missing_ids])
+
+        for emergency_id, contributions in zip(missing_ids, all_contributions):
+            self.contributions_by_emergency[emergency_id] = _select_pooled_fund_contributions(contributions)
+
+    def load_countries(self, countries):
+        """
+        Fetch the emergencies of each country, then the contributions of all their emergencies,
+        and roll up the pooled fund amounts of each country by donor and year
+        """
+        countries = list(countries)
+        emergencies_by_country = fts_queries.fetch_many(
+            [(fts_queries.fetch_emergencies_json_for_country_as_dataframe, country, EMERGENCY_COLUMNS)
+             for country in countries])
+
+        self.load_emergencies(
+            [emergency_id for emergencies in emergencies_by_country for emergency_id in emergencies.index])
+
+        for country, emergencies in zip(countries, emergencies_by_country):
+            # combine the data across emergencies
+            contributions_overall = fts_records.stack(
+                [self.contributions_by_emergency[emergency_id] for emergency_id in emergencies.index],
+                fts_records.CONTRIBUTION)
+
+            if len(contributions_overall):
+                # sum amount by donor-year
+                amount_by_donor_year = pd.Series(contributions_overall['amount']).groupby(
+                    [contributions_overall['donor'], contributions_overall['year']]).sum()
+                amount_by_donor_year.index.names = ['donor', 'year']
+            else:
+                amount_by_donor_year = pd.Series()  # empty Series
+
+            self.amount_by_donor_year_by_country[country] = amount_by_donor_year
+
+    def get_amount_by_donor_year(self, country):
+        """
+        Pooled fund contributions towards the country's emergencies, summed by donor and year
+        """
+        if country not in self.amount_by_donor_year_by_country:
+            self.load_countries([country])
+        return self.amount_by_donor_year_by_country[country]
+
+
+def _select_pooled_fund_contributions(contributions):
+    """
+    Keep only the contribution records that count towards pooled fund indicators
+    """
+    if not len(contributions):
+        return contributions
+
+    # note that is_allocation field on contributions is much cleaner and _almost_ gives the same answer,
+    # but found 1 instance of contribution that did not have this field set and yet looked like it should
+
+    # exclude pledges and non-CERF/ERF/CHF
+    selected = (contributions['status'] != FUNDING_STATUS_PLEDGE) & POOLED_FUND_NAMES.contains(contributions['donor'])
+    return contributions[selected]
+
+
+# reference data shared by all regions, nothing is fetched until a region needs it
+POOLED_FUND_CACHE = None
+COUNTRY_FUNDING_CACHE = None
+POOLED_FUND_CONTRIBUTIONS = None
+
+
+def reset_reference_caches():
+    """
+    Start over with empty reference caches, e.g. to run again in the same process against other FTS data
+    """
+    global POOLED_FUND_CACHE, COUNTRY_FUNDING_CACHE, POOLED_FUND_CONTRIBUTIONS
+    POOLED_FUND_CACHE = PooledFundCacheByYear()
+    COUNTRY_FUNDING_CACHE = CountryFundingCacheByYear()
+    POOLED_FUND_CONTRIBUTIONS = PooledFundContributionIndex()
+
+
+reset_reference_caches()
 
 FUNDING_STATUS_PLEDGE = "Pledge"
 
@@ -85,20 +242,43 @@ ORG_TYPE_NGOS = 'NGOs'
 ORG_TYPE_PRIVATE_ORGS = 'Private Orgs. & Foundations'
 ORG_TYPE_UN_AGENCIES = 'UN Agencies'
 
+# the only columns of each FTS entity the indicators need, everything else is skipped when decoding responses
+COUNTRY_COLUMNS = ['iso_code_A', 'name']
+ORGANIZATION_COLUMNS = ['name', 'type']
+APPEAL_COLUMNS = ['country', 'type', 'year', 'original_requirements', 'current_requirements', 'funding']
+EMERGENCY_COLUMNS = ['id']
+
 
-# holds IndicatorValue objects until we are ready to put them in a dataframe
-VALUES = []
+# holds the indicator tuples until we are ready to put them in a dataframe
+VALUES = indicator_buffer.IndicatorValueBuffer()
 
+# the scraperwiki style "value" table built from VALUES, shared by the writers (see get_values_for_export)
+_EXPORT_VALUES = None
 
-class IndicatorValue(object):
+VALUE_TABLE_COLUMNS = ['dsID', 'region', 'indID', 'period', 'value', 'is_number', 'source']
+TABLE_NAME = "value"
+SQL_FILENAME = 'ocha.db'
+CSV_OUTPUT_DIR = '/tmp'
+SQL_OUTPUT_DIR = '/home/'
+FINGERPRINTS_FILENAME = 'fts_fingerprints.db'
+CHECKPOINT_FILENAME = 'fts_checkpoint.db'
+# all the values of the last incremental refresh, in the order a full run produces them
+REFRESH_VALUES_FILENAME = 'fts_values.npz'
+# snapshots of the global reference data are reused for this many days, see load_reference_data
+REFERENCE_MAX_AGE_DAYS = 0
+# an incremental refresh recomputes everything when the last full refresh is older than this, see
+# refresh_data_for_regions
+FULL_REFRESH_DAYS = 7
+
+
+class RegionsFailedError(Exception):
     """
-    A simple "struct" for the data tuple produced by this process.
+    Raised at the end of a checkpointed run if some regions could not be populated, see populate_data_for_regions
     """
-    def __init__(self, indicator, region, year, value):
-        self.indicator = indicator
-        self.region = region
-        self.year = year
-        self.value = value
+    def __init__(self, errors_by_region):
+        Exception.__init__(self, '{} regions failed, rerun with --resume to retry them: {}'.format(
+            len(errors_by_region), ', '.join(sorted(errors_by_region))))
+        self.errors_by_region = errors_by_region
 
 
 def add_row_to_values(indicator, region, year, value):
@@ -109,26 +289,33 @@ def add_row_to_values(indicator, region, year, value):
     if year > YEAR_END:
         return
 
-    VALUES.append(IndicatorValue(indicator, region, year, value))
+    VALUES.append(indicator, region, year, value)
 
 
 def get_values_as_dataframe():
     """
     Retrieve all recorded tuples as a pandas dataframe
     """
-    indicators = [ind_value.indicator for ind_value in VALUES]
-    regions = [ind_value.region for ind_value in VALUES]
-    years = [ind_value.year for ind_value in VALUES]
-    values = [ind_value.value for ind_value in VALUES]
+    return VALUES.to_dataframe()
+
+
+def get_values_for_export():
+    """
+    Retrieve all recorded tuples in the layout of the scraperwiki style "value" table.
+    This is only built once (until the tuples change) and shared by all the writers, so treat it as read-only.
+    """
+    global _EXPORT_VALUES
+    if _EXPORT_VALUES is None or _EXPORT_VALUES[0] != VALUES.generation:
+        _EXPORT_VALUES = (VALUES.generation, export_values(get_values_as_dataframe()))
 
-    return pd.DataFrame(
-        {'indicator': indicators, 'region': regions, 'year': years, 'value': values},
-        columns=['indicator', 'region', 'year', 'value']
-    )
+    return _EXPORT_VALUES[1]
 
 
-def write_values_as_scraperwiki_style_csv(base_dir):
-    values = get_values_as_dataframe()
+def export_values(values):
+    """
+    Convert a dataframe of indicator, region, year, value rows to the layout of the scraperwiki style "value" table
+    """
+    values = values.copy()
     values.replace(to_replace=[float('inf')],
                    value=['na'],
                    inplace=True)
@@ -136,32 +323,36 @@ def write_values_as_scraperwiki_style_csv(base_dir):
     values['is_number'] = 1
     values['source'] = ''
     values = values.rename(columns={'indicator': 'indID', 'year': 'period'})
-    values = values[['dsID', 'region', 'indID', 'period', 'value', 'is_number', 'source']]
+    return values[VALUE_TABLE_COLUMNS]
+
+
+def write_values_as_scraperwiki_style_csv(base_dir):
+    values = get_values_for_export()
 
     filename = os.path.join(base_dir, 'value.csv')
     values.to_csv(filename, index=False)
 
 
 def write_values_as_scraperwiki_style_sql(base_dir):
-    TABLE_NAME = "value"
-    values = get_values_as_dataframe()
-    values.replace(to_replace=[float('inf')],
-                   value=['na'],
-                   inplace=True)
-    values['dsID'] = 'fts'
-    values['is_number'] = 1
-    values['source'] = ''
-    values = values.rename(columns={'indicator': 'indID', 'year': 'period'})
-    values = values[['dsID', 'region', 'indID', 'period', 'value', 'is_number', 'source']]
+    values = get_values_for_export()
 
-    filename = os.path.join(base_dir, 'ocha.db')
-    sqlite_db = sqlite3.connect(filename)
-    sqlite_db.execute("drop table if exists {};".format(TABLE_NAME))
-    #values = values.reset_index()
-    sql.write_frame(values, TABLE_NAME, sqlite_db)
+    filename = os.path.join(base_dir, SQL_FILENAME)
+    orm.bulk_save_values(values.itertuples(index=False), filename)
     print values
 
 
+def value_table_exists(sql_dir):
+    filename = os.path.join(sql_dir, SQL_FILENAME)
+    if not os.path.exists(filename):
+        return False
+    sqlite_db = sqlite3.connect(filename)
+    try:
+        return sqlite_db.execute(
+            "select count(*) from sqlite_master where type = 'table' and name = ?", (TABLE_NAME,)).fetchone()[0] > 0
+    finally:
+        sqlite_db.close()
+
+
 def populate_appeals_level_data(country):
     """
     Populate data based on the "appeals" concept in FTS.
@@ -169,19 +360,26 @@ def populate_appeals_level_data(country):
     If there was no appeal, fill in zeros for all items.
     This unfortunately conflates "zero" vs "missing" data.
     """
-    appeals = fts_queries.fetch_appeals_json_for_country_as_dataframe(country)
+    appeals = fts_queries.fetch_appeals_json_for_country_as_dataframe(country, APPEAL_COLUMNS)
 
     if not appeals.empty:
         # group/sum all appeals by year, columns are now just the numerical ones:
         #  - current_requirements, emergency_id, funding, original_requirements, pledges
-        cross_appeals_by_year = appeals.groupby('year').sum().astype(float)
+        cross_appeals_by_year = appeals.groupby('year')[APPEAL_AMOUNT_COLUMNS].sum().astype(float)
         # do the same with Consolidated Appeals Process (CAP)-only
-        cap_appeals_by_year = appeals[appeals.type == 'CAP'].groupby('year').sum().astype(float)
+        cap_appeals_by_year = appeals[appeals.type == 'CAP'].groupby('year')[APPEAL_AMOUNT_COLUMNS].sum().astype(float)
     else:
         # just re-use the empty frames
         cross_appeals_by_year = appeals
         cap_appeals_by_year = appeals
 
+    add_appeals_level_rows(country, cross_appeals_by_year, cap_appeals_by_year)
+
+
+def add_appeals_level_rows(country, cross_appeals_by_year, cap_appeals_by_year):
+    """
+    Record FY010, FY020, FY040, FA010, FA140 given appeal amounts summed by year, for all appeals and CAP appeals
+    """
     for year in range(YEAR_START, YEAR_END + 1):
         original_requirements = 0.
         current_requirements = 0.
@@ -213,44 +411,127 @@ def get_organizations_indexed_by_name():
     string is used in other API results (not id), so we need to join on it.
     This is a slow call, so it makes sense to cache it.
     """
-    organizations = fts_queries.fetch_organizations_json_as_dataframe()
+    organizations = fts_queries.fetch_organizations_json_as_dataframe(ORGANIZATION_COLUMNS)
     return organizations.set_index('name')
 
 
+def get_organization_index():
+    """
+    Load organizations from FTS into an interned name -> id -> type lookup, see name_index.OrganizationIndex.
+    Like get_organizations_indexed_by_name, this is a slow call, so build it once and pass it around.
+    """
+    return name_index.OrganizationIndex(get_organizations_indexed_by_name())
+
+
+def load_reference_data(reference_dir=None, max_age_days=REFERENCE_MAX_AGE_DAYS):
+    """
+    Load the reference data shared by all regions (organizations, countries, global pooled fund allocations and
+    country funding by year) up front, returning the organization index.
+    With a reference_dir, the newest snapshot there fetched from the same FTS_BASE_URL is used if it is recent enough
+    (see reference_snapshot). Otherwise everything is fetched concurrently rather than one year at a time on the
+    first region, and saved as a new snapshot in reference_dir; the run goes on without it if it can't be saved.
+    """
+    years = range(YEAR_START, YEAR_END + 1)
+    if reference_dir is not None:
+        snapshot = reference_snapshot.load_latest_snapshot(reference_dir, max_age_days, fts_queries.FTS_BASE_URL)
+        if snapshot is not None:
+            print "Using the reference data snapshot of", snapshot.version
+            POOLED_FUND_CACHE.use_snapshot(snapshot)
+            COUNTRY_FUNDING_CACHE.use_snapshot(snapshot)
+            return name_index.OrganizationIndex(snapshot.get_organizations_indexed_by_name())
+
+    results = fts_http.run_in_parallel(
+        [get_organizations_indexed_by_name, COUNTRY_FUNDING_CACHE.get_country_names_by_code] +
+        [_bind_year(POOLED_FUND_CACHE.get_pooled_global_allocation_for_year, year) for year in years] +
+        [_bind_year(COUNTRY_FUNDING_CACHE.fetch_funding_for_year, year) for year in years])
+    organizations_by_name, country_names_by_code = results[:2]
+
+    if reference_dir is not None:
+        try:
+            reference_snapshot.save_snapshot(
+                reference_dir, country_names_by_code, organizations_by_name,
+                dict(zip(years, results[2:2 + len(years)])), dict(zip(years, results[2 + len(years):])),
+                source=fts_queries.FTS_BASE_URL)
+        except (IOError, OSError) as e:
+            print "Could not save the reference data snapshot in", reference_dir, repr(e)
+
+    return name_index.OrganizationIndex(organizations_by_name)
+
+
+def sum_funding_by_organization_type(funding_by_recipient, organizations, group_keys):
+    """
+    Roll up funding (indexed by recipient organization name) by the given keys, where the key 'type' stands for the
+    organization type of the recipient and other keys are columns of funding_by_recipient.
+    Recipients are looked up as integer codes in the organizations index rather than joined on their names,
+    recipients of unknown type are left out.
+    Returns a series indexed by group_keys.
+    """
+    type_codes = organizations.get_type_codes(funding_by_recipient.index)
+    known_type = type_codes != name_index.UNKNOWN
+    funding_by_recipient = funding_by_recipient[known_type]
+    if funding_by_recipient.empty:
+        return pd.Series()
+
+    keys = [type_codes[known_type] if key == 'type' else funding_by_recipient[key].values for key in group_keys]
+    funding_sums = funding_by_recipient.funding.groupby(keys).sum()
+
+    # bring back the type names, so callers can look up e.g. (ORG_TYPE_NGOS, year)
+    levels = [funding_sums.index.get_level_values(level) for level in range(len(group_keys))]
+    type_level = group_keys.index('type')
+    levels[type_level] = organizations.get_type_names(levels[type_level])
+    funding_sums.index = pd.MultiIndex.from_arrays(levels, names=group_keys)
+    return funding_sums
+
+
+def _stack_funding_by_recipient(funding_records_by_appeal, **values_by_appeal):
+    """
+    One frame of the funding by recipient records (see fts_queries.fetch_funding_json_for_appeal_as_records) of
+    several appeals, indexed by organisation, with a funding column and a column for each of the given lists of
+    per-appeal values (e.g. the year of each appeal)
+    """
+    funding = fts_records.stack(funding_records_by_appeal, fts_records.GROUPING)
+    columns = {'funding': funding['amount']}
+    for name, values in values_by_appeal.items():
+        columns[name] = fts_records.repeat_for_each(values, funding_records_by_appeal)
+    return pd.DataFrame(columns, index=pd.Index(funding['type'], name='organisation'))
+
+
 def populate_organization_level_data(country, organizations=None):
     """
     Populate data on funding by organization type
     """
     if organizations is None:
-        organizations = get_organizations_indexed_by_name()
+        organizations = get_organization_index()
 
     # load appeals, analyze each one
-    appeals = fts_queries.fetch_appeals_json_for_country_as_dataframe(country)
-
-    funding_dataframes_by_appeal = []
-
-    for appeal_id, appeal_row in appeals.iterrows():
-        # first check if there is any funding at all (otherwise API calls will get upset)
-        if appeal_row['funding'] == 0:
-            continue
+    appeals = fts_queries.fetch_appeals_json_for_country_as_dataframe(country, APPEAL_COLUMNS)
 
-        # query funding by recipient, including "carry over" from previous years
-        funding_by_recipient = fts_queries.fetch_funding_json_for_appeal_as_dataframe(
-            appeal_id, grouping='Recipient', alias='organisation')
+    # first check if there is any funding at all (otherwise API calls will get upset)
+    funded_appeals = [(appeal_id, appeal_row['year']) for appeal_id, appeal_row in appeals.iterrows()
+                      if appeal_row['funding'] != 0]
 
-        funding_by_recipient['year'] = appeal_row['year']
+    # query funding by recipient, including "carry over" from previous years, for all appeals at once
+    funding_records_by_appeal = fts_queries.fetch_many(
+        [(fts_queries.fetch_funding_json_for_appeal_as_records, appeal_id, 'Recipient')
+         for appeal_id, year in funded_appeals])
 
-        funding_dataframes_by_appeal.append(funding_by_recipient)
-
-    if funding_dataframes_by_appeal:
+    if funding_records_by_appeal:
         # combine the data across appeals
-        funding_by_recipient_overall = pd.concat(funding_dataframes_by_appeal)
+        funding_by_recipient_overall = _stack_funding_by_recipient(
+            funding_records_by_appeal, year=[year for appeal_id, year in funded_appeals])
         # now roll up by organization type and year
-        grouped = funding_by_recipient_overall.join(organizations.type).groupby(['type', 'year'])
-        funding_by_type_year = grouped.funding.sum()
+        funding_by_type_year = sum_funding_by_organization_type(
+            funding_by_recipient_overall, organizations, ['type', 'year'])
     else:
         funding_by_type_year = pd.Series()  # just an empty Series
 
+    add_organization_level_rows(country, funding_by_type_year)
+
+
+def add_organization_level_rows(country, funding_by_type_year):
+    """
+    Record FY190, FY200, FY210 given appeal funding summed by organization type and year
+    """
     for year in range(YEAR_START, YEAR_END + 1):
         ngo_funding = 0.
         private_org_funding = 0.
@@ -272,38 +553,7 @@ def populate_pooled_fund_data(country):
     """
     Populate data on pooled funds (CERF, ERF, CHF)
     """
-    emergencies = fts_queries.fetch_emergencies_json_for_country_as_dataframe(country)
-
-    contribution_dataframes_by_emergency = []
-
-    for emergency_id, emergency_row in emergencies.iterrows():
-        contributions = fts_queries.fetch_contributions_json_for_emergency_as_dataframe(emergency_id)
-
-        if contributions.empty:
-            continue
-
-        # note that is_allocation field on contributions is much cleaner and _almost_ gives the same answer,
-        # but found 1 instance of contribution that did not have this field set and yet looked like it should
-
-        # exclude pledges
-        contributions = contributions[contributions.status != FUNDING_STATUS_PLEDGE]
-
-        # exclude non-CERF/ERF/CHF
-        donor_filter = lambda x: x in POOLED_FUNDS
-        contributions = contributions[contributions.donor.apply(donor_filter)]
-
-        if contributions.empty:
-            continue  # if not excluded, can mess up concat
-
-        contribution_dataframes_by_emergency.append(contributions)
-
-    if contribution_dataframes_by_emergency:
-        # combine the data across emergencies
-        contributions_overall = pd.concat(contribution_dataframes_by_emergency)
-        # sum amount by donor-year
-        amount_by_donor_year = contributions_overall.groupby(['donor', 'year']).amount.sum()
-    else:
-        amount_by_donor_year = pd.Series()  # empty Series
+    amount_by_donor_year = POOLED_FUND_CONTRIBUTIONS.get_amount_by_donor_year(country)
 
     for year in range(YEAR_START, YEAR_END + 1):
         # note that 'global_allocations' is close to FTS report numbers but not always exactly the same
@@ -350,27 +600,709 @@ def populate_pooled_fund_data(country):
         add_row_to_values('FY630', country, year, country_funding)
 
 
-def populate_data_for_regions(region_list):
+APPEAL_AMOUNT_COLUMNS = ['original_requirements', 'current_requirements', 'funding']
+
+
+def _categories_as_objects(dataframe):
     """
-    Populate the various FTS data tuples for a list of regions
+    Copy of the dataframe with its categorical columns as object columns
     """
-    # cache organizations as it's an expensive call
-    organizations = get_organizations_indexed_by_name()
+    dataframe = dataframe.copy()
+    for column_name in dataframe.columns:
+        if dataframe[column_name].dtype.name == 'category':
+            dataframe[column_name] = dataframe[column_name].astype(object)
+    return dataframe
 
-    for region in region_list:
-        print "Populating indicators for region", region
-        populate_appeals_level_data(region)
-        populate_organization_level_data(region, organizations)
-        populate_pooled_fund_data(region)
+
+def fetch_appeals_for_all_years():
+    """
+    Bulk alternative to fetching appeals country by country: fetches the appeals for each year once,
+    and adds a 'country_code' column with the ISO code of each appeal's country.
+    Appeals for countries not in the FTS country list get a null country_code.
+    """
+    appeals_by_year = fts_queries.fetch_many(
+        [(fts_queries.fetch_appeals_json_for_year_as_dataframe, year, APPEAL_COLUMNS)
+         for year in range(YEAR_START, YEAR_END + 1)])
+    appeals_by_year = [appeals for appeals in appeals_by_year if not appeals.empty]
+
+    if not appeals_by_year:
+        return pd.DataFrame(columns=['country_code', 'type', 'year'] + APPEAL_AMOUNT_COLUMNS)
+
+    # the categories of the country and type columns differ from year to year, which pandas before 0.19 can't
+    # concatenate, so concatenate them as plain objects
+    appeals_by_year = [_categories_as_objects(appeals) for appeals in appeals_by_year]
+    # sort by id, which is the order appeals are listed per country, so sums add up in the same order
+    appeals = pd.concat(appeals_by_year).sort_index()
+    appeals['country_code'] = appeals.country.astype(object).map(COUNTRY_FUNDING_CACHE.get_country_codes_by_name())
+    return appeals
+
+
+def _select_country(grouped, country):
+    """
+    Slice the data for one country out of something grouped by country code first, dropping that index level
+    """
+    if grouped.empty or country not in grouped.index.get_level_values('country_code'):
+        return grouped.iloc[0:0]
+    return grouped.xs(country, level='country_code')
+
+
+def get_appeal_sums_by_country_and_year(appeals):
+    """
+    Sum appeal amounts for all countries in one pass, for all appeals and CAP appeals.
+    Returns two frames indexed by (country_code, year).
+    """
+    cross_appeals = appeals.groupby(['country_code', 'year'])[APPEAL_AMOUNT_COLUMNS].sum().astype(float)
+    cap_appeals = appeals[appeals.type == 'CAP'].groupby(['country_code', 'year'])[APPEAL_AMOUNT_COLUMNS].sum()
+    return cross_appeals, cap_appeals.astype(float)
+
+
+def get_funding_by_country_type_and_year(appeals, organizations, region_list):
+    """
+    Bulk version of the funding rollup in populate_organization_level_data.
+    The FTS funding grouping only accepts a single filter, so the recipients still have to be fetched per appeal,
+    but all appeals of all regions are fetched in one concurrent batch and rolled up in one pass.
+    Returns a series indexed by (country_code, type, year).
+    """
+    # first check if there is any funding at all (otherwise API calls will get upset)
+    funded_appeals = appeals[(appeals.funding != 0) & appeals.country_code.isin(list(region_list))]
+
+    funding_records_by_appeal = fts_queries.fetch_many(
+        [(fts_queries.fetch_funding_json_for_appeal_as_records, appeal_id, 'Recipient')
+         for appeal_id in funded_appeals.index])
+
+    if not funding_records_by_appeal:
+        return pd.Series()
+
+    funding_by_recipient_overall = _stack_funding_by_recipient(
+        funding_records_by_appeal, year=funded_appeals.year.values, country_code=funded_appeals.country_code.values)
+    return sum_funding_by_organization_type(
+        funding_by_recipient_overall, organizations, ['country_code', 'type', 'year'])
+
+
+def _bind_year(function, year):
+    return lambda: function(year)
+
+
+# shards per worker process, more than one so that a few slow regions don't hold up a whole worker
+SHARDS_PER_PROCESS = 4
+# seconds to wait before asking the job queue again while other workers finish the last jobs
+QUEUE_POLL_SECONDS = 5
+
+# reference data loaded by the parent before forking the worker processes, see populate_data_for_regions
+_SHARED_DATA = None
+
+
+def populate_region(region, organizations, bulk_sums=None):
+    """
+    Populate the FTS data tuples for one region, given the organization index and,
+    in bulk mode, the (cross appeal, CAP appeal, funding by type) sums for all regions
+    """
+    print "Populating indicators for region", region
+    with instrumentation.stage('populate_region', region):
+        if bulk_sums is not None:
+            cross_appeals, cap_appeals, funding_by_country_type_year = bulk_sums
+            with instrumentation.stage('add_appeals_level_rows', region):
+                add_appeals_level_rows(
+                    region, _select_country(cross_appeals, region), _select_country(cap_appeals, region))
+            with instrumentation.stage('add_organization_level_rows', region):
+                add_organization_level_rows(region, _select_country(funding_by_country_type_year, region))
+        else:
+            with instrumentation.stage('populate_appeals_level_data', region):
+                populate_appeals_level_data(region)
+            with instrumentation.stage('populate_organization_level_data', region):
+                populate_organization_level_data(region, organizations)
+        with instrumentation.stage('populate_pooled_fund_data', region):
+            populate_pooled_fund_data(region)
+
+
+def populate_region_with_checkpoint(region, organizations, bulk_sums, store, still_leased=None):
+    """
+    Populate one region, saving its rows to the checkpoint store, or marking it as failed there if a request failed.
+    The rows are not kept in VALUES, populate_data_for_regions takes them from the store once all regions are done.
+    When the region is a job of a job queue, still_leased is called before touching the store, and if it returns
+    False (the lease ran out, so the job may be another worker's by now) nothing is saved and None is returned.
+    """
+    start = len(VALUES)
+    try:
+        populate_region(region, organizations, bulk_sums)
+        rows = [(indicator, year, value) for indicator, _, year, value in VALUES.iter_rows(start)]
+        if still_leased is not None and not still_leased():
+            print "Lost the lease of region", region, "so leaving it to the worker that took it over"
+            return None
+        store.save_region(region, rows)
+        return True
+    except fts_http.REQUEST_ERRORS as e:
+        # requests have already been retried by then, so leave this region for a later --resume (anything else is a
+        # bug, which is left to stop the run)
+        print "Failed to populate region", region, repr(e)
+        if still_leased is not None and not still_leased():
+            return None
+        store.mark_failed(region, repr(e))
+        return False
+    finally:
+        VALUES.truncate(start)
+
+
+class RegionStreamer(object):
+    """
+    Passes the rows of each region on to a value_sinks.SinkPipeline as one batch, in region order: a region is passed
+    on as soon as it and all the regions before it are done, so the output is the same as writing VALUES at the end.
+    """
+    def __init__(self, regions, pipeline, checkpoint_store=None):
+        self.regions = list(regions)
+        self.pipeline = pipeline
+        self.checkpoint_store = checkpoint_store
+        self.position = 0
+        self.ready_rows_by_region = {}
+
+    def region_done(self, region, rows=None):
+        """
+        Call once a region is done, with its (indicator, region, year, value) rows, or None if they are in the
+        checkpoint store
+        """
+        self.ready_rows_by_region[region] = rows
+        while self.position < len(self.regions) and self.regions[self.position] in self.ready_rows_by_region:
+            next_region = self.regions[self.position]
+            rows = self.ready_rows_by_region.pop(next_region)
+            if rows is None:
+                rows = [(indicator, next_region, year, value)
+                        for indicator, year, value in self.checkpoint_store.load_rows(next_region)]
+            if rows:
+                self.pipeline.put(export_values(pd.DataFrame(rows, columns=['indicator', 'region', 'year', 'value'])))
+            self.position += 1
+
+    def regions_done_in_store(self):
+        """
+        Call region_done for the regions done in the checkpoint store since the last call, e.g. by the workers of a
+        job queue
+        """
+        done_regions = self.checkpoint_store.get_done_regions()
+        newly_done_regions = [region for region in self.regions[self.position:]
+                              if region in done_regions and region not in self.ready_rows_by_region]
+        for region in newly_done_regions:
+            self.region_done(region)
+
+
+def _rows_by_region(buffer):
+    rows_by_region = {}
+    for row in buffer.iter_rows():
+        rows_by_region.setdefault(row[1], []).append(row)
+    return rows_by_region
+
+
+def _split_into_shards(region_list, shard_count):
+    """
+    Split the regions into at most shard_count contiguous runs, so that merging the shards in order keeps the
+    regions in their original order
+    """
+    shard_size = -(-len(region_list) // shard_count)  # rounded up
+    return [region_list[start:start + shard_size] for start in range(0, len(region_list), shard_size)]
+
+
+def _init_worker(process_count):
+    fts_queries.reset_after_fork(process_count)
+    # rows and measurements recorded by the parent before forking belong to the parent
+    VALUES.clear()
+    instrumentation.take_records()
+
+
+def _populate_shard(shard):
+    """
+    Runs in a worker process: populate the regions of one shard and write their rows to the shard file.
+    Returns the shard filename and the instrumentation records of the shard.
+    """
+    regions, filename = shard
+    organizations, bulk_sums, store, _ = _SHARED_DATA
+    VALUES.clear()
+    for region in regions:
+        if store is not None:
+            populate_region_with_checkpoint(region, organizations, bulk_sums, store)
+        else:
+            populate_region(region, organizations, bulk_sums)
+    VALUES.save(filename)
+    return filename, instrumentation.take_records()
+
+
+def _populate_regions_in_processes(region_list, process_count, streamer=None):
+    """
+    Fan the regions out to a pool of worker processes, each writing its rows to a shard file,
+    then merge the shards into VALUES in region order, so the result is the same as populating them one by one.
+    With a RegionStreamer, the regions of each shard are passed on to it as soon as the shard is done instead.
+    """
+    shard_dir = tempfile.mkdtemp(prefix='fts_shards_')
+    try:
+        shards = [(regions, os.path.join(shard_dir, 'shard_{:05d}.npz'.format(number)))
+                  for number, regions in enumerate(_split_into_shards(region_list, process_count * SHARDS_PER_PROCESS))]
+
+        # the workers are forked, so they share the reference data already loaded by this process
+        pool = multiprocessing.Pool(process_count, initializer=_init_worker, initargs=(process_count,))
+        try:
+            if streamer is not None:
+                # shards come back in order, so the regions are streamed in order too
+                for (regions, _), (filename, records) in zip(shards, pool.imap(_populate_shard, shards, chunksize=1)):
+                    _stream_shard(streamer, regions, filename)
+                    instrumentation.add_records(records)
+                return
+            shard_results = pool.map(_populate_shard, shards, chunksize=1)
+        finally:
+            pool.terminate()
+            pool.join()
+
+        with instrumentation.stage('merge_shards'):
+            for filename, records in shard_results:
+                VALUES.extend_from_file(filename)
+                instrumentation.add_records(records)
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+
+
+def _stream_shard(streamer, regions, filename):
+    """
+    Pass the regions of a shard written by _populate_shard on to the streamer
+    """
+    if streamer.checkpoint_store is not None:
+        done_regions = streamer.checkpoint_store.get_done_regions()
+        for region in regions:
+            if region in done_regions:
+                streamer.region_done(region)
+        return
+
+    shard_values = indicator_buffer.IndicatorValueBuffer()
+    shard_values.extend_from_file(filename)
+    rows_by_region = _rows_by_region(shard_values)
+    for region in regions:
+        streamer.region_done(region, rows_by_region.get(region, []))
+
+
+def _work_job_queue(jobs, organizations, bulk_sums, store, on_progress=None):
+    """
+    Lease regions from the job queue and populate them, saving them to the checkpoint store, until every job is
+    finished, including those of other workers (whose leases may run out).
+    on_progress is called after each job and while waiting for the jobs of other workers.
+    """
+    worker = job_queue.worker_name()
+    while True:
+        if on_progress is not None:
+            on_progress()
+        region = jobs.lease(worker)
+        if region is None:
+            if not jobs.has_unfinished_jobs():
+                return
+            time.sleep(QUEUE_POLL_SECONDS)
+            continue
+        started = time.time()
+        with jobs.keep_leased(region, worker) as lease:
+            # renewing the lease right before saving leaves the whole lease for the save
+            done = populate_region_with_checkpoint(region, organizations, bulk_sums, store,
+                                                   lambda: not lease.lost and jobs.renew(region, worker))
+        if done is None:
+            continue
+        if done:
+            jobs.complete(region, worker, time.time() - started)
+        else:
+            jobs.fail(region, worker, store.get_failed_regions().get(region))
+
+
+def _work_job_queue_in_process(_):
+    """
+    Runs in a worker process: work on the jobs of the queue, returning the instrumentation records
+    """
+    organizations, bulk_sums, store, jobs = _SHARED_DATA
+    VALUES.clear()
+    _work_job_queue(jobs, organizations, bulk_sums, store)
+    return instrumentation.take_records()
+
+
+def _work_job_queue_in_processes(jobs, organizations, bulk_sums, store, process_count, on_progress=None):
+    """
+    Work on the jobs of the queue in process_count processes, calling on_progress every QUEUE_POLL_SECONDS
+    (see _work_job_queue)
+    """
+    global _SHARED_DATA
+    if process_count <= 1:
+        _work_job_queue(jobs, organizations, bulk_sums, store, on_progress)
+        return
+
+    _SHARED_DATA = (organizations, bulk_sums, store, jobs)
+    try:
+        pool = multiprocessing.Pool(process_count, initializer=_init_worker, initargs=(process_count,))
+        try:
+            result = pool.map_async(_work_job_queue_in_process, range(process_count), chunksize=1)
+            while not result.ready():
+                result.wait(QUEUE_POLL_SECONDS)
+                if on_progress is not None:
+                    on_progress()
+            for records in result.get():
+                instrumentation.add_records(records)
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        _SHARED_DATA = None
+
+
+def _load_shared_data(region_list, bulk, reference_dir):
+    """
+    Load the data shared by all regions, returning the organizations and, in bulk mode, the appeal sums
+    """
+    # organizations and the global per-year data are expensive calls, so load them once for all regions
+    with instrumentation.stage('load_reference_data'):
+        organizations = load_reference_data(reference_dir)
+
+    # fetch the contributions of every emergency once, shared by all regions
+    with instrumentation.stage('load_pooled_fund_contributions'):
+        POOLED_FUND_CONTRIBUTIONS.load_countries(region_list)
+
+    bulk_sums = None
+    if bulk:
+        with instrumentation.stage('bulk_appeal_sums'):
+            appeals = fetch_appeals_for_all_years()
+            cross_appeals, cap_appeals = get_appeal_sums_by_country_and_year(appeals)
+            funding_by_country_type_year = get_funding_by_country_type_and_year(appeals, organizations, region_list)
+            bulk_sums = (cross_appeals, cap_appeals, funding_by_country_type_year)
+    return organizations, bulk_sums
+
+
+def work_job_queue(jobs, checkpoint_store, bulk=False, processes=1, reference_dir=None):
+    """
+    Help a run of populate_data_for_regions with a job queue, e.g. on another host sharing the queue and checkpoint
+    files: work on the jobs of the queue until every job is finished. The rows are only saved to the checkpoint
+    store, the run that enqueued the jobs writes them out. Unless the jobs of a run were picked already (see
+    job_queue.JobQueue.wait_for_run), waits for a run to be going first.
+    """
+    if jobs.run_id is None:
+        jobs.wait_for_run(QUEUE_POLL_SECONDS)
+    region_list = jobs.get_regions()
+    organizations, bulk_sums = _load_shared_data(region_list, bulk, reference_dir)
+    with instrumentation.stage('work_job_queue'):
+        _work_job_queue_in_processes(jobs, organizations, bulk_sums, checkpoint_store, processes)
+
+
+def populate_data_for_regions(region_list, bulk=False, processes=1, checkpoint_store=None, reference_dir=None,
+                              pipeline=None, jobs=None):
+    """
+    Populate the various FTS data tuples for a list of regions.
+    In bulk mode, appeals are fetched once per year for all regions instead of once per region,
+    and the appeal-derived indicators are computed for all regions in one grouped pass.
+    With more than one process, the regions are populated by a pool of worker processes, sharing the reference data
+    (organizations, global pooled fund and country funding by year, pooled fund contributions) loaded here first.
+    With a checkpoint_store (a checkpoint.CheckpointStore), regions already done in the store are skipped, each other
+    region is saved to the store as soon as it is done, and a region that fails doesn't stop the others.
+    Once all regions have been attempted, RegionsFailedError is raised if any failed,
+    otherwise the rows of all regions are added to VALUES.
+    With a reference_dir, the reference data is kept there as a snapshot between runs, see load_reference_data.
+    With a pipeline (a value_sinks.SinkPipeline), the rows of each region are passed on to the pipeline, in region
+    order, as the regions are done, rather than added to VALUES; only a region's worth of rows is held at a time.
+    With a job queue (a job_queue.JobQueue, which needs a checkpoint_store to keep the rows), the regions are enqueued
+    as jobs and populated most costly first by the worker processes, and by any other workers sharing the queue
+    (see work_job_queue).
+    """
+    global _SHARED_DATA
+    if jobs is not None and checkpoint_store is None:
+        raise ValueError("A job queue needs a checkpoint store to keep the rows of the regions")
+    all_regions = list(region_list)
+    region_list = all_regions
+    streamer = RegionStreamer(all_regions, pipeline, checkpoint_store) if pipeline is not None else None
+    if checkpoint_store is not None:
+        done_regions = checkpoint_store.get_done_regions()
+        region_list = [region for region in all_regions if region not in done_regions]
+        print "Checkpoint has", len(all_regions) - len(region_list), "of", len(all_regions), "regions done already"
+        if streamer is not None:
+            for region in all_regions:
+                if region in done_regions:
+                    streamer.region_done(region)
+
+    organizations, bulk_sums = _load_shared_data(region_list, bulk, reference_dir)
+
+    if jobs is not None:
+        jobs.enqueue(region_list)
+        try:
+            # regions are streamed as their jobs are done, by whichever worker
+            _work_job_queue_in_processes(jobs, organizations, bulk_sums, checkpoint_store, processes,
+                                         streamer.regions_done_in_store if streamer is not None else None)
+        finally:
+            jobs.finish_run()
+        # regions given up on by the queue, after their leases ran out too many times
+        finished_regions = checkpoint_store.get_done_regions() | set(checkpoint_store.get_failed_regions())
+        for region, error in jobs.get_failed_jobs().items():
+            if region not in finished_regions:
+                checkpoint_store.mark_failed(region, error)
+        if streamer is not None:
+            streamer.regions_done_in_store()
+    elif processes > 1 and len(region_list) > 1:
+        _SHARED_DATA = (organizations, bulk_sums, checkpoint_store, None)
+        try:
+            _populate_regions_in_processes(region_list, processes, streamer)
+        finally:
+            _SHARED_DATA = None
+    else:
+        for region in region_list:
+            if checkpoint_store is not None:
+                if populate_region_with_checkpoint(region, organizations, bulk_sums, checkpoint_store) and\
+                        streamer is not None:
+                    streamer.region_done(region)
+            elif streamer is not None:
+                start = len(VALUES)
+                populate_region(region, organizations, bulk_sums)
+                streamer.region_done(region, list(VALUES.iter_rows(start)))
+                VALUES.truncate(start)
+            else:
+                populate_region(region, organizations, bulk_sums)
+
+    if checkpoint_store is not None:
+        failed_regions = dict((region, error) for region, error in checkpoint_store.get_failed_regions().items()
+                              if region in all_regions)
+        if failed_regions:
+            raise RegionsFailedError(failed_regions)
+        if streamer is not None:
+            return
+        for region in all_regions:
+            for indicator, year, value in checkpoint_store.load_rows(region):
+                VALUES.append(indicator, region, year, value)
+
+
+def fingerprint_upstream_data(region_list):
+    """
+    Fingerprint the upstream responses the indicators depend on, by (region, endpoint):
+     - for each region, its appeals and emergencies (these include the funding totals of each appeal and emergency,
+       so new funding of an appeal or emergency shows up here too)
+     - globally, the countries and organizations, and worldwide funding by donor and by country for each year
+    Changes that leave those totals as they are, e.g. funding moved from one type of recipient to another or a
+    pooled fund contribution changing donor or status, don't show up; refresh_data_for_regions catches up with
+    those by recomputing everything every so often.
+    The responses are fetched from FTS rather than through the global caches, which may hold them already or take
+    them from a reference snapshot.
+    """
+    region_list = list(region_list)
+    years = range(YEAR_START, YEAR_END + 1)
+
+    keys = [(region, 'appeals') for region in region_list] + [(region, 'emergencies') for region in region_list]
+    calls = [(fts_queries.fetch_appeals_json_for_country_as_dataframe, region, APPEAL_COLUMNS)
+             for region in region_list] +\
+            [(fts_queries.fetch_emergencies_json_for_country_as_dataframe, region, EMERGENCY_COLUMNS)
+             for region in region_list]
+
+    keys += [(incremental.GLOBAL_REGION, 'countries'), (incremental.GLOBAL_REGION, 'organizations')]
+    calls += [(fts_queries.fetch_countries_json_as_dataframe, COUNTRY_COLUMNS),
+              (fts_queries.fetch_organizations_json_as_dataframe, ORGANIZATION_COLUMNS)]
+
+    keys += [(incremental.GLOBAL_REGION, 'funding-by-donor/{}'.format(year)) for year in years]
+    calls += [(fts_queries.fetch_funding_json_for_year_as_dataframe, year, 'donor', 'organization') for year in years]
+    keys += [(incremental.GLOBAL_REGION, 'funding-by-country/{}'.format(year)) for year in years]
+    calls += [(fts_queries.fetch_funding_json_for_year_as_dataframe, year, 'country', 'country') for year in years]
+
+    fingerprinter = incremental.ResponseFingerprinter()
+    fts_queries.add_response_listener(fingerprinter)
+    try:
+        digests = fts_queries.fetch_many([(fingerprinter.fingerprint,) + call for call in calls])
+    finally:
+        fts_queries.remove_response_listener(fingerprinter)
+
+    return dict(zip(keys, digests))
+
+
+def merge_unchanged_regions(region_list, changed_regions, filename):
+    """
+    Put the rows of the regions that were not recomputed back into VALUES, from the file written by the previous
+    refresh, and write the result to that file for the next one.
+    The regions end up in the same order as when populating them all, so VALUES is then what a full run produces.
+    """
+    previous = indicator_buffer.IndicatorValueBuffer()
+    # missing only when all regions were recomputed
+    if os.path.exists(filename):
+        previous.extend_from_file(filename)
+
+    merged = indicator_buffer.IndicatorValueBuffer()
+    changed_regions = set(changed_regions)
+    for recomputed, regions in itertools.groupby(region_list, lambda region: region in changed_regions):
+        merged.extend_with_regions(VALUES if recomputed else previous, list(regions))
+
+    # written next to the file and moved in place, so an interrupted write leaves the previous file as it was
+    temporary_filename = filename + '.tmp.npz'
+    merged.save(temporary_filename)
+    os.rename(temporary_filename, filename)
+    VALUES.clear()
+    VALUES.extend(merged.get_rows(), merged.indicators.names, merged.regions.names)
+
+
+def refresh_data_for_regions(region_list, sql_dir, bulk=False, processes=1, checkpoint_store=None,
+                             reference_dir=None, jobs=None, full_refresh_days=FULL_REFRESH_DAYS):
+    """
+    Incremental alternative to populate_data_for_regions followed by write_values_as_scraperwiki_style_sql:
+    only the (region, year) partitions whose upstream data changed since the previous refresh are recomputed,
+    and written into the existing value table in place of the old rows.
+    Not every change shows up in the fingerprints (see fingerprint_upstream_data), so if the last full refresh is
+    more than full_refresh_days old, everything is recomputed.
+    Afterwards VALUES holds the values of all the regions, as after populate_data_for_regions, ready to be written
+    as CSV.
+    """
+    region_list = list(region_list)
+    all_years = range(YEAR_START, YEAR_END + 1)
+
+    store = incremental.FingerprintStore(os.path.join(sql_dir, FINGERPRINTS_FILENAME))
+    last_full_refresh = store.get_last_full_refresh()
+    values_filename = os.path.join(sql_dir, REFRESH_VALUES_FILENAME)
+    # without an existing table (or the values of the regions left as they are), everything has to be computed
+    full_refresh = not value_table_exists(sql_dir) or not os.path.exists(values_filename) or\
+        last_full_refresh is None or time.time() - last_full_refresh > full_refresh_days * 24 * 60 * 60
+    if full_refresh:
+        print "Full refresh, recomputing all regions"
+    old_digests = {} if full_refresh else store.get_all()
+    with instrumentation.stage('fingerprint_upstream_data'):
+        new_digests = fingerprint_upstream_data(region_list)
+
+    endpoint_years = {}
+    for year in all_years:
+        endpoint_years['funding-by-donor/{}'.format(year)] = [year]
+        endpoint_years['funding-by-country/{}'.format(year)] = [year]
+
+    partitions = incremental.find_changed_partitions(old_digests, new_digests, endpoint_years, all_years)
+    changed_regions = [region for region in region_list if incremental.years_for_region(partitions, region)]
+    print "Upstream data changed for", len(changed_regions), "of", len(region_list), "regions"
+
+    if changed_regions:
+        with instrumentation.stage('populate_data_for_regions'):
+            populate_data_for_regions(changed_regions, bulk, processes, checkpoint_store, reference_dir, jobs=jobs)
+        if old_digests:
+            with instrumentation.stage('write_changed_partitions_sql'):
+                values, replaced_partitions = incremental.select_partitions(get_values_for_export(), partitions)
+                orm.bulk_save_values(values.itertuples(index=False), os.path.join(sql_dir, SQL_FILENAME),
+                                     replace_all=False, replace_partitions=replaced_partitions)
+            print "Updated", len(values), "values"
+        else:
+            with instrumentation.stage('write_values_as_scraperwiki_style_sql'):
+                write_values_as_scraperwiki_style_sql(sql_dir)
+
+    with instrumentation.stage('merge_unchanged_regions'):
+        merge_unchanged_regions(region_list, changed_regions, values_filename)
+    store.save(new_digests, full_refresh)
+    store.close()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--bulk', action='store_true',
+                        help='fetch appeals once per year rather than once per country (same output, fewer calls)')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='populate regions in this many worker processes (same output)')
+    parser.add_argument('--cache-dir', help='keep FTS responses in this directory between runs')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only recompute regions and years whose FTS data changed since the last refresh, '
+                             'and update the existing value table in place')
+    parser.add_argument('--full-refresh-days', type=int, default=FULL_REFRESH_DAYS,
+                        help='with --incremental, recompute everything when the last full refresh is older than '
+                             'this many days')
+    parser.add_argument('--reference-dir',
+                        help='keep snapshots of the global reference data in this directory, reusing the one '
+                             'fetched today')
+    parser.add_argument('--stream', action='store_true',
+                        help='write the rows of each region as soon as it is done rather than holding all of them '
+                             'until the end (same output, bounded memory)')
+    parser.add_argument('--queue', metavar='FILE',
+                        help='share the regions out through a job queue in this file, most costly first by the time '
+                             'they took in previous runs; other hosts can help with --worker')
+    parser.add_argument('--worker', action='store_true',
+                        help='only work on the jobs of the --queue of a run started elsewhere, sharing its checkpoint')
+    parser.add_argument('--resume', action='store_true',
+                        help='carry on from the checkpoint of a failed run: regions already done are not recomputed')
+    parser.add_argument('--retries', type=int, default=fts_http.DEFAULT_MAX_RETRIES,
+                        help='retries of each FTS request on transient failures, with exponential backoff')
+    parser.add_argument('--record', metavar='ARCHIVE', help='capture every FTS response into this fixture archive')
+    parser.add_argument('--replay', metavar='ARCHIVE', help='serve FTS responses from this fixture archive')
+    parser.add_argument('--replay-latency', type=float, default=0., help='seconds of latency added in replay mode')
+    parser.add_argument('--replay-bandwidth', type=int, help='bytes per second per response in replay mode')
+    parser.add_argument('--report', metavar='FILE',
+                        help='write a JSON report of request and stage timings, see instrumentation')
+    parser.add_argument('--profile', metavar='FILE', help='run under cProfile and write the stats to this file')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='trace Python memory allocations for the report (needs tracemalloc)')
+    args = parser.parse_args()
+    if args.record and args.processes > 1:
+        parser.error('--record needs all responses to be fetched in one process, use --processes 1')
+    if args.replay and args.reference_dir:
+        parser.error('--reference-dir would keep the reference data of the replayed responses, it can\'t be combined '
+                     'with --replay')
+    if args.worker and not args.queue:
+        parser.error('--worker needs the --queue of the run to help')
+    if args.stream and args.incremental:
+        parser.error('--incremental updates the existing value table in place, it can\'t be combined with --stream')
+
+    if args.profile:
+        instrumentation.start_profiling()
+    if args.trace_memory and not instrumentation.start_memory_tracing():
+        print "tracemalloc is not available, memory allocations will not be traced"
+
+    fts_http.configure(max_retries=args.retries)
+
+    # each region is checkpointed as soon as it is done, so a failed run can be resumed
+    checkpoint_store = checkpoint.CheckpointStore(os.path.join(SQL_OUTPUT_DIR, CHECKPOINT_FILENAME))
+    if not args.resume and not args.worker:
+        checkpoint_store.reset()
+    jobs = job_queue.JobQueue(os.path.expanduser(args.queue)) if args.queue else None
+
+    if args.replay:
+        replay_server = fts_replay.start_replay_server(
+            args.replay, latency=args.replay_latency, bandwidth=args.replay_bandwidth)
+        fts_queries.FTS_BASE_URL = replay_server.base_url
+    if args.cache_dir:
+        fts_queries.enable_cache(os.path.expanduser(args.cache_dir))
+    reference_dir = os.path.expanduser(args.reference_dir) if args.reference_dir else None
+    if args.record:
+        fts_queries.start_recording(args.record)
+
     # regions_of_interest = ['COL', 'KEN', 'YEM']
     # regions_of_interest = ['SSD']  # useful for testing CHF
     # regions_of_interest = ['AFG']  # useful for testing spotty data
-    regions_of_interest = fts_queries.fetch_countries_json_as_dataframe().iso_code_A
-
-    populate_data_for_regions(regions_of_interest)
-
-    write_values_as_scraperwiki_style_csv('/tmp')
-    write_values_as_scraperwiki_style_sql('/home/')
+    if args.worker:
+        # the regions are those enqueued by the run being helped, which may not have enqueued them yet
+        print "Waiting for a run to help in", args.queue
+        jobs.wait_for_run(QUEUE_POLL_SECONDS)
+        regions_of_interest = jobs.get_regions()
+    else:
+        regions_of_interest = fts_queries.fetch_countries_json_as_dataframe(COUNTRY_COLUMNS).iso_code_A
+
+    if args.worker:
+        work_job_queue(jobs, checkpoint_store, bulk=args.bulk, processes=args.processes, reference_dir=reference_dir)
+        fts_queries.stop_recording()
+    elif args.incremental:
+        refresh_data_for_regions(regions_of_interest, SQL_OUTPUT_DIR, bulk=args.bulk, processes=args.processes,
+                                 checkpoint_store=checkpoint_store, reference_dir=reference_dir, jobs=jobs,
+                                 full_refresh_days=args.full_refresh_days)
+        fts_queries.stop_recording()
+        with instrumentation.stage('write_values_as_scraperwiki_style_csv'):
+            write_values_as_scraperwiki_style_csv(CSV_OUTPUT_DIR)
+    elif args.stream:
+        pipeline = value_sinks.SinkPipeline([value_sinks.CsvValueSink(os.path.join(CSV_OUTPUT_DIR, 'value.csv')),
+                                             value_sinks.SqlValueSink(os.path.join(SQL_OUTPUT_DIR, SQL_FILENAME))])
+        try:
+            with instrumentation.stage('populate_data_for_regions'):
+                populate_data_for_regions(regions_of_interest, bulk=args.bulk, processes=args.processes,
+                                          checkpoint_store=checkpoint_store, reference_dir=reference_dir,
+                                          pipeline=pipeline, jobs=jobs)
+        except:
+            pipeline.abort()
+            raise
+        fts_queries.stop_recording()
+        with instrumentation.stage('close_value_sinks'):
+            pipeline.close()
+    else:
+        with instrumentation.stage('populate_data_for_regions'):
+            populate_data_for_regions(regions_of_interest, bulk=args.bulk, processes=args.processes,
+                                      checkpoint_store=checkpoint_store, reference_dir=reference_dir, jobs=jobs)
+        fts_queries.stop_recording()
+        with instrumentation.stage('write_values_as_scraperwiki_style_csv'):
+            write_values_as_scraperwiki_style_csv(CSV_OUTPUT_DIR)
+        with instrumentation.stage('write_values_as_scraperwiki_style_sql'):
+            write_values_as_scraperwiki_style_sql(SQL_OUTPUT_DIR)
+
+    # all written, the next run starts afresh (a worker leaves that to the run it helped)
+    if not args.worker:
+        checkpoint_store.reset()
+
+    if args.profile:
+        instrumentation.stop_profiling(args.profile)
+    if args.report:
+        value_count = pipeline.row_count if args.stream else len(VALUES)
+        run_report = instrumentation.write_report(
+            args.report, extra={'options': vars(args), 'regions': len(regions_of_interest), 'values': value_count})
+        instrumentation.print_summary(run_report)
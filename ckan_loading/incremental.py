@@ -0,0 +1,115 @@
+"""
+Support for incremental refreshes: only recompute the (region, year) partitions whose upstream FTS data changed.
+
+Each upstream response is fingerprinted (a SHA-1 of its raw body) per (region, endpoint), and the fingerprints of
+the previous run are kept in a small SQLite file. Comparing the two tells us which partitions are affected, and only
+those are recomputed and written back into the existing "value" table (see orm.bulk_save_values).
+
+The fingerprinted responses don't cover everything the indicators depend on (see
+generate_chd_indicators.fingerprint_upstream_data), so the time of the last full refresh is kept too, for the caller
+to recompute everything every so often.
+"""
+
+import hashlib
+import sqlite3
+import threading
+import time
+
+GLOBAL_REGION = '*'  # region used for endpoints that are not specific to one region, e.g. worldwide funding by year
+
+
+class ResponseFingerprinter(object):
+    """
+    A response listener (see fts_queries.add_response_listener) which fingerprints the responses fetched while
+    calling a function. Captures are per thread, so fingerprint() can be used with fts_queries.fetch_many.
+    """
+    def __init__(self):
+        self.local = threading.local()
+
+    def __call__(self, url, body):
+        digests = getattr(self.local, 'digests', None)
+        if digests is not None:
+            digests.append(hashlib.sha1(body).hexdigest())
+
+    def fingerprint(self, function, *args):
+        """
+        Calls function(*args), returning a fingerprint of all the raw responses it fetched
+        """
+        self.local.digests = []
+        try:
+            function(*args)
+            return hashlib.sha1(''.join(self.local.digests)).hexdigest()
+        finally:
+            self.local.digests = None
+
+
+class FingerprintStore(object):
+    """
+    Fingerprints by (region, endpoint) from the previous run
+    """
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+        self.db.execute("create table if not exists fingerprint ("
+                        " region text not null, endpoint text not null, digest text not null,"
+                        " primary key (region, endpoint))")
+        self.db.execute("create table if not exists full_refresh (refreshed_at real not null)")
+        self.db.commit()
+
+    def get_all(self):
+        """
+        Returns a dict of (region, endpoint) -> digest
+        """
+        return dict(((region, endpoint), digest) for region, endpoint, digest
+                    in self.db.execute("select region, endpoint, digest from fingerprint"))
+
+    def get_last_full_refresh(self):
+        """
+        Time of the last full refresh, or None if there was none
+        """
+        return self.db.execute("select max(refreshed_at) from full_refresh").fetchone()[0]
+
+    def save(self, digests, full_refresh=False):
+        """
+        Store the given dict of (region, endpoint) -> digest, call once the affected partitions have been written.
+        With full_refresh, everything was recomputed rather than only the affected partitions.
+        """
+        with self.db:
+            self.db.executemany("insert or replace into fingerprint (region, endpoint, digest) values (?, ?, ?)",
+                                [(region, endpoint, digest) for (region, endpoint), digest in digests.items()])
+            if full_refresh:
+                self.db.execute("insert into full_refresh (refreshed_at) values (?)", (time.time(),))
+
+    def close(self):
+        self.db.close()
+
+
+def find_changed_partitions(old_digests, new_digests, endpoint_years, all_years):
+    """
+    Work out which (region, year) partitions need to be recomputed.
+    endpoint_years maps an endpoint to the years it feeds into, by default all years.
+    A change to a GLOBAL_REGION endpoint affects those years for every region.
+    Returns a dict of region -> set of years, where GLOBAL_REGION stands for all regions.
+    """
+    partitions = {}
+    for key, digest in new_digests.items():
+        if old_digests.get(key) == digest:
+            continue
+        region, endpoint = key
+        partitions.setdefault(region, set()).update(endpoint_years.get(endpoint, all_years))
+    return partitions
+
+
+def years_for_region(partitions, region):
+    return partitions.get(region, set()) | partitions.get(GLOBAL_REGION, set())
+
+
+def select_partitions(values, partitions):
+    """
+    Select the rows of a scraperwiki style value dataframe that belong to the affected partitions.
+    Returns the selected rows, plus the (dsID, region, period) keys of the affected partitions, whose existing rows
+    should be replaced by the selected ones.
+    """
+    keep = [year in years_for_region(partitions, region) for region, year in zip(values.region, values.period)]
+    replaced_partitions = [('fts', region, year) for region in sorted(set(values.region))
+                           for year in sorted(years_for_region(partitions, region))]
+    return values[keep], replaced_partitions
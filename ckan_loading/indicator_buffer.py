@@ -0,0 +1,174 @@
+"""
+Compact columnar storage for the (indicator, region, year, value) tuples produced by the indicator process.
+
+A full run produces well over 100k tuples, so rather than one Python object per tuple, indicator and region codes
+are interned to small integers and the tuples are kept in fixed size NumPy chunks, which are only turned into a
+dataframe once, when needed.
+
+A buffer can be saved to a shard file and merged into another buffer, which is how the results of worker processes
+are brought together (see generate_chd_indicators.populate_data_for_regions).
+"""
+
+import numpy as np
+import pandas as pd
+
+ROW_DTYPE = np.dtype([('indicator', np.int16), ('region', np.int32), ('year', np.int16), ('value', np.float64)])
+CHUNK_SIZE = 8192
+
+
+class _Interner(object):
+    """
+    Maps strings to small consecutive integer codes and back
+    """
+    def __init__(self):
+        self.code_by_name = {}
+        self.names = []
+
+    def code(self, name):
+        code = self.code_by_name.get(name)
+        if code is None:
+            code = self.code_by_name[name] = len(self.names)
+            self.names.append(name)
+        return code
+
+    def decode(self, codes):
+        return np.array(self.names, dtype=object).take(codes)
+
+
+class IndicatorValueBuffer(object):
+    """
+    Accumulates indicator tuples in chunks of typed arrays
+    """
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.indicators = _Interner()
+        self.regions = _Interner()
+        self.full_chunks = []
+        self.full_chunk_rows = 0
+        self.chunk = np.empty(chunk_size, dtype=ROW_DTYPE)
+        self.chunk_used = 0
+        self.dataframe = None  # built on demand, dropped whenever a row is added
+        # bumped whenever the rows change, so things built from them can tell they are out of date
+        self.generation = 0
+
+    def __len__(self):
+        return self.full_chunk_rows + self.chunk_used
+
+    def _close_chunk(self, *extra_chunks):
+        """
+        Move the rows of the current chunk (and any extra chunks of rows) to the full chunks and start a new chunk
+        """
+        for chunk in (self.chunk[:self.chunk_used],) + extra_chunks:
+            if len(chunk):
+                self.full_chunks.append(chunk)
+                self.full_chunk_rows += len(chunk)
+        self.chunk = np.empty(self.chunk_size, dtype=ROW_DTYPE)
+        self.chunk_used = 0
+
+    def append(self, indicator, region, year, value):
+        if self.chunk_used == self.chunk_size:
+            self._close_chunk()
+
+        self.chunk[self.chunk_used] = (self.indicators.code(indicator), self.regions.code(region), year, value)
+        self.chunk_used += 1
+        self.dataframe = None
+        self.generation += 1
+
+    def clear(self):
+        generation = self.generation
+        self.__init__(self.chunk_size)
+        self.generation = generation + 1
+
+    def truncate(self, length):
+        """
+        Drop the rows added after the first length rows
+        """
+        if length >= len(self):
+            return
+        rows = self.get_rows()[:length].copy()
+        self.full_chunks = []
+        self.full_chunk_rows = 0
+        self.chunk_used = 0
+        self._close_chunk(rows)
+        self.dataframe = None
+        self.generation += 1
+
+    def extend(self, rows, indicator_names, region_names):
+        """
+        Add rows coded against another buffer's indicator and region names, keeping their order
+        """
+        if not len(rows):
+            return
+
+        rows = rows.copy()
+        indicator_codes = np.array([self.indicators.code(name) for name in indicator_names], dtype=np.int16)
+        region_codes = np.array([self.regions.code(name) for name in region_names], dtype=np.int32)
+        rows['indicator'] = indicator_codes.take(rows['indicator'])
+        rows['region'] = region_codes.take(rows['region'])
+
+        self._close_chunk(rows)
+        self.dataframe = None
+        self.generation += 1
+
+    def extend_with_regions(self, other, regions):
+        """
+        Add the rows of the given regions from another buffer, region by region in the given order,
+        keeping the order of the rows within each region
+        """
+        rows = other.get_rows()
+        for region in regions:
+            code = other.regions.code_by_name.get(region)
+            if code is not None:
+                self.extend(rows[rows['region'] == code], other.indicators.names, other.regions.names)
+
+    def save(self, filename):
+        """
+        Write all rows, along with the names their codes refer to, to a shard file (see extend_from_file)
+        """
+        np.savez(filename, rows=self.get_rows(),
+                 indicators=np.array(self.indicators.names, dtype=str), regions=np.array(self.regions.names, dtype=str))
+
+    def extend_from_file(self, filename):
+        """
+        Add the rows of a shard file written by save
+        """
+        shard = np.load(filename)
+        try:
+            self.extend(shard['rows'], shard['indicators'].tolist(), shard['regions'].tolist())
+        finally:
+            shard.close()
+
+    def get_rows(self, start=0):
+        """
+        All rows (from the given position on) as a single structured array, in the order they were added
+        """
+        selected_chunks = []
+        chunk_start = 0
+        for chunk in self.full_chunks + [self.chunk[:self.chunk_used]]:
+            if chunk_start + len(chunk) > start:
+                selected_chunks.append(chunk[max(0, start - chunk_start):])
+            chunk_start += len(chunk)
+        return np.concatenate(selected_chunks) if selected_chunks else np.empty(0, dtype=ROW_DTYPE)
+
+    def iter_rows(self, start=0):
+        """
+        Yields (indicator, region, year, value) tuples for the rows from the given position on
+        """
+        for indicator, region, year, value in self.get_rows(start).tolist():
+            yield self.indicators.names[indicator], self.regions.names[region], year, value
+
+    def to_dataframe(self):
+        """
+        All rows as a dataframe with columns indicator, region, year, value.
+        The dataframe is cached until the next row is added, so treat it as read-only.
+        """
+        if self.dataframe is None:
+            rows = self.get_rows()
+            self.dataframe = pd.DataFrame(
+                {'indicator': self.indicators.decode(rows['indicator']),
+                 'region': self.regions.decode(rows['region']),
+                 'year': rows['year'].astype(np.int64),
+                 'value': rows['value']},
+                columns=['indicator', 'region', 'year', 'value']
+            )
+        return self.dataframe
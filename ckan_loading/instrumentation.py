@@ -0,0 +1,337 @@
+"""
+Performance instrumentation for indicator runs.
+
+Every FTS query is recorded with its latency, size, row count, cache outcome and retries, and the main stages of a run
+(populating each region, writing the outputs, archiving) are timed. At the end of a run this is summarized into a JSON
+run report, per endpoint, per stage and per region, with the slowest requests and regions listed first, so a slow
+night can be traced back to the network, the decoding, pandas or the database writes.
+
+Optional hooks run the whole process under cProfile, and trace Python memory allocations with tracemalloc where it is
+available (Python 3, or the pytracemalloc backport).
+
+Can also be run as a script to time a shell step and add it to an existing report, e.g.
+    python instrumentation.py ~/fts_run_report.json archive python ~/tool/DAP-FTSCollector/archives/exporter.py
+"""
+
+import argparse
+import contextlib
+import cProfile
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import threading
+import time
+import urlparse
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+DEFAULT_TOP_N = 10
+CACHE_STATUSES = ['hit', 'revalidated', 'miss']
+
+# path segments that identify one entity rather than an endpoint: ids, years and ISO country codes
+_ENTITY_SEGMENT = re.compile(r'^(\d+|[A-Z]{3})$')
+# query parameters whose value picks the endpoint rather than the entity
+_ENDPOINT_PARAMETERS = ['groupby']
+
+
+class RequestRecord(object):
+    """
+    Measurements for a single FTS query, filled in while it runs
+    """
+    def __init__(self, url):
+        self.url = url
+        self.endpoint = endpoint_for_url(url)
+        self.seconds = 0.
+        self.bytes = 0
+        self.rows = 0
+        self.cache = None  # one of CACHE_STATUSES, or None when no cache is enabled
+        self.retries = 0
+        self.error = None
+
+    def as_dict(self):
+        return dict((name, getattr(self, name))
+                    for name in ['url', 'endpoint', 'seconds', 'bytes', 'rows', 'cache', 'retries', 'error'])
+
+
+class CountingReader(object):
+    """
+    Wraps a file-like object, adding the number of bytes read from it to a RequestRecord
+    """
+    def __init__(self, stream, record):
+        self.stream = stream
+        self.record = record
+
+    def read(self, size=None):
+        data = self.stream.read() if size is None else self.stream.read(size)
+        self.record.bytes += len(data)
+        return data
+
+    def close(self):
+        self.stream.close()
+
+
+_LOCK = threading.Lock()
+_LOCAL = threading.local()
+_REQUESTS = []
+_STAGES = []
+_STARTED = time.time()
+_PROFILER = None
+
+
+def endpoint_for_url(url):
+    """
+    Name of the endpoint a url belongs to, e.g. 'Appeal/country/*' or 'funding?GroupBy=donor&Year=*'
+    """
+    parts = urlparse.urlsplit(url)
+    path = re.sub(r'\.json$', '', parts.path)
+    path = path.split('/api/v1/', 1)[-1]
+    endpoint = '/'.join('*' if _ENTITY_SEGMENT.match(segment) else segment for segment in path.split('/'))
+
+    parameters = sorted(urlparse.parse_qsl(parts.query))
+    if parameters:
+        endpoint += '?' + '&'.join('{}={}'.format(name, value if name.lower() in _ENDPOINT_PARAMETERS else '*')
+                                   for name, value in parameters)
+    return endpoint
+
+
+def current_request():
+    """
+    The RequestRecord of the query running in this thread, or None
+    """
+    return getattr(_LOCAL, 'request', None)
+
+
+def note_retry():
+    record = current_request()
+    if record is not None:
+        record.retries += 1
+
+
+def note_cache_status(status):
+    record = current_request()
+    if record is not None:
+        record.cache = status
+
+
+@contextlib.contextmanager
+def request(url):
+    """
+    Time an FTS query, yielding its RequestRecord so the caller can fill in bytes and rows
+    """
+    record = RequestRecord(url)
+    outer_record = current_request()
+    _LOCAL.request = record
+    started = time.time()
+    try:
+        yield record
+    except Exception as e:
+        record.error = repr(e)
+        raise
+    finally:
+        record.seconds = time.time() - started
+        _LOCAL.request = outer_record
+        with _LOCK:
+            _REQUESTS.append(record.as_dict())
+
+
+@contextlib.contextmanager
+def stage(name, region=None):
+    """
+    Time a stage of the run, optionally for a single region
+    """
+    started = time.time()
+    try:
+        yield
+    finally:
+        with _LOCK:
+            _STAGES.append({'name': name, 'region': region, 'seconds': time.time() - started})
+
+
+def take_records():
+    """
+    Remove and return everything recorded so far in this process, e.g. to send it from a worker process to the parent
+    """
+    with _LOCK:
+        records = (list(_REQUESTS), list(_STAGES))
+        del _REQUESTS[:]
+        del _STAGES[:]
+    return records
+
+
+def add_records(records):
+    """
+    Add records returned by take_records in another process
+    """
+    requests, stages = records
+    with _LOCK:
+        _REQUESTS.extend(requests)
+        _STAGES.extend(stages)
+
+
+def start_profiling():
+    global _PROFILER
+    _PROFILER = cProfile.Profile()
+    _PROFILER.enable()
+
+
+def stop_profiling(filename):
+    """
+    Stop profiling and write the stats in pstats format, to be explored with e.g. snakeviz or python -m pstats
+    """
+    global _PROFILER
+    if _PROFILER is not None:
+        _PROFILER.disable()
+        _PROFILER.dump_stats(filename)
+        _PROFILER = None
+
+
+def start_memory_tracing():
+    """
+    Trace Python memory allocations for the memory section of the report, returns False if tracemalloc is missing
+    """
+    if tracemalloc is None:
+        return False
+    tracemalloc.start()
+    return True
+
+
+def _memory_summary(top_n):
+    usage = {
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'max_rss_kb_worker_processes': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        usage['traced_bytes'] = current
+        usage['traced_peak_bytes'] = peak
+        usage['top_allocations'] = [
+            {'location': str(statistic.traceback), 'bytes': statistic.size, 'count': statistic.count}
+            for statistic in tracemalloc.take_snapshot().statistics('lineno')[:top_n]]
+    return usage
+
+
+def _summarize_requests(requests):
+    summary = {'count': len(requests), 'seconds': 0., 'max_seconds': 0., 'bytes': 0, 'rows': 0, 'retries': 0,
+               'errors': 0, 'cache': dict((status, 0) for status in CACHE_STATUSES)}
+    for record in requests:
+        summary['seconds'] += record['seconds']
+        summary['max_seconds'] = max(summary['max_seconds'], record['seconds'])
+        summary['bytes'] += record['bytes']
+        summary['rows'] += record['rows']
+        summary['retries'] += record['retries']
+        summary['errors'] += record['error'] is not None
+        if record['cache'] is not None:
+            summary['cache'][record['cache']] += 1
+    return summary
+
+
+def _summarize_stages(stages):
+    totals = {}
+    for record in stages:
+        total = totals.setdefault(record['name'], {'count': 0, 'seconds': 0., 'max_seconds': 0.})
+        total['count'] += 1
+        total['seconds'] += record['seconds']
+        total['max_seconds'] = max(total['max_seconds'], record['seconds'])
+    return totals
+
+
+def _slowest_regions(stages, top_n):
+    """
+    Regions by total time, each with the time spent in each of its stages
+    """
+    stages_by_region = {}
+    for record in stages:
+        if record['region'] is not None:
+            stages_by_region.setdefault(record['region'], []).append(record)
+
+    regions = []
+    for region, region_stages in stages_by_region.items():
+        seconds_by_stage = dict((name, total['seconds']) for name, total in _summarize_stages(region_stages).items())
+        # the stage timing a whole region includes the others, so use the longest rather than the sum
+        regions.append({'region': region, 'seconds': max(seconds_by_stage.values()), 'stages': seconds_by_stage})
+
+    return sorted(regions, key=lambda region: region['seconds'], reverse=True)[:top_n]
+
+
+def build_report(top_n=DEFAULT_TOP_N, extra=None):
+    """
+    Summarize everything recorded so far into a JSON serializable dict
+    """
+    with _LOCK:
+        requests = list(_REQUESTS)
+        stages = list(_STAGES)
+
+    requests_by_endpoint = {}
+    for record in requests:
+        requests_by_endpoint.setdefault(record['endpoint'], []).append(record)
+
+    report = {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(_STARTED)),
+        'seconds': time.time() - _STARTED,
+        'requests': _summarize_requests(requests),
+        'endpoints': dict((endpoint, _summarize_requests(endpoint_requests))
+                          for endpoint, endpoint_requests in requests_by_endpoint.items()),
+        'stages': _summarize_stages(stages),
+        'slowest_requests': sorted(requests, key=lambda record: record['seconds'], reverse=True)[:top_n],
+        'slowest_regions': _slowest_regions(stages, top_n),
+        'memory': _memory_summary(top_n),
+    }
+    report.update(extra or {})
+    return report
+
+
+def write_report(filename, top_n=DEFAULT_TOP_N, extra=None):
+    report = build_report(top_n, extra)
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    return report
+
+
+def print_summary(report):
+    requests = report['requests']
+    print "Run took {:.1f}s, {} requests ({:.1f}s, {} bytes, {} retries, cache {})".format(
+        report['seconds'], requests['count'], requests['seconds'], requests['bytes'], requests['retries'],
+        ', '.join('{} {}'.format(requests['cache'][status], status) for status in CACHE_STATUSES))
+    for name, total in sorted(report['stages'].items(), key=lambda item: item[1]['seconds'], reverse=True):
+        print "  {:<40} {:>5} x {:>9.2f}s".format(name, total['count'], total['seconds'])
+    print "Slowest regions:"
+    for region in report['slowest_regions']:
+        print "  {:<6} {:>9.2f}s".format(region['region'], region['seconds'])
+
+
+def add_stage_to_report(filename, name, seconds):
+    """
+    Add a stage timed outside of the indicator process to an existing report, if there is one
+    """
+    if not os.path.exists(filename):
+        return
+
+    with open(filename) as f:
+        report = json.load(f)
+
+    total = report['stages'].setdefault(name, {'count': 0, 'seconds': 0., 'max_seconds': 0.})
+    total['count'] += 1
+    total['seconds'] += seconds
+    total['max_seconds'] = max(total['max_seconds'], seconds)
+
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time a command and add it as a stage to an existing run report')
+    parser.add_argument('report', help='JSON run report written by generate_chd_indicators.py --report')
+    parser.add_argument('stage', help='name of the stage, e.g. archive')
+    parser.add_argument('command', nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    started = time.time()
+    return_code = subprocess.call(args.command)
+    add_stage_to_report(args.report, args.stage, time.time() - started)
+    sys.exit(return_code)
@@ -0,0 +1,262 @@
+"""
+Durable queue of region jobs, so that the regions of a run can be shared out between worker processes, including
+processes on other hosts sharing the file.
+
+The jobs of a run are kept in a small SQLite file. A worker leases the next job, renews its lease while working on it
+(see keep_leased) and reports the job as completed or failed. A job whose lease runs out, e.g. because its worker
+died, is leased again by the next worker to ask, up to MAX_ATTEMPTS times.
+
+Regions vary a lot in cost: one with dozens of appeals and emergencies takes hundreds of requests, most take a
+handful. So jobs are leased longest first, by the time each region took in previous runs, which is kept in the same
+file across runs; regions without a recorded time go first, as they may be the longest. That way the long regions
+are started early rather than being left to run on their own at the end of the run.
+
+Each enqueue starts a new run, and its jobs are tagged with the run's id. Workers of other processes or hosts
+(see wait_for_run) only take jobs of a run that is still going: one that hasn't been finished by the process that
+enqueued it, and whose jobs have been leased or renewed recently. So a worker started before the run it is meant to
+help waits for it, rather than working on the jobs left over from a previous run.
+
+A worker checks that it still holds its lease before saving a job's results (see renew), and complete and fail only
+take effect for the worker holding the lease, so a worker whose lease ran out can't overwrite the work of the worker
+that took the job over.
+
+A connection is opened for each operation, so one queue file can be shared by forked worker processes.
+"""
+
+import contextlib
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+DEFAULT_LEASE_SECONDS = 300
+MAX_ATTEMPTS = 3
+# weight of the latest time in the recorded cost of a region, the rest is the cost recorded before
+COST_SMOOTHING = 0.5
+LOCK_TIMEOUT = 60  # seconds to wait for other processes writing to the same queue
+
+
+def worker_name():
+    """
+    Name of the current process, unique across the hosts sharing a queue
+    """
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+class JobQueue(object):
+    """
+    Region jobs of the current run, and the cost of each region in previous runs
+    """
+    def __init__(self, filename, lease_seconds=DEFAULT_LEASE_SECONDS):
+        self.filename = filename
+        self.lease_seconds = lease_seconds
+        self.run_id = None
+        with self._transaction() as db:
+            column_names = [column[1] for column in db.execute("pragma table_info(job)")]
+            if column_names and 'run_id' not in column_names:
+                db.execute("drop table job")  # jobs of a run from before runs were tracked
+            db.execute("create table if not exists run ("
+                       " id text primary key, created_at real not null, finished_at real)")
+            db.execute("create table if not exists job ("
+                       " region text primary key, run_id text not null, position integer not null,"
+                       " status text not null, worker text, lease_expires real, attempts integer not null,"
+                       " error text, updated_at real not null)")
+            db.execute("create table if not exists job_cost ("
+                       " region text primary key, seconds real not null, updated_at real not null)")
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """
+        A connection in a write transaction, taken up front so a job can't be leased by two workers at once
+        """
+        db = sqlite3.connect(self.filename, timeout=LOCK_TIMEOUT, isolation_level=None)
+        try:
+            db.execute("begin immediate")
+            try:
+                yield db
+                db.execute("commit")
+            except:
+                db.execute("rollback")
+                raise
+        finally:
+            db.close()
+
+    def _query(self, sql, parameters=()):
+        db = sqlite3.connect(self.filename, timeout=LOCK_TIMEOUT)
+        try:
+            return db.execute(sql, parameters).fetchall()
+        finally:
+            db.close()
+
+    def enqueue(self, regions):
+        """
+        Start a new run, replacing the jobs with one pending job per region. Returns the id of the run.
+        """
+        now = time.time()
+        self.run_id = uuid.uuid4().hex
+        with self._transaction() as db:
+            db.execute("update run set finished_at = ? where finished_at is null", (now,))
+            db.execute("insert into run (id, created_at) values (?, ?)", (self.run_id, now))
+            db.execute("delete from job")
+            db.executemany("insert into job (region, run_id, position, status, attempts, updated_at)"
+                           " values (?, ?, ?, ?, 0, ?)",
+                           [(region, self.run_id, position, PENDING, now) for position, region in enumerate(regions)])
+        return self.run_id
+
+    def finish_run(self):
+        """
+        Mark the run started by enqueue as finished, so no worker takes its jobs any more
+        """
+        with self._transaction() as db:
+            db.execute("update run set finished_at = ? where id = ?", (time.time(), self.run_id))
+
+    def get_current_run(self):
+        """
+        The id of the run still going, or None: a run not finished yet whose jobs were enqueued, leased or renewed
+        within the last lease_seconds (a run whose process died without finishing it doesn't count)
+        """
+        rows = self._query("select run.id from run join job on job.run_id = run.id where run.finished_at is null"
+                           " group by run.id having max(job.updated_at) > ?"
+                           " order by run.created_at desc limit 1", (time.time() - self.lease_seconds,))
+        return rows[0][0] if rows else None
+
+    def wait_for_run(self, poll_seconds=5):
+        """
+        Wait for a run to be going, and take jobs of that run from then on. Returns the id of the run.
+        """
+        while True:
+            run_id = self.get_current_run()
+            if run_id is not None:
+                self.run_id = run_id
+                return run_id
+            time.sleep(poll_seconds)
+
+    def lease(self, worker):
+        """
+        Lease the most costly job of the run that is pending or whose lease ran out, returning its region,
+        or None if there is no such job right now
+        """
+        now = time.time()
+        with self._transaction() as db:
+            db.execute("update job set status = ?, error = ?, updated_at = ?"
+                       " where run_id = ? and status = ? and lease_expires < ? and attempts >= ?",
+                       (FAILED, 'lease ran out {} times'.format(MAX_ATTEMPTS), now, self.run_id, LEASED, now,
+                        MAX_ATTEMPTS))
+            row = db.execute("select job.region from job left join job_cost on job_cost.region = job.region"
+                             " where job.run_id = ? and (job.status = ? or (job.status = ? and job.lease_expires < ?))"
+                             " order by job_cost.seconds is null desc, job_cost.seconds desc, job.position limit 1",
+                             (self.run_id, PENDING, LEASED, now)).fetchone()
+            if row is None:
+                return None
+            region = row[0]
+            db.execute("update job set status = ?, worker = ?, lease_expires = ?, attempts = attempts + 1,"
+                       " updated_at = ? where region = ?", (LEASED, worker, now + self.lease_seconds, now, region))
+        return region
+
+    def _update_leased_job(self, db, region, worker, assignments, parameters):
+        """
+        Update a job only if the worker still holds its lease, returning whether it did
+        """
+        return db.execute("update job set {} where region = ? and run_id = ? and worker = ? and status = ?"
+                          " and lease_expires >= ?".format(assignments),
+                          tuple(parameters) + (region, self.run_id, worker, LEASED, time.time())).rowcount == 1
+
+    def renew(self, region, worker):
+        """
+        Extend the lease of a job, returning False if the worker lost it (it ran out, and the job may have been
+        leased again). Call before saving the results of a job, so they are saved within a fresh lease.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            return self._update_leased_job(db, region, worker, "lease_expires = ?, updated_at = ?",
+                                           (now + self.lease_seconds, now))
+
+    def keep_leased(self, region, worker):
+        """
+        Context manager renewing the lease of a job on a thread while the job is worked on
+        """
+        return _LeaseRenewer(self, region, worker)
+
+    def complete(self, region, worker, seconds):
+        """
+        Mark a job as done, recording how long it took as the cost of its region for later runs.
+        Returns False, recording nothing, if the worker no longer holds the lease.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            if not self._update_leased_job(db, region, worker, "status = ?, lease_expires = null, error = null,"
+                                           " updated_at = ?", (DONE, now)):
+                return False
+            row = db.execute("select seconds from job_cost where region = ?", (region,)).fetchone()
+            if row is not None:
+                seconds = COST_SMOOTHING * seconds + (1 - COST_SMOOTHING) * row[0]
+            db.execute("insert or replace into job_cost (region, seconds, updated_at) values (?, ?, ?)",
+                       (region, seconds, now))
+        return True
+
+    def fail(self, region, worker, error):
+        """
+        Mark a job as failed, returning False if the worker no longer holds the lease
+        """
+        with self._transaction() as db:
+            return self._update_leased_job(db, region, worker, "status = ?, lease_expires = null, error = ?,"
+                                           " updated_at = ?", (FAILED, error, time.time()))
+
+    def has_unfinished_jobs(self):
+        """
+        Whether any job of the run is still pending or leased, possibly by another worker
+        """
+        return self._query("select count(*) from job where run_id = ? and status in (?, ?)",
+                           (self.run_id, PENDING, LEASED))[0][0] > 0
+
+    def get_regions(self):
+        """
+        The regions of all the jobs of the run, in the order they were enqueued
+        """
+        return [region for (region,) in self._query("select region from job where run_id = ? order by position",
+                                                    (self.run_id,))]
+
+    def get_failed_jobs(self):
+        """
+        Returns a dict of region -> error for the jobs of the run that failed
+        """
+        return dict(self._query("select region, error from job where run_id = ? and status = ?",
+                                (self.run_id, FAILED)))
+
+    def get_costs(self):
+        """
+        Returns a dict of region -> seconds taken, as recorded by previous runs
+        """
+        return dict(self._query("select region, seconds from job_cost"))
+
+
+class _LeaseRenewer(object):
+    def __init__(self, queue, region, worker):
+        self.queue = queue
+        self.region = region
+        self.worker = worker
+        self.stopped = threading.Event()
+        self.lost = False  # set once a renewal found the lease gone
+        self.thread = threading.Thread(target=self._renew, name='lease-' + region)
+        self.thread.daemon = True
+
+    def _renew(self):
+        while not self.stopped.wait(self.queue.lease_seconds / 3.):
+            if not self.queue.renew(self.region, self.worker):
+                self.lost = True
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        self.thread.join()
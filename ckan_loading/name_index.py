@@ -0,0 +1,62 @@
+"""
+Interned lookups for the free-text names FTS uses to refer to organizations and donors.
+
+Several API results refer to organizations by name rather than id, so the indicator code has to join on long
+strings. Instead of joining object-dtype columns against the whole Organization table for every country, the names
+are interned once per run into compact integer ids, and attributes such as the organization type are kept as
+integer codes indexed by those ids, so lookups become vectorized integer array operations.
+"""
+
+import numpy as np
+import pandas as pd
+
+UNKNOWN = -1
+
+
+class NameIndex(object):
+    """
+    Maps names to compact integer ids (their position in the index), UNKNOWN for names not in the index
+    """
+    def __init__(self, names):
+        # only the first occurrence of a duplicated name gets an id
+        self.index = pd.Index(pd.unique(np.asarray(list(names), dtype=object)))
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_ids(self, names):
+        return self.index.get_indexer(np.asarray(list(names), dtype=object))
+
+    def get_id(self, name):
+        return self.get_ids([name])[0]
+
+    def contains(self, names):
+        """
+        Boolean array, true for each of the names that is in the index
+        """
+        return self.get_ids(names) != UNKNOWN
+
+
+class OrganizationIndex(object):
+    """
+    Organization name -> id -> type code, built once from the FTS organizations
+    """
+    def __init__(self, organizations_by_name):
+        # first occurrence of each name wins, in line with NameIndex
+        organizations_by_name = organizations_by_name[~pd.Series(organizations_by_name.index).duplicated().values]
+
+        self.names = NameIndex(organizations_by_name.index)
+        type_codes, self.types = pd.factorize(organizations_by_name.type)
+        self.type_code_by_id = np.asarray(type_codes, dtype=np.int32)
+
+    def get_type_codes(self, names):
+        """
+        Type code for each of the given organization names, UNKNOWN for unknown organizations (or missing type)
+        """
+        ids = self.names.get_ids(names)
+        if not len(self.type_code_by_id):
+            return ids  # all unknown
+        return np.where(ids == UNKNOWN, UNKNOWN, self.type_code_by_id.take(ids))
+
+    def get_type_names(self, type_codes):
+        return np.asarray(self.types, dtype=object).take(type_codes)
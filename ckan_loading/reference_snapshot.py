@@ -0,0 +1,203 @@
+"""
+Versioned on-disk snapshots of the global reference data the indicators are computed against: the countries, the
+organizations, and for each year the worldwide pooled fund allocations and the total funding of each country.
+
+Fetching these takes a request per year and per table, so once fetched they are saved as a snapshot, named after the
+date they were fetched on. Later runs (e.g. a --resume on the same day) take them from the newest snapshot that is
+recent enough, rather than from FTS. Each table is kept as plain numpy arrays (one .npy file per array, strings as
+fixed width unicode), which are memory-mapped when a snapshot is opened, so the processes of a run share the pages
+and only the years actually looked up are read.
+
+A snapshot records the source it was fetched from (the FTS base URL), and is only used by runs fetching from the same
+source. A day's snapshot is saved once: a run that finds it saved already, e.g. by another process, keeps it.
+
+    directory/2016-03-01/manifest.json
+    directory/2016-03-01/country_code.npy
+    ...
+"""
+
+import datetime
+import errno
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+MANIFEST_FILENAME = 'manifest.json'
+SNAPSHOT_FORMAT = 1
+# snapshots kept in the directory, older ones are removed when a new one is saved
+KEEP_SNAPSHOTS = 7
+
+ARRAY_NAMES = [
+    'country_code', 'country_name',  # the countries
+    'organization_name', 'organization_type_code',  # the organizations, with their type as a code into the manifest
+    'pooled_fund_amount',  # years x pooled funds
+    'funding_year', 'funding_country', 'funding_amount',  # funding by country and year, sorted by year
+    'funding_country_name',  # names the funding_country ids refer to
+]
+
+
+def _strings(values):
+    return np.asarray([u'' if value is None else value for value in values], dtype=np.unicode_)
+
+
+def save_snapshot(directory, countries, organizations, pooled_fund_amounts_by_year, funding_by_country_by_year,
+                  source=None, version=None):
+    """
+    Save the reference data as a new snapshot in directory, returning it as a ReferenceSnapshot.
+     - countries: dict of ISO code -> name
+     - organizations: dataframe indexed by name, with a type column
+     - pooled_fund_amounts_by_year: dict of year -> series of the worldwide allocation of each pooled fund
+     - funding_by_country_by_year: dict of year -> dataframe indexed by country name, with a funding column
+    The source is where the data was fetched from. The version is the fetch date, today by default. The snapshot is
+    written next to its final place and then renamed, so a snapshot is never seen half written. If the version is
+    saved already, it is kept as it is, and returned if it has the same source (None otherwise).
+    """
+    version = version or datetime.date.today().isoformat()
+    path = os.path.join(directory, version)
+    if os.path.exists(os.path.join(path, MANIFEST_FILENAME)):
+        return _open_existing_snapshot(path, source)
+    years = sorted(pooled_fund_amounts_by_year)
+    pooled_funds = list(pooled_fund_amounts_by_year[years[0]].index) if years else []
+    country_codes = sorted(countries)
+    type_codes, types = pd.factorize(organizations.type)
+
+    funding_years = []
+    funding_countries = []
+    funding_amounts = []
+    funding_country_names = []
+    funding_country_ids = {}
+    for year in sorted(funding_by_country_by_year):
+        funding = funding_by_country_by_year[year]
+        if funding.empty:
+            continue
+        for country_name, amount in zip(funding.index, funding.funding):
+            funding_years.append(year)
+            funding_countries.append(funding_country_ids.setdefault(country_name, len(funding_country_names)))
+            if funding_countries[-1] == len(funding_country_names):
+                funding_country_names.append(country_name)
+            funding_amounts.append(amount)
+
+    arrays = {
+        'country_code': _strings(country_codes),
+        'country_name': _strings([countries[code] for code in country_codes]),
+        'organization_name': _strings(organizations.index),
+        'organization_type_code': np.asarray(type_codes, dtype=np.int32),
+        'pooled_fund_amount': np.asarray([[pooled_fund_amounts_by_year[year][fund] for fund in pooled_funds]
+                                          for year in years], dtype=np.float64).reshape(len(years), len(pooled_funds)),
+        'funding_year': np.asarray(funding_years, dtype=np.int16),
+        'funding_country': np.asarray(funding_countries, dtype=np.int32),
+        'funding_amount': np.asarray(funding_amounts, dtype=np.float64),
+        'funding_country_name': _strings(funding_country_names),
+    }
+    manifest = {
+        'format': SNAPSHOT_FORMAT,
+        'version': version,
+        'source': source,
+        'saved_at': datetime.datetime.now().isoformat(),
+        'years': years,
+        'pooled_funds': pooled_funds,
+        'organization_types': list(types),
+    }
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    staging_path = tempfile.mkdtemp(prefix='.snapshot-', dir=directory)
+    try:
+        for name in ARRAY_NAMES:
+            np.save(os.path.join(staging_path, name + '.npy'), arrays[name])
+        with open(os.path.join(staging_path, MANIFEST_FILENAME), 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        try:
+            # fails rather than replacing the version if another process saved it in the meantime
+            os.rename(staging_path, path)
+        except OSError as e:
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+            return _open_existing_snapshot(path, source)
+    finally:
+        shutil.rmtree(staging_path, ignore_errors=True)
+
+    for old_version in list_versions(directory)[:-KEEP_SNAPSHOTS]:
+        shutil.rmtree(os.path.join(directory, old_version), ignore_errors=True)
+
+    return ReferenceSnapshot(path)
+
+
+def _open_existing_snapshot(path, source):
+    snapshot = ReferenceSnapshot(path)
+    return snapshot if snapshot.source == source else None
+
+
+def list_versions(directory):
+    """
+    Versions of the complete snapshots in directory, oldest first
+    """
+    if not os.path.isdir(directory):
+        return []
+    return sorted(name for name in os.listdir(directory)
+                  if os.path.exists(os.path.join(directory, name, MANIFEST_FILENAME)))
+
+
+def load_latest_snapshot(directory, max_age_days=0, source=None):
+    """
+    The newest snapshot in directory fetched from source at most max_age_days ago (so 0 means today's), or None
+    """
+    oldest_version = (datetime.date.today() - datetime.timedelta(days=max_age_days)).isoformat()
+    versions = [version for version in list_versions(directory) if version >= oldest_version]
+    for version in reversed(versions):
+        snapshot = ReferenceSnapshot(os.path.join(directory, version))
+        if snapshot.manifest['format'] == SNAPSHOT_FORMAT and snapshot.source == source:
+            return snapshot
+    return None
+
+
+class ReferenceSnapshot(object):
+    """
+    The reference data of one snapshot, memory-mapped from its directory
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST_FILENAME)) as f:
+            self.manifest = json.load(f)
+        self.version = self.manifest['version']
+        self.source = self.manifest.get('source')
+        self.years = self.manifest['years']
+        self.arrays = dict((name, np.load(os.path.join(path, name + '.npy'), mmap_mode='r')) for name in ARRAY_NAMES)
+
+    def has_year(self, year):
+        return year in self.years
+
+    def get_country_names_by_code(self):
+        return dict(zip(self.arrays['country_code'].tolist(), self.arrays['country_name'].tolist()))
+
+    def get_organizations_indexed_by_name(self):
+        """
+        The organizations as a dataframe indexed by name with a (categorical) type column, organizations without a
+        type have a missing type
+        """
+        types = pd.Categorical.from_codes(np.asarray(self.arrays['organization_type_code']),
+                                          categories=self.manifest['organization_types'])
+        return pd.DataFrame({'type': types}, index=pd.Index(self.arrays['organization_name'].tolist(), name='name'))
+
+    def get_pooled_fund_amounts(self, year):
+        """
+        Series of the worldwide allocation of each pooled fund in the year
+        """
+        amounts = np.array(self.arrays['pooled_fund_amount'][self.years.index(year)])
+        return pd.Series(amounts, index=pd.Index(self.manifest['pooled_funds'], name='organization'), name='funding')
+
+    def get_funding_by_country(self, year):
+        """
+        Dataframe of the total funding of each country in the year, indexed by country name (empty if none)
+        """
+        funding_years = self.arrays['funding_year']
+        start, end = np.searchsorted(funding_years, [year, year + 1])
+        if start == end:
+            return pd.DataFrame()
+        country_names = self.arrays['funding_country_name'].take(self.arrays['funding_country'][start:end])
+        return pd.DataFrame({'funding': np.array(self.arrays['funding_amount'][start:end])},
+                            index=pd.Index(country_names.tolist(), name='country'))
@@ -0,0 +1,124 @@
+"""
+Streaming output of the indicator rows, one region's batch at a time, as an alternative to holding all the rows of a
+run in memory and writing them at the end.
+
+Batches are dataframes in the layout of the scraperwiki style "value" table. They are handed to a SinkPipeline, which
+writes them to each of its sinks on a writer thread while the next regions are populated. The pipeline only holds a
+few batches: if the writers fall behind, put() blocks until they catch up, so memory stays bounded whatever the number
+of regions. The files being written are visible while the run progresses, and only replace the previous output once
+the pipeline is closed, so a failed run leaves the previous output in place.
+"""
+
+import os
+import sys
+import threading
+from Queue import Queue
+
+# the database writer lives with the rest of the database code in ../metadata
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'metadata'))
+import orm
+
+DEFAULT_MAX_PENDING_BATCHES = 4
+PARTIAL_SUFFIX = '.partial'
+
+
+class CsvValueSink(object):
+    """
+    Writes the batches to a CSV file, the same as writing all of them at once with DataFrame.to_csv
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename + PARTIAL_SUFFIX, 'w')
+        self.header = True
+
+    def write(self, batch):
+        batch.to_csv(self.file, index=False, header=self.header)
+        self.header = False
+
+    def close(self):
+        self.file.close()
+        os.rename(self.filename + PARTIAL_SUFFIX, self.filename)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.filename + PARTIAL_SUFFIX)
+
+
+class SqlValueSink(object):
+    """
+    Writes the batches to the value table of a database, see orm.StreamingValueWriter
+    """
+    def __init__(self, filename):
+        self.writer = orm.StreamingValueWriter(filename)
+
+    def write(self, batch):
+        self.writer.write(batch.itertuples(index=False))
+
+    def close(self):
+        self.writer.finish()
+
+    def abort(self):
+        self.writer.abort()
+
+
+class SinkPipeline(object):
+    """
+    Feeds batches to several sinks on a writer thread, through a bounded queue
+    """
+    def __init__(self, sinks, max_pending_batches=DEFAULT_MAX_PENDING_BATCHES):
+        self.sinks = sinks
+        self.queue = Queue(max_pending_batches)
+        self.error = None
+        self.row_count = 0
+        self.thread = threading.Thread(target=self._write_batches, name='value-sinks')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _write_batches(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            if self.error is not None:
+                continue  # keep draining, so put() doesn't block forever
+            try:
+                for sink in self.sinks:
+                    sink.write(batch)
+            except Exception as e:
+                self.error = e
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def put(self, batch):
+        """
+        Queue a batch for writing, waiting while the writers are max_pending_batches behind.
+        Raises the error of any earlier batch that failed to be written.
+        """
+        self._raise_error()
+        self.row_count += len(batch)
+        self.queue.put(batch)
+
+    def close(self):
+        """
+        Wait for all batches to be written, then put the output of each sink in place
+        """
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            self.abort()
+            self._raise_error()
+        for sink in self.sinks:
+            sink.close()
+
+    def abort(self):
+        """
+        Stop writing and drop the partial output, leaving the previous output as it was.
+        Doesn't raise the error of a batch that failed to be written, so it can be called while handling another.
+        """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        for sink in self.sinks:
+            sink.abort()
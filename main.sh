@@ -1,9 +1,12 @@
 #!/bin/bash -ex
 COLLECTOR=~/tool/DAP-FTSCollector
 cd ~
-rm -f ~/ocha.db
 python $COLLECTOR/metadata/metadata.py
-python $COLLECTOR/ckan_loading/generate_chd_indicators.py
-$COLLECTOR/archives/archive
+GENERATE="python $COLLECTOR/ckan_loading/generate_chd_indicators.py --incremental --report $HOME/fts_run_report.json"
+# FTS responses and the global reference data are kept between runs
+GENERATE="$GENERATE --cache-dir $HOME/fts_cache --reference-dir $HOME/fts_reference"
+# if some countries still fail after the per-request retries, give them one more go, keeping the countries already done
+$GENERATE || $GENERATE --resume
+python $COLLECTOR/ckan_loading/instrumentation.py ~/fts_run_report.json archive python $COLLECTOR/archives/exporter.py
 echo done
 
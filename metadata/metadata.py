@@ -19,7 +19,5 @@ def indicators(filename):
         for row in spamreader:
             yield dict(zip(field_names, row))
 
-orm.DataSet(**dataset).save()
-for indicator in indicators(filename):
-    print indicator
-    orm.Indicator(**indicator).save()
+orm.bulk_save_datasets([dataset])
+orm.bulk_save_indicators(indicators(filename))
@@ -1,10 +1,14 @@
-from sqlalchemy import Column, String, Boolean
+from sqlalchemy import Column, String, Boolean, Float
 from sqlalchemy import ForeignKey, create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.engine import Engine
 from sqlalchemy import event
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.dialects import sqlite
 import datetime
+import math
+import sqlite3
 from canon import canonicalise, canon_number, canon_period, chd_id
 import atexit
 
@@ -13,6 +17,19 @@ def now():
     return datetime.datetime.now().isoformat()
 
 
+def number_or_none(value):
+    """
+    The value as a float for the typed num_value column, None if it isn't a finite number (e.g. 'na')
+    """
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    if math.isnan(number) or math.isinf(number):
+        return None
+    return number
+
+
 @event.listens_for(Engine, "connect")
 def set_sqlite_pragma(dbapi_connection, connection_record):
     cursor = dbapi_connection.cursor()
@@ -20,11 +37,35 @@ def set_sqlite_pragma(dbapi_connection, connection_record):
     cursor.close()
 
 echo = False
-engine = create_engine("sqlite:///ocha.db", echo=echo)
-Session = sessionmaker(bind=engine)
-session = Session()
+DB_FILENAME = "ocha.db"
 Base = declarative_base()
 
+# created on first use (see get_session), so that importing this module does no I/O
+engine = None
+Session = None
+session = None
+
+
+def init(filename=DB_FILENAME):
+    """
+    Open the database for the ORM, creating its tables if needed; the session is committed at exit.
+    Only needed to use another database than ocha.db in the current directory, get_session calls it otherwise.
+    """
+    global engine, Session, session
+    if engine is None:
+        atexit.register(exithandler)
+    engine = create_engine("sqlite:///" + filename, echo=echo)
+    Session = sessionmaker(bind=engine)
+    session = Session()
+    Base.metadata.create_all(engine)
+    return session
+
+
+def get_session():
+    if session is None:
+        init()
+    return session
+
 
 class Value(Base):
     __tablename__ = "value"
@@ -35,6 +76,8 @@ class Value(Base):
     value = Column(String, nullable=False)
     is_number = Column(Boolean)
     source = Column(String)
+    # value as a number, for queries that compare or aggregate values without casting text (see value_query.py)
+    num_value = Column(Float)
 
     def is_blank(self):
         if type(self.value) in [float, int]:
@@ -54,9 +97,10 @@ class Value(Base):
             self.value = canon_number(self.value)
             if self.value is None:
                 return
+        self.num_value = number_or_none(self.value) if self.is_number else None
         assert not self.is_blank()
         try:
-            session.merge(self)
+            get_session().merge(self)
         except:
             print self.__dict__
             raise
@@ -70,7 +114,7 @@ class DataSet(Base):
     name = Column(String)
 
     def save(self):
-        session.merge(self)
+        get_session().merge(self)
 
 
 class Indicator(Base):
@@ -81,11 +125,234 @@ class Indicator(Base):
 
     def save(self):
         self.indID = chd_id(self.indID)
-        session.merge(self)
+        get_session().merge(self)
 
-Base.metadata.create_all(engine)
 
-
-@atexit.register
 def exithandler():
-    session.commit()
+    if session is not None:
+        session.commit()
+
+
+# Bulk write path, for loading many rows at once without going through session.merge
+# (which costs a SELECT per row) - see bulk_save_values
+
+BULK_PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",  # safe with WAL, only the last transaction can be lost on power failure
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",  # 64MB
+]
+
+# secondary indexes on value, (re)created after a bulk load as that's much faster than maintaining them per row.
+# They cover the columns read by value_query.py, so its lookups never touch the table itself.
+VALUE_INDEXES = {
+    'value_by_indicator': '(indID, period, region, num_value)',
+    'value_by_region': '(region, indID, period, num_value)',
+}
+
+BULK_BATCH_SIZE = 10000
+
+
+def connect_for_bulk_write(filename=DB_FILENAME, check_same_thread=True):
+    """
+    Plain sqlite3 connection to the database, tuned for bulk loads.
+    Foreign keys are not enforced on this connection, as values can be loaded before their indicators.
+    """
+    # transactions are managed explicitly
+    connection = sqlite3.connect(filename, isolation_level=None, check_same_thread=check_same_thread)
+    for pragma in BULK_PRAGMAS:
+        connection.execute(pragma)
+    return connection
+
+
+def _table_exists(connection, table_name):
+    return connection.execute(
+        "select count(*) from sqlite_master where type = 'table' and name = ?", (table_name,)).fetchone()[0] > 0
+
+
+def create_table(connection, model):
+    """
+    Create the table for the given model if it doesn't exist yet.
+    The value table is created WITHOUT ROWID, so its rows are stored in primary key order.
+    """
+    if not _table_exists(connection, model.__tablename__):
+        connection.execute(_create_table_ddl(model))
+    elif model is Value:
+        upgrade_value_table(connection)
+
+
+def _create_table_ddl(model, table_name=None):
+    ddl = str(CreateTable(model.__table__).compile(dialect=sqlite.dialect())).strip()
+    if table_name is not None:
+        ddl = ddl.replace("CREATE TABLE {} ".format(model.__tablename__), "CREATE TABLE {} ".format(table_name), 1)
+    if model is Value:
+        ddl += " WITHOUT ROWID"
+    return ddl
+
+
+def upgrade_value_table(connection):
+    """
+    Add the num_value column to a value table written before it existed, filling it in from value
+    """
+    column_names = [column[1] for column in connection.execute("PRAGMA table_info({})".format(Value.__tablename__))]
+    if 'num_value' not in column_names:
+        connection.create_function('number_or_none', 1, number_or_none)
+        connection.execute("ALTER TABLE {} ADD COLUMN num_value FLOAT".format(Value.__tablename__))
+        connection.execute("UPDATE {} SET num_value = number_or_none(value) WHERE is_number".format(
+            Value.__tablename__))
+
+
+VALUE_COLUMNS = ['dsID', 'region', 'indID', 'period', 'value', 'is_number', 'source', 'num_value']
+
+
+def _bulk_insert(connection, table_name, column_names, rows):
+    statement = "INSERT OR REPLACE INTO {} ({}) VALUES ({})".format(
+        table_name, ', '.join(column_names), ', '.join('?' * len(column_names)))
+
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BULK_BATCH_SIZE:
+            connection.executemany(statement, batch)
+            batch = []
+    if batch:
+        connection.executemany(statement, batch)
+
+
+def _sql_value(value):
+    if hasattr(value, 'item'):
+        value = value.item()  # numpy scalars are not understood by sqlite3
+    return value
+
+
+def _value_rows(rows):
+    """
+    Rows of (dsID, region, indID, period, value, is_number, source) made ready for sqlite3, with num_value added.
+    Like Value.save, rows without a value are skipped.
+    """
+    for dsID, region, indID, period, value, is_number, source in rows:
+        value = _sql_value(value)
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            continue
+        is_number = bool(is_number)
+        yield (dsID, region, chd_id(indID), _sql_value(period), value, is_number, source,
+               number_or_none(value) if is_number else None)
+
+
+def bulk_save_values(rows, filename=DB_FILENAME, replace_all=True, replace_partitions=None):
+    """
+    Write many (dsID, region, indID, period, value, is_number, source) rows to the value table in one transaction.
+    If replace_all, the table is recreated first. Otherwise the rows are upserted, after deleting the existing rows
+    of replace_partitions, a list of (dsID, region, period), so values that have gone away are removed too.
+    The secondary indexes are dropped during the load and created again afterwards.
+    """
+    connection = connect_for_bulk_write(filename)
+    try:
+        connection.execute("BEGIN")
+        if replace_all:
+            connection.execute("DROP TABLE IF EXISTS {}".format(Value.__tablename__))
+        create_table(connection, Value)
+        for index_name in VALUE_INDEXES:
+            connection.execute("DROP INDEX IF EXISTS {}".format(index_name))
+
+        if replace_partitions:
+            connection.executemany("DELETE FROM {} WHERE dsID = ? AND region = ? AND period = ?".format(
+                Value.__tablename__), [tuple(_sql_value(key) for key in partition) for partition in replace_partitions])
+
+        _bulk_insert(connection, Value.__tablename__, VALUE_COLUMNS, _value_rows(rows))
+
+        _create_value_indexes(connection)
+        connection.execute("COMMIT")
+    except:
+        connection.execute("ROLLBACK")
+        raise
+    finally:
+        connection.close()
+
+
+def _create_value_indexes(connection):
+    for index_name, columns in sorted(VALUE_INDEXES.items()):
+        connection.execute("CREATE INDEX {} ON {} {}".format(index_name, Value.__tablename__, columns))
+
+
+class StreamingValueWriter(object):
+    """
+    Replaces the value table with rows written a batch at a time, for when the rows are not all available at once
+    (the streaming counterpart of bulk_save_values with replace_all).
+    Each batch is committed to a staging table as it comes, so progress is visible, and finish() swaps the staging
+    table in for the value table in one transaction; until then the previous value table is left as it was.
+    The writer may be used from another thread than the one that created it, but only by one thread at a time.
+    """
+    STAGING_TABLE_NAME = 'value_staging'
+
+    def __init__(self, filename=DB_FILENAME):
+        self.connection = connect_for_bulk_write(filename, check_same_thread=False)
+        self.connection.execute("DROP TABLE IF EXISTS {}".format(self.STAGING_TABLE_NAME))
+        self.connection.execute(_create_table_ddl(Value, self.STAGING_TABLE_NAME))
+
+    def write(self, rows):
+        """
+        Write a batch of (dsID, region, indID, period, value, is_number, source) rows
+        """
+        self.connection.execute("BEGIN")
+        try:
+            _bulk_insert(self.connection, self.STAGING_TABLE_NAME, VALUE_COLUMNS, _value_rows(rows))
+            self.connection.execute("COMMIT")
+        except:
+            self.connection.execute("ROLLBACK")
+            raise
+
+    def finish(self):
+        try:
+            self.connection.execute("BEGIN")
+            try:
+                self.connection.execute("DROP TABLE IF EXISTS {}".format(Value.__tablename__))
+                self.connection.execute("ALTER TABLE {} RENAME TO {}".format(
+                    self.STAGING_TABLE_NAME, Value.__tablename__))
+                _create_value_indexes(self.connection)
+                self.connection.execute("COMMIT")
+            except:
+                self.connection.execute("ROLLBACK")
+                raise
+        finally:
+            self.connection.close()
+
+    def abort(self):
+        """
+        Drop the rows written so far, leaving the value table as it was
+        """
+        try:
+            self.connection.execute("DROP TABLE IF EXISTS {}".format(self.STAGING_TABLE_NAME))
+        finally:
+            self.connection.close()
+
+
+def bulk_save_datasets(datasets, filename=DB_FILENAME):
+    """
+    Write many datasets (dicts with the DataSet columns) in one transaction
+    """
+    _bulk_save_dicts(DataSet, datasets, filename)
+
+
+def bulk_save_indicators(indicators, filename=DB_FILENAME):
+    """
+    Write many indicators (dicts with the Indicator columns) in one transaction
+    """
+    indicators = [dict(indicator, indID=chd_id(indicator['indID'])) for indicator in indicators]
+    _bulk_save_dicts(Indicator, indicators, filename)
+
+
+def _bulk_save_dicts(model, dicts, filename):
+    column_names = [column.name for column in model.__table__.columns]
+    connection = connect_for_bulk_write(filename)
+    try:
+        connection.execute("BEGIN")
+        create_table(connection, model)
+        _bulk_insert(connection, model.__tablename__, column_names,
+                     [tuple(row.get(name) for name in column_names) for row in dicts])
+        connection.execute("COMMIT")
+    except:
+        connection.execute("ROLLBACK")
+        raise
+    finally:
+        connection.close()
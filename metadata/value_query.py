@@ -0,0 +1,166 @@
+"""
+Read-side queries over the value table of ocha.db, for dashboards and other downstream lookups.
+
+Values are read from the typed num_value column, through the covering indexes of orm.VALUE_INDEXES, so looking up an
+indicator across regions, or a region across years, reads only the index and never casts text. Results are kept in a
+small in-process LRU cache, which is emptied whenever the database file changes.
+
+Queries only read the database. A database written before the num_value column and the indexes existed has to be
+upgraded first, with prepare_database or ValueQuery(..., prepare=True).
+
+    query = ValueQuery('ocha.db')
+    query.get('FY010', 'KEN')                       # Series of the values by year
+    query.get('FY010', years=[2012, 2013])          # DataFrame of the values, regions by year
+"""
+
+import collections
+import os
+import sqlite3
+import threading
+
+import pandas as pd
+
+import orm
+
+DEFAULT_CACHE_SIZE = 256
+
+
+def _index_columns(connection, index_name):
+    return [column[2] for column in connection.execute("PRAGMA index_info({})".format(index_name))]
+
+
+def prepare_database(filename):
+    """
+    Make sure the value table has its num_value column and covering indexes, e.g. in a database written before they
+    existed
+    """
+    connection = sqlite3.connect(filename, isolation_level=None)
+    try:
+        connection.execute("BEGIN")
+        orm.upgrade_value_table(connection)
+        for index_name, columns in sorted(orm.VALUE_INDEXES.items()):
+            if _index_columns(connection, index_name) != [column.strip() for column in columns.strip('()').split(',')]:
+                connection.execute("DROP INDEX IF EXISTS {}".format(index_name))
+                connection.execute("CREATE INDEX {} ON {} {}".format(index_name, orm.Value.__tablename__, columns))
+        connection.execute("COMMIT")
+    except:
+        connection.execute("ROLLBACK")
+        raise
+    finally:
+        connection.close()
+
+
+class LRUCache(object):
+    """
+    Least recently used cache of a fixed number of entries
+    """
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        """
+        The cached value, or None
+        """
+        value = self.entries.pop(key, None)
+        if value is not None:
+            self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+def _years_key(years):
+    """
+    years as an int, an iterable of ints or None, normalized to a sorted tuple of periods (or None for all years)
+    """
+    if years is None:
+        return None
+    if isinstance(years, (int, long, basestring)):
+        years = [years]
+    return tuple(sorted(set(str(year) for year in years)))
+
+
+class ValueQuery(object):
+    """
+    Cached lookups of indicator values in one database, upgrading it first with prepare (see prepare_database)
+    """
+    def __init__(self, filename="ocha.db", cache_size=DEFAULT_CACHE_SIZE, prepare=False):
+        if prepare:
+            prepare_database(filename)
+        self.filename = filename
+        self.cache = LRUCache(cache_size)
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._file_version = None
+        self._lock = threading.Lock()
+
+    def _check_file_version(self):
+        """
+        Empty the cache if the database has been written since the cached results were read
+        """
+        versions = []
+        for filename in [self.filename, self.filename + '-wal']:
+            if os.path.exists(filename):
+                status = os.stat(filename)
+                versions.append((status.st_mtime, status.st_size))
+        if versions != self._file_version:
+            self.cache.clear()
+            self._file_version = versions
+
+    def _read(self, sql, parameters):
+        connection = sqlite3.connect(self.filename)
+        try:
+            return connection.execute(sql, parameters).fetchall()
+        finally:
+            connection.close()
+
+    def _query(self, indicator, region, periods):
+        conditions = ["indID = ?"]
+        parameters = [indicator]
+        if region is not None:
+            conditions.append("region = ?")
+            parameters.append(region)
+        if periods is not None:
+            conditions.append("period IN ({})".format(', '.join('?' * len(periods))))
+            parameters.extend(periods)
+
+        rows = self._read("SELECT region, period, num_value FROM {} WHERE {} ORDER BY region, period".format(
+            orm.Value.__tablename__, ' AND '.join(conditions)), parameters)
+        values = pd.DataFrame.from_records(rows, columns=['region', 'period', 'value'])
+        # periods are years, except for values saved without one, which get the date they were saved on
+        if values.period.astype(str).str.isdigit().all():
+            values['period'] = values.period.astype(int)
+        values['value'] = values.value.astype(float)
+
+        if region is not None:
+            series = values.set_index('period').value
+            series.name = indicator
+            return series
+        return values.pivot(index='region', columns='period', values='value')
+
+    def get(self, indicator, region=None, years=None):
+        """
+        Values of the indicator, for the given years (an int or a list of them, or None for all years).
+        With a region, returns a Series indexed by year, otherwise a DataFrame of regions by year.
+        Years are ints, unless some periods are not years (e.g. YYYY-MM-DD), in which case all periods are strings.
+        Values that aren't numbers are NaN. The result is a copy, so it can be changed freely.
+        """
+        key = (indicator, region, _years_key(years))
+        with self._lock:
+            self._check_file_version()
+            result = self.cache.get(key)
+            if result is None:
+                self.cache_misses += 1
+                result = self._query(*key)
+                self.cache.put(key, result)
+            else:
+                self.cache_hits += 1
+            return result.copy()